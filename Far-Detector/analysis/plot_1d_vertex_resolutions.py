@@ -38,6 +38,8 @@ parser.add_argument("--coordinate", help="the coordinate you want to plot", defa
 parser.add_argument("--test_file", help="full path to file used for testing/inference",
                     default="/home/k948d562/NOvA-shared/FD-Training-Samples/{}-Nominal-{}-{}/test/trimmed_h5_R20-11-25-prod5.1reco.j_{}-Nominal-{}-{}_27_of_28.h5",
                     type=str)
+parser.add_argument("--metadata_file", help="the metadata sidecar (.metadata.h5, from '--write_metadata') of the "
+                    "preprocessed test file, read instead of the --test_file", default="", type=str)
 
 meg = parser.add_mutually_exclusive_group()
 meg.add_argument("--nonswap",  required=False, default=False, action='store_true', help="For 'Combined' only, make predictions with the nonswap inference file")
@@ -88,7 +90,9 @@ else:
 # want the mode from the test file (same one used to make the predictions).
 test_file = args.test_file.format(DET, HORN, FLUX, DET, HORN, FLUX)
 print(f'test_file: {test_file}')
-with h5py.File(test_file, mode='r') as f:
+if args.metadata_file:
+    print('metadata_file: {}'.format(args.metadata_file))
+with h5py.File(args.metadata_file or test_file, mode='r') as f:
     df_mode = pd.DataFrame({'Mode': f['mode'][:]})
 
 # define path to save some plots (the local dir).
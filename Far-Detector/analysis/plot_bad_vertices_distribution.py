@@ -16,7 +16,6 @@ import numpy as np
 import os
 import seaborn as sns
 import pandas as pd
-import h5py
 
 
 ########### begin main script ###########
@@ -35,53 +34,38 @@ det, horn, flux = io.IOManager.get_det_horn_and_flux_from_string(train_path_dir)
 
 print('WARNING: You are to use the full training dataset, be sure you have the correct path to train data! ')
 print('data_train_path: ', train_path)
-datasets, total_events, total_files = io.load_data(train_path, False)
-
-print('========================================')
-# convert the lists to numpy arrays
-datasets = dp.convert_lists_to_nparray(datasets)
-print('to access FILE, index in array is: (cvnmap.shape[0] = ', datasets['cvnmap'].shape[0], 'files.)')  # first dimension is the file
+# only the vertices & first hits (and the baked labels, if any): no cvnmap is read.
+label_keys = ['vtx.x', 'vtx.y', 'vtx.z', 'firstcellx', 'firstcelly', 'firstplane', 'vtx_x_pixelmap', 'vtx_y_pixelmap', 'vtx_z_pixelmap']
+datasets, total_events, total_files = io.load_data(train_path, False, keys=label_keys, contiguous=True)
 
 #trust that they are all numpy.arrays AND have the right shape
 #for key in datasets:
 #    print(key)
 #    dp.Debug(datasets[key]).printout_type()
 
-print('========================================')
-datasets['firstcellx'] = dp.DataCleaning(datasets['firstcellx'], 'x').remove_unsigned_ints()
-datasets['firstcelly'] = dp.DataCleaning(datasets['firstcelly'], 'y').remove_unsigned_ints()
-datasets['firstplane'] = dp.DataCleaning(datasets['firstplane'], 'z').remove_unsigned_ints()
-# Let's now check to make sure we don't have any gigantic numbers, from unsigned int's.
-# we already know this is the common number we see if wew do this wrong...so check against it.
-file_idx = 0
-for i in [datasets['firstcellx'], datasets['firstcelly']]:
-    event = 0
-    if i[file_idx][event] > 4294967200:  # this a large number, just below the max value of an unsigned int, which should trigger
-        print('i: ', i)
-    event += 1
-
 #output directory
 outdir = "/homes/m962g264/wsu_Nova_Vertexer/output/XYZ_outputs/plots/"
 
 
-#Converting Detector Coordinate to PIxelmap Coordinates
-datasets['firstcellx']= dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
-datasets['firstcelly'] = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
-datasets['firstplane']= dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
-print('Convertion Done')
-
-#Modifying a dictionary by renaming keys
-datasets['vtx_x_pixelmap'] = datasets.pop('firstcellx')
-datasets['vtx_y_pixelmap'] = datasets.pop('firstcelly')
-datasets['vtx_z_pixelmap'] = datasets.pop('firstplane')
-
-# concatenate/flatten each vertex array
-print("Reshape datasets['vtx_x_pixelmap'], datasets['vtx_y_pixelmap'], datasets['vtx_z_pixelmap'] to be of just the events...")
-print("Before, datasets['vtx_x_pixelmap']: ", datasets['vtx_x_pixelmap'].shape)
-datasets['vtx_x_pixelmap'] = np.concatenate(datasets['vtx_x_pixelmap'], axis=0)
-datasets['vtx_y_pixelmap'] = np.concatenate(datasets['vtx_y_pixelmap'], axis=0)
-datasets['vtx_z_pixelmap'] = np.concatenate(datasets['vtx_z_pixelmap'], axis=0)
-print("After, datasets['vtx_x_pixelmap']: ", datasets['vtx_x_pixelmap'].shape)
+print('========================================')
+if 'vtx_x_pixelmap' in datasets:
+    # preprocessed with --bake_labels: the first hits are already signed, and the labels are in pixel map coordinates.
+    print('The pixel map labels are in the preprocessed files. Skipping the cleaning and conversion...')
+else:
+    datasets['firstcellx'] = dp.remove_unsigned_ints_array(datasets['firstcellx'])
+    datasets['firstcelly'] = dp.remove_unsigned_ints_array(datasets['firstcelly'])
+    datasets['firstplane'] = dp.remove_unsigned_ints_array(datasets['firstplane'])
+
+    #Converting Detector Coordinate to PIxelmap Coordinates
+    datasets['firstcellx']= dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
+    datasets['firstcelly'] = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
+    datasets['firstplane']= dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
+    print('Convertion Done')
+
+    #Modifying a dictionary by renaming keys
+    datasets['vtx_x_pixelmap'] = datasets.pop('firstcellx')
+    datasets['vtx_y_pixelmap'] = datasets.pop('firstcelly')
+    datasets['vtx_z_pixelmap'] = datasets.pop('firstplane')
 
 # combine for Nx3 array: [X, Y, Z]
 vtx_coords = np.stack((datasets['vtx_x_pixelmap'], datasets['vtx_y_pixelmap'], datasets['vtx_z_pixelmap']), axis=-1)
@@ -89,17 +73,6 @@ print('Done converting.')
 print('vtx_coords shape:', vtx_coords.shape)
 
 
-# this array should be something like: [fileIdx](events_in_file, 16000)
-# reshape the pixels into 2 (100,80) views: XZ and YZ.
-# NOTE: this works regardless how many events are in each file...
-datasets['cvnmap'] = np.concatenate([entry.reshape(-1, 16000) for entry in datasets['cvnmap']], axis=0)  # remove the file index (8,)
-datasets['cvnmap'] = datasets['cvnmap'].reshape(total_events, 100, 80, 2)  # divide into the pixels into the map
-datasets['cvnmap'] = datasets['cvnmap'].reshape(datasets['cvnmap'].shape[0], datasets['cvnmap'].shape[1], datasets['cvnmap'].shape[2], datasets['cvnmap'].shape[3], 1) # add the color channel
-datasets['cvnmap'] = datasets['cvnmap'].astype(np.float16)
-# these are views (without copies) to save memory
-cvnmap_xz = datasets['cvnmap'][:, :, :, 0].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the XZ view and reshape
-cvnmap_yz = datasets['cvnmap'][:, :, :, 1].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the YZ view and reshape
-
 
 # Drop the events that are outside the cvnmap!
 # Apply to both features & labels.
@@ -31,6 +31,8 @@ parser.add_argument("--coordinate", help="the coordinate you want to plot", defa
 parser.add_argument("--test_file", help="full path to file used for testing/inference",
                     default="/home/k948d562/NOvA-shared/FD-Training-Samples/{}-Nominal-{}-{}/test/trimmed_h5_R20-11-25-prod5.1reco.j_{}-Nominal-{}-{}_27_of_28.h5",
                     type=str)
+parser.add_argument("--metadata_file", help="the metadata sidecar (.metadata.h5, from '--write_metadata') of the "
+                    "preprocessed test file, read instead of the --test_file", default="", type=str)
 args = parser.parse_args()
 
 C = args.coordinate.upper()
@@ -52,7 +54,9 @@ df = dp.ModelPrediction.load_pred_csv_file(args.pred_file)
 test_file = args.test_file.format(DET, HORN, FLUX, DET, HORN, FLUX)
 print('test_file: {}'.format(test_file))
 
-with h5py.File(test_file, 'r') as f:
+if args.metadata_file:
+    print('metadata_file: {}'.format(args.metadata_file))
+with h5py.File(args.metadata_file or test_file, 'r') as f:
     df_test_file = pd.DataFrame({'E': f['E'][:],
                        'PDG': f['pdg'][:],
                        'Interaction': f['interaction'][:],
@@ -0,0 +1,60 @@
+# python script to check the integrity of EVERY preprocessed file of one or more dirs, in parallel,
+# before a (long) training job reads them. Replaces opening one file in validate_preprocessed_h5.ipynb.
+# Each file is checked for: the schema (version, datasets, cvnmap layout), the types & shapes,
+# the same number of events in every dataset, that every chunk decompresses (the whole file is read),
+# NaN/inf in the floats and out of range firstcellx/firstcelly/firstplane, and the size & sha256 of its manifest.
+
+# A summary of every file (ok, warning, error) is written as JSON, and the script exits with 1 if any file has an error,
+# so it can gate the training job, e.g. `sbatch --dependency=afterok:<verify_job> ...`.
+# The shards, the sidecars and the VDS are listed too: the shards have no manifest (a warning), the rest are skipped.
+
+# To run this script:
+#   $ python verify_preprocessed_files.py --input_dirs <preprocessed_dir> [<dir_2> ...] --workers 8 [--summary_file <file.json>]
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import utils.iomanager as io
+import utils.verify
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files (or Zarr stores)", nargs='+', type=str, required=True)
+    parser.add_argument("--workers", help="number of worker processes (default: SLURM_CPUS_PER_TASK, or all CPUs)",
+                        default=int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count())), type=int)
+    parser.add_argument("--summary_file", help="JSON summary to write (default: <first input dir>/verify_summary.json)",
+                        default='', type=str)
+    parser.add_argument("--skip_checksum", help="don't check the sha256 of the manifests (reads each file once, not twice)",
+                        action='store_true')
+    args = parser.parse_args()
+
+    paths = utils.verify.find_preprocessed_paths(args.input_dirs)
+    print(f'Found {len(paths)} h5 files & Zarr stores in {len(args.input_dirs)} dir(s). Checking with {args.workers} workers.')
+
+    start = time.time()
+    reports = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(utils.verify.verify_file, path, not args.skip_checksum): path for path in paths}
+        for files_done, future in enumerate(as_completed(futures), start=1):
+            report = future.result()
+            reports.append(report)
+            print(f'[{files_done}/{len(paths)}] {report["status"].upper()}: {os.path.basename(report["file"])} '
+                  f'({report["events"]} events, {report["seconds"]:.1f} s)', flush=True)
+            for error in report['errors']:
+                print('    ERROR:', error)
+            for warning in report['warnings']:
+                print('    WARNING:', warning)
+
+    summary = utils.verify.write_summary(reports, args.summary_file or os.path.join(args.input_dirs[0], 'verify_summary.json'))
+    print(f"Checked {summary['files']} files in {(time.time() - start) / 60:.2f} minutes: {summary['ok']} ok, "
+          f"{summary['warning']} with warnings, {summary['error']} with errors, {summary['skipped']} skipped (no events). "
+          f"{summary['events']} events.")
+    if summary['failed_files']:
+        print(f"{len(summary['failed_files'])} file(s) FAILED:")
+        for path in summary['failed_files']:
+            print('  ', path)
+    io.print_memory_usage()
+    sys.exit(1 if summary['failed_files'] else 0)
@@ -2,13 +2,12 @@
 # coding: utf-8
 # # `model_predict_coordinates_xyz.py `
 
-# $PY37 model_predict_coordinates_xyz.py --model_file <model_file>  --outdir <$OUTPUT/predictions>
+# $PY37 model_predict_coordinates_xyz.py --model_file <model_file>  --outdir <$OUTPUT/predictions> [--batch_size 1024]
 
 # Output: creates a CSV file of the vertex predictions from the model h5 file via training.
 # Note: csv file also contains 'True' and 'Elastic Arms' vertex values.
 
-# TODO: We remove the file index, which is just 1, so squeeze() works.
-#  we'll need to fix this if/when we have multiple files to load in...
+# The test files are streamed in batches (--batch_size), so any number of files and events fit in memory.
 
 import os
 import sys
@@ -28,6 +27,7 @@ import utils.iomanager as io
 parser = argparse.ArgumentParser()
 parser.add_argument("--model_file", help="the model file to generate predictions", default="", type=str)
 parser.add_argument("--outdir", help="the directory to save CSV file predictions", default="", type=str)
+parser.add_argument("--batch_size", help="events per batch to predict (bounds the memory)", default=1024, type=int)
 meg = parser.add_mutually_exclusive_group()
 meg.add_argument("--nonswap",  required=False, default=False, action='store_true', help="For 'Combined' only, make predictions with the nonswap inference file")
 meg.add_argument("--fluxswap", required=False, default=False, action='store_true', help="For 'Combined' only, make predictions with the fluxswap inference file")
@@ -69,118 +69,36 @@ print(f'Loading the {FLUX} file for model prediction')
 path_inference = f'/home/k948d562/NOvA-shared/FD-Training-Samples/{DETECTOR}-Nominal-{HORN}-{FLUX}/test/'
 
 
-# Read in the info from the validation file -- don't really care about the events & files here.
-datasets, _, _ = io.load_data(path_inference, True)
-
-# convert the lists to numpy arrays
-print('========================================')
-print('Converting lists to numpy arrays...')
-# NOTE: need to redefine the 'datasets' np.array() returns a copy, so need to save to a new obj.
-datasets = {key: np.array(datasets[key]) for key in datasets}
-
-# These arrays have shape (file (row), events (column), pixels)
-print("datasets['cvnmap'].shape: ", datasets['cvnmap'].shape)
-
-# Next, for model prediction, we want to remove the file index completely. Do it now.
-print('Flattening the arrays in `datasets`...')
-for key in datasets:
-    if key == 'cvnmap':
-        print(f'Skipping {key}, will NOT flatten().')
-        continue
-    datasets[key] = datasets[key].flatten()
-    print(f'datasets[{key}].shape: {datasets[key].shape}')
-
-
-print('========================================')
-print('Addressing the bug in the h5 files. Converting firstcellx, firstcelly, firstplane to int type...')
-datasets['firstcellx'] = dp.DataCleaning(datasets['firstcellx'], 'x').remove_unsigned_ints(single_file=True)
-datasets['firstcelly'] = dp.DataCleaning(datasets['firstcelly'], 'y').remove_unsigned_ints(single_file=True)
-datasets['firstplane'] = dp.DataCleaning(datasets['firstplane'], 'z').remove_unsigned_ints(single_file=True)
-# Let's now check to make sure we don't have any gigantic numbers, from unsigned int's.
-# we already know this is the common number we see if wew do this wrong...so check against it.
-for i in [datasets['firstcellx'], datasets['firstcelly']]:
-    event = 0
-    # assuming only 1 file used:
-    if i[event] > 4294967200:  # this a large number, just below the max value of an unsigned int, which should trigger
-        print('event: ', event)
-    event += 1
-
-vtx_coords = np.stack(
-    (
-        dp.ConvertFarDetCoords(DETECTOR, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx']),
-        dp.ConvertFarDetCoords(DETECTOR, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly']),
-        dp.ConvertFarDetCoords(DETECTOR, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane']),
-    ),
-    axis=-1
-)
-print('Done converting.')
-
-print('Now remove the file index from the cvnmap...')
-assert datasets['cvnmap'].shape[0] == 1, "More than 1 file, and the events in each file are likely not the same."
-# We assume the index of 1 is the file index! With shape (1, 497067, 16000)
-# Will have to come back when we have more than one file to predict...
-datasets['cvnmap'] = datasets['cvnmap'].squeeze() # remove the 1, (i.e. file) index
-
-# dictionary of {keep; np.array, drop: array}
-keep_drop_evts = dp.DataCleaning.sort_events_with_vtxs_outside_cvnmaps(vtx_coords)
-# Now drop events that are outside the map for ALL datasets key-value pairs
-print('dropping events outside the 80x100 maps for all datasets keys')
-for key in datasets:
-    print(key)
-    datasets[key] = datasets[key][keep_drop_evts['keep']]
-
-print('========================================')
-print('-------------------')
-print('cvnmap.shape: ', datasets['cvnmap'].shape)
-print('vtx_x.shape: ', datasets['vtx.x'].shape)
-print('firstcellx.shape: ', datasets['firstcellx'].shape)
-print('-------------------')
-
-# Print the new shape
-print("datasets['cvnmap'].shape", datasets['cvnmap'].shape)  # Should be (497067, 16000)
-print('The index is now:')
-print('cvnmap.shape: ', datasets['cvnmap'].shape)
-print('vtx_x.shape: ', datasets['vtx.x'].shape)
-print('firstcellx.shape: ', datasets['firstcellx'].shape)
-print('-------------------')
-# reshape the pixels into 2 (100,80) views: XZ and YZ.
-print('reshape the pixels into 2 (100,80) views: XZ and YZ.....')
-datasets['cvnmap'] = datasets['cvnmap'].reshape(datasets['cvnmap'].shape[0],
-                                                100,
-                                                80,
-                                                2)  # 2 views, 100x80 pixels onto single axis
-print(datasets['cvnmap'].shape)
-datasets['cvnmap'] = datasets['cvnmap'].reshape(datasets['cvnmap'].shape[0],
-                                                datasets['cvnmap'].shape[1],
-                                                datasets['cvnmap'].shape[2],
-                                                datasets['cvnmap'].shape[3],
-                                                1)  # add the color channel
-print(datasets['cvnmap'].shape)
-# -1 automatically calculates the size of the dimension
-cvnmap_xz = datasets['cvnmap'][:, :, :, 0].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the XZ view and reshape
-cvnmap_yz = datasets['cvnmap'][:, :, :, 1].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the YZ view and reshape
-print('cvnmap_xz.shape ', cvnmap_xz.shape)
-print('cvnmap_yz.shape ', cvnmap_yz.shape)
+# Stream the inference files in batches (see iomanager.iter_batches()): the memory is ~one batch of cvnmaps, however many
+# events or files. Only the events inside the cvnmap are predicted, as before -- those outside are never read.
+# The batches hold the signed first hits, to convert the predictions back, and the truth & Elastic Arms for the CSV.
 print('========================================')
-assert cvnmap_xz.shape == cvnmap_yz.shape, "Shapes of cvnmap_xz and cvnmap_yz must match."
-print('========================================')
-
-
-print('about to predict() with the model:')
-# Prediction of the coordinate in the pixelmap coordinates
+print(f'Streaming the events of {path_inference} in batches of {args.batch_size}...')
+csv_keys = ['vtx.x', 'vtx.y', 'vtx.z', 'vtxEA.x', 'vtxEA.y', 'vtxEA.z', 'firstcellx', 'firstcelly', 'firstplane']
+columns = {key: [] for key in csv_keys}
+pred_vtx = []
 start = time.time()
-pred_vtx = model.predict([cvnmap_xz, cvnmap_yz])  # need to give the two views bc I have dual-input model
+for batch in io.iter_batches(path_inference, args.batch_size, keys=csv_keys, drop_outside_map=True):
+    assert batch['xz'].shape == batch['yz'].shape, "Shapes of cvnmap_xz and cvnmap_yz must match."
+    # Prediction of the coordinate in the pixelmap coordinates
+    pred_vtx.append(model.predict_on_batch([batch['xz'], batch['yz']]))  # need to give the two views bc I have dual-input model
+    for key in csv_keys:
+        columns[key].append(batch[key])
 print('Prediction done.')
 end = time.time()
 print('Time to predict: ', end - start)
+
+datasets = {key: np.concatenate(columns[key]) for key in csv_keys}
+pred_vtx = np.concatenate(pred_vtx)
 print('-------------------')
 print('pred_pixelmap.shape ', pred_vtx.shape)
+print('vtx_x.shape: ', datasets['vtx.x'].shape)
 print('-------------------')
 print('========================================')
 
 # Convert this prediction BACK into detector coordinates (each column is a coordinate)
 print('Converting the prediction back into detector coordinates...')
-x = dp.ConvertFarDetCoords(DETECTOR, 'x').convert_pixelmap_to_fd_vtx(pred_vtx[:,0], datasets['firstcellx'])
+x = dp.ConvertFarDetCoords(DETECTOR, 'x').convert_pixelmap_to_fd_vtx(pred_vtx[:, 0], datasets['firstcellx'])
 y = dp.ConvertFarDetCoords(DETECTOR, 'y').convert_pixelmap_to_fd_vtx(pred_vtx[:, 1], datasets['firstcelly'])
 z = dp.ConvertFarDetCoords(DETECTOR, 'z').convert_pixelmap_to_fd_vtx(pred_vtx[:, 2], datasets['firstplane'])
 
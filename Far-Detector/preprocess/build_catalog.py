@@ -0,0 +1,32 @@
+# python script to catalog the preprocessed files of each dir, from their metadata only (no data is read):
+# the events (and those inside the cvnmap), datasets, types, chunks & compression, det/horn/flux and size on disk of every file,
+# into <dir>/catalog.json. The loaders then take the event ids of the files from it (iomanager.load_catalog()),
+# and the memory of the loaded arrays is printed, to size the training job.
+
+# NOTE: the catalog is ignored once a file is added, removed or rewritten, rebuild it after (re)preprocessing.
+
+# To run this script:
+#   $ python build_catalog.py --input_dirs <preprocessed_dir> [<dir_2> ...]
+
+import argparse
+import time
+
+import utils.catalog
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files (or Zarr stores), one catalog each",
+                        nargs='+', type=str, required=True)
+    args = parser.parse_args()
+
+    for input_dir in args.input_dirs:
+        start = time.time()
+        catalog = utils.catalog.build_catalog(input_dir)
+        print(f"{catalog['det']} {catalog['horn']} {catalog['flux']}: {len(catalog['files'])} files, "
+              f"{catalog['events']} events ({catalog['contained_events']} inside the cvnmap), "
+              f"{catalog['size_bytes'] / 1024 ** 3:.2f} GB on disk. Cataloged in {time.time() - start:.1f} s.")
+        for contained_only in [False, True]:
+            load_bytes = utils.catalog.estimate_load_bytes(catalog, contained_only)
+            print(f'load_data(..., contained_only={contained_only}, contiguous=True) needs '
+                  f'{sum(load_bytes.values()) / 1024 ** 3:.2f} GB: '
+                  + ', '.join(f'{key} {value / 1024 ** 3:.2f} GB' for key, value in load_bytes.items()))
@@ -0,0 +1,26 @@
+# python script to stitch the preprocessed h5 files of a sample into one HDF5 virtual dataset (VDS) file:
+# 'cvnmap', 'vtx.*', 'firstcell*', ... of every file as single datasets, without copying any data.
+# Any global range of events is then one h5py read, and load_data() takes the VDS file as the path to the data.
+
+# NOTE: the VDS maps the preprocessed files by absolute path, rebuild it if they move.
+# NOTE: not for '--layout sparse' files (their offsets restart in every file), repack those into shards instead.
+
+# To run this script:
+#   $ python build_vds.py --input_dirs <preprocessed_dir> [<dir_2> ...] [--outfile <file.vds.h5>]
+
+import argparse
+
+import utils.iomanager as io
+import utils.vds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files", nargs='+', type=str, required=True)
+    parser.add_argument("--outfile", help="the VDS file to create (default: <first input dir>/<its name>.vds.h5)",
+                        default='', type=str)
+    args = parser.parse_args()
+
+    # sorted, so the event ids are the same as those of the directory.
+    in_files = io.list_preprocessed_files(args.input_dirs)
+    print(f'Found {len(in_files)} preprocessed h5 files in {len(args.input_dirs)} dir(s).')
+    utils.vds.build_vds(in_files, args.outfile or utils.vds.vds_filename(args.input_dirs[0]))
@@ -9,9 +9,6 @@
 # run this script by:
 #   $ . create_slurm_script_preprocess.sh  <det> <horn> <flux> <file_number>
 
-#confusion:  from Adam Tygart...don't request multiple nodes if you can't guarantee your code can handle them.
-# -- but sbatch config fails with just 1 node.
-
 DATE=$(date +%m-%d-%Y.%H.%M.%S)
 echo "current date: " $DATE
 
@@ -58,20 +55,25 @@ cat > ${slurm_dir}/${slurm_script} <<EOF
 #SBATCH --output ${OUTDIR_PREFIX}/logs/${PREPROCESS_FILE}.out
 #SBATCH --error  ${OUTDIR_PREFIX}/logs/${PREPROCESS_FILE}.err
 
-#SBATCH --nodes=2         # 2 if you can't guarantee your code can handle them. your current code cannot.
-#SBATCH --mem-per-cpu=40G # memory per CPU core
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --mem=2G          # the file is streamed in blocks of events, so a few hundred MB is plenty
 #========================================================================================================
 
 
+export WSUVTX="/homes/\$USER/WSU-NOvA-Vertexer"
+
 # load modules
-module load Python/3.7.4-GCCcore-8.3.0
-module load TensorFlow/2.3.1-fosscuda-2019b-Python-3.7.4
-source /home/k948d562/virtual-envs/VirtualTensorFlow-Abdul/VirtualTensor/bin/activate
-/home/k948d562/virtual-envs/VirtualTensorFlow-Abdul/VirtualTensor/bin/python --version
+module load Python/3.11.5-GCCcore-13.2.0
+source /homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/activate
+/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/python --version
 
+# the preprocessing lives in utils/, so WSUVTX must be in the PYTHONPATH.
+unset PYTHONPATH
+export PYTHONPATH="/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/lib/python3.11/site-packages:\${WSUVTX}"
 
 #run python script
-/home/k948d562/virtual-envs/VirtualTensorFlow-Abdul/VirtualTensor/bin/python /home/k948d562/ml-vertexing/wsu-vertexer/preprocess/preprocess_h5_file.py  $PREPROCESS_FILE_PATH
+/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/python \${WSUVTX}/Far-Detector/preprocess/preprocess_h5_file.py  $PREPROCESS_FILE_PATH
 EOF
 
 echo "Slurm script created: ${slurm_dir}/${slurm_script}"
@@ -0,0 +1,101 @@
+#!/bin/bash
+# shellcheck disable=SC2086
+
+# bash script to create the pre-processing slurm script for Vertexing ML on WSU BeoShock cluster.
+# this script preprocesses EVERY file of the sample(s) in a single job, using a pool of workers on one node.
+# NOTE: this preprocessing saves the X,Y, and Z vertex information into single file!
+
+# run this script by:
+#   $ . create_slurm_script_preprocess_parallel.sh  <det> <horn> <flux> <workers>
+# where <horn> can be FHC, RHC or "all", and <flux> can be Nonswap, Fluxswap or "all".
+
+DATE=$(date +%m-%d-%Y.%H.%M.%S)
+echo "current date: " $DATE
+
+# Ensure exactly 4 arguments are provided
+if [[ $# -ne 4 ]]; then
+    echo "Usage: $0 <DET> <HORN> <FLUX> <WORKERS>"
+    echo "Example: $0 FD all all 8"
+    return 0
+fi
+
+DET=${1^^}     # ND or FD
+HORN=$2        # FHC, RHC, or all
+FLUX=$3        # Nonswap, Fluxswap, or all
+WORKERS=$4     # number of files to preprocess at the same time (one CPU each)
+
+HORNS=$HORN
+FLUXES=$FLUX
+if [[ ${HORN,,} == "all" ]]; then HORNS="FHC RHC"; fi
+if [[ ${FLUX,,} == "all" ]]; then FLUXES="Nonswap Fluxswap"; fi
+
+echo "Detector: $DET"
+echo "Horn(s): $HORNS"
+echo "Flux(es): $FLUXES"
+echo "Workers: $WORKERS"
+
+# The sample dirs to be processed.
+INPUT_DIRS=""
+for H in $HORNS; do
+    for F in $FLUXES; do
+        INPUT_DIRS="$INPUT_DIRS /home/k948d562/NOvA-shared/$DET-Training-Samples/$DET-Nominal-${H^^}-${F^}/train"
+    done
+done
+echo "Sample dirs to preprocess: $INPUT_DIRS"
+
+outputfile=preprocess_parallel_${DET}_${HORN}_${FLUX}_date_${DATE}
+
+# the log files go into logs dir
+OUTDIR_PREFIX=/home/k948d562/output/wsu-vertexer/preprocess
+
+slurm_dir="/home/k948d562/slurm-scripts/"
+slurm_script="submit_slurm_${outputfile}.sh"
+
+cat > ${slurm_dir}/${slurm_script} <<EOF
+#!/bin/bash
+
+# script automatically generated at ${DATE} by create_slurm_script_preprocess_parallel.sh.
+
+## There is one strict rule for guaranteeing Slurm reads all of your options:
+## Do not put *any* lines above your resource requests that aren't either:
+##    1) blank. (no other characters)
+##    2) comments (lines must begin with '#')
+
+#Run this script by [ $ sbatch $slurm_script ]
+#========================================================================================================
+#SBATCH --job-name=${outputfile}
+#SBATCH --time=48:00:00
+
+#SBATCH --output ${OUTDIR_PREFIX}/logs/${outputfile}.out
+#SBATCH --error  ${OUTDIR_PREFIX}/logs/${outputfile}.err
+
+### a single task, with one CPU per worker process.
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=${WORKERS}
+#SBATCH --mem-per-cpu=4G  # memory per CPU core (i.e. per worker), the files are streamed in blocks of events
+#========================================================================================================
+
+export WSUVTX="/homes/\$USER/WSU-NOvA-Vertexer"
+
+# load modules
+module load Python/3.11.5-GCCcore-13.2.0
+source /homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/activate
+/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/python --version
+
+unset PYTHONPATH
+export PYTHONPATH="/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/lib/python3.11/site-packages:\${WSUVTX}"
+
+#run python script
+/homes/k948d562/virtual-envs/py3.11-pipTF2.15.0/bin/python \${WSUVTX}/Far-Detector/preprocess/preprocess_h5_files_parallel.py \\
+    --input_dirs ${INPUT_DIRS} \\
+    --outdir ${OUTDIR_PREFIX} \\
+    --workers ${WORKERS} \\
+    --mem_per_worker 3
+
+# After the job finishes, log resource usage
+sleep 120
+sacct -j \$SLURM_JOB_ID --format=JobID,JobName,MaxRSS,MaxVMSize,NodeList,Elapsed,State >> ${OUTDIR_PREFIX}/logs/${outputfile}.out
+EOF
+
+echo "Slurm script created: ${slurm_dir}/${slurm_script}"
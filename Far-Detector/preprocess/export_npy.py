@@ -0,0 +1,40 @@
+# python script to export the preprocessed h5 files of a sample into raw, uncompressed .npy arrays,
+# one per column (cvnmap, vtx.x, ...), all files concatenated, plus a JSON schema (schema.json).
+# The training and prediction then memory map the columns (load_data() does it when it finds the schema),
+# instead of decompressing and copying every byte. Jobs on the same node share the pages in the OS page cache.
+
+# NOTE: uncompressed, so the export is ~16 kB per event (the size of the dense cvnmap).
+
+# To run this script:
+#   $ python export_npy.py --input_dirs <preprocessed_dir_1> [<dir_2> ...] --outdir <npy_dir> [--contained_only]
+
+import argparse
+import os
+import time
+
+import utils.iomanager as io
+import utils.npy_export
+import utils.preprocess
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files", nargs='+', type=str, required=True)
+    parser.add_argument("--outdir", help="directory to save the .npy columns and the schema", type=str, required=True)
+    parser.add_argument("--contained_only", help="export only the events with the vertex inside the cvnmap "
+                                                 "(files preprocessed with '--containment mask')",
+                        default=False, action='store_true')
+    parser.add_argument("--block_size", help="events copied at a time (sets the peak memory)",
+                        default=utils.preprocess.DEFAULT_BLOCK_SIZE, type=int)
+    args = parser.parse_args()
+
+    # sorted, so the event order is reproducible.
+    in_files = io.list_preprocessed_files(args.input_dirs)
+    print(f'Found {len(in_files)} preprocessed h5 files in {len(args.input_dirs)} dir(s).')
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+        print('created dir: {}'.format(args.outdir))
+
+    start = time.time()
+    utils.npy_export.export_npy(in_files, args.outdir, args.contained_only, args.block_size)
+    print(f'Exported in {(time.time() - start) / 60:.2f} minutes.')
+    io.print_memory_usage()
@@ -0,0 +1,44 @@
+# python script to merge the pixel stats sidecars (.stats.h5, from '--write_stats') of the preprocessed files
+# into the stats of the whole sample (one stats h5 file).
+# The training normalises the cvnmaps from the stats of its training set only (--stats_file, with --split_file),
+# so with --split_file the stats are instead accumulated over the training events of the split (see pixel_stats.split_stats()).
+
+# Without --split_file, only the small sidecars are read, not the cvnmaps.
+# With --split_file, the cvnmaps of the sample are streamed once, in batches.
+
+# To run this script:
+#   $ python merge_pixel_stats.py --input_dirs <preprocessed_dir_1> [<dir_2> ...] --outfile <sample.stats.h5>
+#   $ python merge_pixel_stats.py --input_dirs <preprocessed_dir> --split_file <split.h5> --outfile <train.stats.h5>
+
+import argparse
+import os
+
+import utils.pixel_stats
+import utils.splits
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files, with their .stats.h5 sidecars",
+                        nargs='+', type=str, required=True)
+    parser.add_argument("--outfile", help="the merged stats h5 file to save", type=str, required=True)
+    parser.add_argument("--split_file", help="only the training events of this split (create_split_file.py), "
+                                             "read from the preprocessed files of the (single) input dir. Needed to train with the stats.",
+                        default='', type=str)
+    args = parser.parse_args()
+
+    if args.split_file:
+        if len(args.input_dirs) != 1:
+            parser.error('The split is of a single sample, give its dir only.')
+        split = utils.splits.load_split(args.split_file, args.input_dirs[0])
+        stats = utils.pixel_stats.split_stats(args.input_dirs[0], split, 'train')
+    else:
+        stats_files = []
+        for input_dir in args.input_dirs:
+            stats_files += [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir)) if name.endswith('.stats.h5')]
+        print(f'Found {len(stats_files)} stats files in {len(args.input_dirs)} dir(s).')
+        if not stats_files:
+            raise FileNotFoundError("No .stats.h5 files, preprocess with '--write_stats'.")
+        stats = utils.pixel_stats.merge_stats_files(stats_files)
+    for key, value in stats.global_stats().items():
+        print(f'{key}: {value}')
+    stats.save(args.outfile)
@@ -6,70 +6,33 @@
 # (vtx.x, vtx.y, vtx.z, firstcellx, firstcelly, firstplane, cvnmap).
 
 # this script is submitted to the BeoShock (WSU) cluster
-# where each slurm submission processes one file at a time
+# where each slurm submission processes one file at a time.
+# To process a whole sample on a single node, use preprocess_h5_files_parallel.py.
 
 # M. Dolce
 # Oct. 2023
 
-# To run this script:  $PY37 preprocess_h5_file.py <infile_h5>
+# The file is streamed in blocks of events, so the memory needed is only a few hundred MB.
+# The input is read once, however many outputs: e.g. '--also_subsets 10000 --write_metadata --write_stats'
+# writes the full file, a 10k subset (in its own dir in <outdir>), and the metadata & stats sidecars of each, from a single pass.
 
+# To run this script:  $PY37 preprocess_h5_file.py <infile_h5> [--outdir <outdir>] [--block_size 1024]
+#                       [--compression {gzip,lzf,none}] [--compression_level 4] [--shuffle] [--chunk_events 1]
+#                       [--also_subsets 10000 --sampling stratified --seed 1]
 
 
-import os
-import sys
-import h5py
-import numpy as np
+import argparse
 
-if __name__ == '__main__':
-    # Terminal Arguments: input file [1]
-    inFilePath = sys.argv[1]
-    inPath = inFilePath.split('/')[:-1]
-    infile = inFilePath.split('/')[-1]
-    # print('input path: ', inPath)
+import utils.preprocess
+import utils.preprocess_cli
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile_h5", help="full path to the trimmed h5 file", type=str)
     # this outPath is hard-coded, it's in "my" directory
-    outPath = '/home/k948d562/output/wsu-vertexer/preprocess'
-    outName = f'preprocessed_{infile}'
-    print('Processing h5 file: ' + infile)
-    print('Saving for training to ' + outPath)
-
-    # Don't recreate the file if it exists
-    print(f'Creating file...{os.path.join(outPath, outName)}')
-    if os.path.exists(os.path.join(outPath, outName)):
-        print('File already exists. Don\'t want to overwrite! Exiting...')
-        sys.exit()
-
-    # Load the h5 file
-    # One file at a time to avoid problems with loading a bunch of pixel maps in memory
-    print(f'Opening file.....{infile}')
-    df_x = h5py.File(inFilePath, 'r')['vtx.x']
-    df_y = h5py.File(inFilePath, 'r')['vtx.y']
-    df_z = h5py.File(inFilePath, 'r')['vtx.z']
-    df_cvnmap = h5py.File(inFilePath, 'r')['cvnmap']
-    df_firstcellx = h5py.File(inFilePath, 'r')['firstcellx']
-    df_firstcelly = h5py.File(inFilePath, 'r')['firstcelly']
-    df_firstplane = h5py.File(inFilePath, 'r')['firstplane']
-    print('loaded the vertices, first cells, first plane and cvnmap dfs')
-
-    # Save in an h5 with new dataset keys
-    hf = h5py.File(os.path.join(outPath, outName), 'w')
-
-    hf.create_dataset('vtx.x',  data=df_x,                compression='gzip')
-    print('added vtx.x')
-    hf.create_dataset('vtx.y',  data=df_y,                compression='gzip')
-    print('added vtx.y')
-    hf.create_dataset('vtx.z',  data=df_z,                compression='gzip')
-    print('added vtx.z')
-    hf.create_dataset('firstcellx', data=df_firstcellx,   compression='gzip')
-    print('added firstcellx')
-    hf.create_dataset('firstcelly', data=df_firstcelly,   compression='gzip')
-    print('added firstcelly')
-    hf.create_dataset('firstplane', data=df_firstplane,   compression='gzip')
-    print('added firstplane')
-
-    # save as 'chunks' to save space, since each pixel map is this size.
-    hf.create_dataset('cvnmap', data=np.stack(df_cvnmap), chunks=(1, 16000),  compression='gzip')
-    print('added cvnmap')
+    parser.add_argument("--outdir", help="directory to save the preprocessed file",
+                        default='/home/k948d562/output/wsu-vertexer/preprocess', type=str)
+    utils.preprocess_cli.add_preprocess_arguments(parser)
+    args = parser.parse_args()
 
-    hf.close()
-    print('File created: ', outName)
+    utils.preprocess.preprocess_h5_file(args.infile_h5, args.outdir, **utils.preprocess_cli.preprocess_kwargs(args))
@@ -0,0 +1,108 @@
+# python script to preprocess MANY trimmed h5 files at once, on a single node.
+# Same slimming as preprocess_h5_file.py (vtx.x, vtx.y, vtx.z, firstcellx, firstcelly, firstplane, cvnmap),
+# but every trimmed h5 file in the sample directories is handed to a bounded pool of worker processes.
+# This replaces submitting one slurm job per file number.
+
+# the sample directories can be one, or several (i.e. {FHC,RHC} x {Nonswap,Fluxswap}), e.g.
+#   /home/k948d562/NOvA-shared/FD-Training-Samples/FD-Nominal-FHC-Nonswap/train/
+
+# To run this script:
+#   $ python preprocess_h5_files_parallel.py --input_dirs <dir1> [<dir2> ...] --outdir <outdir> --workers 8 --mem_per_worker 4
+
+import argparse
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+
+import utils.iomanager as io
+import utils.preprocess_cli
+
+
+def limit_worker_memory(mem_per_worker_gb) -> None:
+    """
+    Initializer for each worker process: cap its address space,
+    so a single bad file cannot take down the whole node.
+    :param mem_per_worker_gb: float, cap in GB. 0 means no cap.
+    :return: None
+    """
+    if mem_per_worker_gb > 0:
+        cap = int(mem_per_worker_gb * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    return None
+
+
+def find_trimmed_h5_files(input_dirs) -> list:
+    """
+    :param input_dirs: list of sample directories
+    :return: sorted list of full paths to the h5 files within them
+    """
+    h5_files = []
+    for input_dir in input_dirs:
+        for h5_filename in sorted(os.listdir(input_dir)):
+            if not h5_filename.endswith('.h5'):
+                print('Skipping this file or dir:', h5_filename)
+                continue
+            h5_files.append(os.path.join(input_dir, h5_filename))
+    return h5_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="sample dir(s) of trimmed h5 files", nargs='+', type=str, required=True)
+    parser.add_argument("--outdir", help="directory to save the preprocessed files",
+                        default=f'/home/{io.USER}/output/wsu-vertexer/preprocess', type=str)
+    parser.add_argument("--workers", help="number of worker processes (default: SLURM_CPUS_PER_TASK, or all CPUs)",
+                        default=int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count())), type=int)
+    parser.add_argument("--mem_per_worker", help="address space cap per worker, in GB (0 = no cap)", default=0, type=float)
+    utils.preprocess_cli.add_preprocess_arguments(parser)
+    args = parser.parse_args()
+
+    in_files = find_trimmed_h5_files(args.input_dirs)
+    print(f'Found {len(in_files)} trimmed h5 files in {len(args.input_dirs)} sample dir(s).')
+    print(f'Using {args.workers} workers, {args.mem_per_worker} GB cap per worker (0 = no cap).')
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+        print('created dir: {}'.format(args.outdir))
+
+    # the event count from the metadata only, so we can report the rate of the whole job.
+    events_to_do = 0
+    for in_file in in_files:
+        with h5py.File(in_file, 'r') as f:
+            events_to_do += f['cvnmap'].shape[0]
+    print(f'Total events to preprocess: {events_to_do}')
+    io.print_memory_usage()
+
+    start = time.time()
+    total_events = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             initializer=limit_worker_memory,
+                             initargs=(args.mem_per_worker,)) as pool:
+        futures = {pool.submit(utils.preprocess_cli.preprocess_h5_file_timed, in_file, args.outdir,
+                               **utils.preprocess_cli.preprocess_kwargs(args)): in_file
+                   for in_file in in_files}
+        for files_done, future in enumerate(as_completed(futures), start=1):
+            in_file = futures[future]
+            try:
+                _, n_events, seconds = future.result()
+            except Exception as e:  # report the bad file, but keep the rest of the pool going.
+                print(f'ERROR: failed to preprocess {in_file}: {e!r}')
+                failed.append(in_file)
+                continue
+            total_events += n_events
+            elapsed = time.time() - start
+            print(f'[{files_done}/{len(in_files)}] {os.path.basename(in_file)}: '
+                  f'{n_events} events in {seconds:.1f} s ({n_events / max(seconds, 1e-9):.0f} events/s). '
+                  f'Overall: {total_events}/{events_to_do} events, {total_events / max(elapsed, 1e-9):.0f} events/s.',
+                  flush=True)
+
+    elapsed = time.time() - start
+    print(f'Preprocessed {total_events} events from {len(in_files) - len(failed)} files in {elapsed / 60:.2f} minutes.')
+    if failed:
+        print(f'{len(failed)} file(s) FAILED:')
+        for in_file in failed:
+            print('  ', in_file)
+    io.print_memory_usage()
@@ -0,0 +1,33 @@
+# preprocess a SUBSET of the events of an h5 file, for "test" training,
+# i.e. to run xyz_vertex_training_testsize.py on an interactive node.
+# Same slimming as preprocess_h5_file.py (vtx.x, vtx.y, vtx.z, firstcellx, firstcelly, firstplane, cvnmap).
+
+# The subset can be:
+#   -- first:      the first N events (fast, but biased -- the files are not shuffled),
+#   -- random:     a uniform random sample of N events,
+#   -- stratified: a random sample of N events, in the same proportions of each
+#                  interaction mode, neutrino pdg and CC/NC (--stratify_by) as the whole file.
+# The events are picked from the scalar columns, then read in sorted, coalesced blocks from a single open file.
+
+# To run this script:
+#   $ python preprocess_h5_subset.py <infile_h5> --n_events 10000 --sampling stratified [--seed 1] [--outdir <outdir>]
+
+import argparse
+
+import utils.iomanager as io
+import utils.preprocess
+import utils.preprocess_cli
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile_h5", help="full path to the trimmed h5 file", type=str)
+    parser.add_argument("--outdir", help="directory to save the preprocessed file",
+                        default=f'/home/{io.USER}/output/wsu-vertexer/preprocess', type=str)
+    parser.add_argument("--n_events", help="number of events to keep", default=10_000, type=int)
+    utils.preprocess_cli.add_preprocess_arguments(parser)
+    args = parser.parse_args()
+
+    # --sampling, --stratify_by & --seed are in the shared preprocessing options.
+    utils.preprocess.preprocess_h5_file(args.infile_h5, args.outdir,
+                                        subset_events=args.n_events,
+                                        **utils.preprocess_cli.preprocess_kwargs(args))
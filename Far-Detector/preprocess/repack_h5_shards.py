@@ -0,0 +1,40 @@
+# python script to repack the preprocessed h5 files (which mirror the uneven trimmed h5 files)
+# into shards of the same number of events, plus a global index (shard_index.h5):
+#   event id -> (shard, row), and -> (source file, source row).
+# Equal shards give parallel readers the same work, can be shuffled per epoch (rather than the events),
+# and a part of the sample can be used by taking fewer shards.
+
+# The shards are preprocessed files too, so load_data() reads a directory of shards as usual.
+# All the input files must be preprocessed with the same options (datasets & layout).
+
+# To run this script:
+#   $ python repack_h5_shards.py --input_dirs <preprocessed_dir_1> [<dir_2> ...] --outdir <shard_dir> --shard_events 65536
+
+import argparse
+import os
+import time
+
+import utils.iomanager as io
+import utils.preprocess
+import utils.shards
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files", nargs='+', type=str, required=True)
+    parser.add_argument("--outdir", help="directory to save the shards and the index", type=str, required=True)
+    parser.add_argument("--shard_events", help="events per shard", default=utils.shards.DEFAULT_SHARD_EVENTS, type=int)
+    parser.add_argument("--block_size", help="events copied at a time (sets the peak memory)",
+                        default=utils.preprocess.DEFAULT_BLOCK_SIZE, type=int)
+    args = parser.parse_args()
+
+    # sorted, so the event ids are reproducible.
+    in_files = io.list_preprocessed_files(args.input_dirs)
+    print(f'Found {len(in_files)} preprocessed h5 files in {len(args.input_dirs)} dir(s).')
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+        print('created dir: {}'.format(args.outdir))
+
+    start = time.time()
+    utils.shards.repack_shards(in_files, args.outdir, args.shard_events, args.block_size)
+    print(f'Repacked in {(time.time() - start) / 60:.2f} minutes.')
+    io.print_memory_usage()
@@ -0,0 +1,108 @@
+# python script to compare the read throughput of preprocessed h5 files written with different layouts,
+# i.e. the compression codec (gzip level, lzf, shuffle filter, or none), the chunk size in events,
+# the cvnmap layout (flat, views, or sparse -- only the non-zero pixels, densified when read),
+# and the backend: h5, or a Zarr store with Blosc (lz4, zstd, '+shuffle' is the bit-shuffle) decompressed in parallel threads.
+# Use it to pick the layout that maximises the training ingest speed per GB of disk.
+
+# Either report on existing preprocessed files (or Zarr stores):
+#   $ python report_read_throughput.py --files <preprocessed_1.h5> <preprocessed_2.zarr> ...
+# or write ONE trimmed h5 file with every candidate layout into --workdir, and report on those:
+#   $ python report_read_throughput.py --infile_h5 <trimmed.h5> --workdir <scratch_dir> \
+#         --codecs gzip gzip+shuffle lzf none --chunk_events 1 16 64 256 --layouts flat sparse
+# e.g. gzip HDF5 side by side with Blosc Zarr, read with the 8 CPUs of the job:
+#   $ python report_read_throughput.py --infile_h5 <trimmed.h5> --workdir <scratch_dir> --backends h5 zarr \
+#         --codecs gzip lz4+shuffle zstd+shuffle --chunk_events 64 --read_threads 8
+# (the codecs a backend doesn't have are skipped).
+
+# NOTE: the OS page cache will serve repeated reads of a file, so compare the first pass of each file.
+
+import argparse
+import os
+
+import pandas as pd
+
+import utils.iomanager as io
+import utils.preprocess
+import utils.zarr_store
+
+
+def parse_codec(codec) -> dict:
+    """
+    :param codec: str, e.g. 'gzip', 'gzip+shuffle', 'lzf', 'none'
+    :return: dict of compression keywords for preprocess_h5_file()
+    """
+    name, _, extra = codec.partition('+')
+    return {'compression': name, 'shuffle': extra == 'shuffle'}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    meg = parser.add_mutually_exclusive_group(required=True)
+    meg.add_argument("--files", help="preprocessed h5 files (or Zarr stores) to report on", nargs='+', type=str)
+    meg.add_argument("--infile_h5", help="trimmed h5 file to write in every candidate layout", type=str)
+    parser.add_argument("--workdir", help="scratch dir for the candidate layouts", default='', type=str)
+    parser.add_argument("--codecs", help="codecs to try, a '+shuffle' suffix adds the shuffle filter",
+                        nargs='+', default=['gzip', 'gzip+shuffle', 'lzf', 'lzf+shuffle', 'none'], type=str)
+    parser.add_argument("--compression_level", help="gzip (or Blosc) compression level (0-9)", default=4, type=int)
+    parser.add_argument("--chunk_events", help="chunk sizes (in events) to try", nargs='+', default=[1, 16, 64, 256], type=int)
+    parser.add_argument("--layouts", help="cvnmap layouts to try", nargs='+', default=['flat'],
+                        choices=utils.preprocess.CVNMAP_LAYOUTS, type=str)
+    parser.add_argument("--backends", help="backends to try", nargs='+', default=['h5'],
+                        choices=utils.preprocess.BACKENDS, type=str)
+    parser.add_argument("--read_threads", help="threads to decompress a Zarr store with",
+                        default=utils.zarr_store.DEFAULT_READ_THREADS, type=int)
+    parser.add_argument("--batch_size", help="events per read, i.e. the training batch", default=1024, type=int)
+    parser.add_argument("--outfile", help="save the report to this CSV file", default='', type=str)
+    args = parser.parse_args()
+
+    h5_files = args.files
+    if args.infile_h5:
+        workdir = args.workdir if args.workdir else os.getcwd()
+        h5_files = []
+        for backend in args.backends:
+            codecs = utils.zarr_store.ZARR_CODECS if backend == 'zarr' else utils.preprocess.COMPRESSION_CODECS
+            for layout in args.layouts:
+                for codec in args.codecs:
+                    if parse_codec(codec)['compression'] not in codecs:
+                        print(f'No {codec} for the {backend} backend, skipping.')
+                        continue
+                    for chunk_events in args.chunk_events:
+                        layout_dir = os.path.join(workdir, f'{backend}_{layout}_{codec}_chunk{chunk_events}')
+                        os.makedirs(layout_dir, exist_ok=True)
+                        utils.preprocess.preprocess_h5_file(args.infile_h5, layout_dir,
+                                                            compression_level=args.compression_level,
+                                                            chunk_events=chunk_events,
+                                                            layout=layout,
+                                                            backend=backend,
+                                                            **parse_codec(codec))
+                        h5_files.append(os.path.join(layout_dir, utils.preprocess.preprocessed_filename(args.infile_h5,
+                                                                                                        backend=backend)))
+
+    rows = []
+    for h5_file in h5_files:
+        print(f'Reading {h5_file}...')
+        with io.open_preprocessed(h5_file) as f:
+            # the XZ view stands in for the cvnmap of the 'views' layout, so read both.
+            keys = utils.preprocess.CVNMAP_VIEW_KEYS if 'cvnmap_xz' in f else ['cvnmap']
+        views = [io.measure_read_throughput(h5_file, key, args.batch_size, args.read_threads) for key in keys]
+        seconds = sum(view['read_seconds'] for view in views)
+        megabytes = sum(view['MB_per_s_uncompressed'] * view['read_seconds'] for view in views)
+        row = views[0]
+        row['read_seconds'] = seconds
+        row['events_per_s'] = row['events'] / max(seconds, 1e-9)
+        row['MB_per_s_uncompressed'] = megabytes / max(seconds, 1e-9)
+        row['layout'] = os.path.basename(os.path.dirname(os.path.abspath(h5_file)))
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    # the figure of merit: read rate for the disk used (per million events).
+    df['GB_per_Mevents'] = df['disk_bytes_per_event'] * 1e6 / 1024 ** 3
+    df['events_per_s_per_GB'] = df['events_per_s'] / df['GB_per_Mevents']
+    df = df.sort_values('events_per_s_per_GB', ascending=False)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(df[['layout', 'backend', 'compression', 'compression_opts', 'shuffle', 'chunks', 'events',
+                  'GB_per_Mevents', 'events_per_s', 'MB_per_s_uncompressed', 'events_per_s_per_GB']].to_string(index=False))
+
+    if args.outfile:
+        df.to_csv(args.outfile, index=False)
+        print('Saved report to: ', args.outfile)
@@ -0,0 +1,43 @@
+# python script to shuffle the events of the preprocessed h5 files of one or more dirs -- e.g. the Nonswap AND
+# the Fluxswap files, for a 'Combined' sample -- into shards of the same number of events, plus a global index
+# (shard_index.h5, the same as repack_h5_shards.py).
+# The shuffle is out of core (bucket, then shuffle each bucket), so the memory used is ~one shard, not the sample.
+# The training can then read the shards in order, at full disk bandwidth, and still see well-mixed batches of both fluxes.
+
+# The shuffle is deterministic: the same --seed and input files give the same shards.
+# NOTE: the (temporary) buckets need about the disk space of the sample, in --outdir.
+# NOTE: name the --outdir with 'Combined' (e.g. .../FD-Nominal-FHC-Combined/), the training reads the flux from it.
+
+# To run this script:
+#   $ python shuffle_h5_shards.py --input_dirs <Nonswap_preprocessed_dir> <Fluxswap_preprocessed_dir> \
+#         --outdir <FD-Nominal-FHC-Combined_dir> --shard_events 65536 --seed 1
+
+import argparse
+import os
+import time
+
+import utils.iomanager as io
+import utils.preprocess
+import utils.shards
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dirs", help="dir(s) of preprocessed h5 files", nargs='+', type=str, required=True)
+    parser.add_argument("--outdir", help="directory to save the shards and the index", type=str, required=True)
+    parser.add_argument("--shard_events", help="events per shard", default=utils.shards.DEFAULT_SHARD_EVENTS, type=int)
+    parser.add_argument("--seed", help="seed of the shuffle", default=1, type=int)
+    parser.add_argument("--block_size", help="events read at a time (sets the peak memory of the bucketing)",
+                        default=utils.preprocess.DEFAULT_BLOCK_SIZE, type=int)
+    args = parser.parse_args()
+
+    # sorted, so the shuffle is reproducible.
+    in_files = io.list_preprocessed_files(args.input_dirs)
+    print(f'Found {len(in_files)} preprocessed h5 files in {len(args.input_dirs)} dir(s).')
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+        print('created dir: {}'.format(args.outdir))
+
+    start = time.time()
+    utils.shards.shuffle_shards(in_files, args.outdir, args.shard_events, args.seed, args.block_size)
+    print(f'Shuffled in {(time.time() - start) / 60:.2f} minutes.')
+    io.print_memory_usage()
@@ -0,0 +1,29 @@
+# python script to make the train/val/test split of a sample ONCE, and save it as event ids (an h5 sidecar file).
+# The training then takes the split with --split_file, and draws the batches of each set by index,
+# instead of copying the maps into the train, val and test arrays (twice, with train_test_split()).
+# The split is deterministic: the same seed and sample give the same split, for every training.
+
+# Only the metadata of the sample is read (the number of events of each file).
+
+# To run this script:
+#   $ python create_split_file.py --data_path <preprocessed_dir> --outfile <split.h5> [--seed 101] [--test_size 0.25] [--val_size 0.1]
+
+import argparse
+
+import utils.splits
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", help="dir of the preprocessed h5 files (or their .npy export)", type=str, required=True)
+    parser.add_argument("--outfile", help="the split h5 file to save", type=str, required=True)
+    parser.add_argument("--seed", help="seed of the split", default=101, type=int)
+    parser.add_argument("--test_size", help="fraction of the events in the test set", default=0.25, type=float)
+    parser.add_argument("--val_size", help="fraction of the (non-test) events in the validation set", default=0.1, type=float)
+    args = parser.parse_args()
+
+    n_events = utils.splits.count_sample_events(args.data_path)
+    print(f'{n_events} events in {args.data_path}')
+    split = utils.splits.create_split(n_events, args.test_size, args.val_size, args.seed)
+    for key in utils.splits.SPLIT_KEYS:
+        print(f'{key}: {len(split[key])} events')
+    utils.splits.save_split(args.outfile, split, args.data_path, args.test_size, args.val_size, args.seed)
@@ -20,13 +20,25 @@ import utils.iomanager as io
 import utils.model
 import utils.plot
 import utils.data_processing as dp
+import utils.pixel_stats
+import utils.splits
 ########### begin main script ###########
 
 # collect the arguments for this macro. the horn and swap options are required.
 parser = argparse.ArgumentParser()
 parser.add_argument("--data_train_path", help="path to train data", type=str, required=True)
 parser.add_argument("--epochs", help="number of epochs", default=20, type=int)
+parser.add_argument("--split_file", help="train/val/test split saved with create_split_file.py (default: split in memory)",
+                    default='', type=str)
+parser.add_argument("--stats_file", help="pixel stats of the training set of --split_file (merge_pixel_stats.py --split_file) "
+                                         "to normalise from, instead of fitting a MinMaxScaler",
+                    default='', type=str)
+parser.add_argument("--n_events", help="train on only the events of the first N global event ids of the sample, "
+                                        "those inside the cvnmap (0: all of them). N need not be a multiple of the events per file.",
+                    default=0, type=int)
 args = parser.parse_args()
+if args.stats_file and not args.split_file:
+    parser.error('The pixel stats must be of the training set only, use them with the --split_file they were made from.')
 
 # want the final dir, and extract its strings.
 train_path = args.data_train_path
@@ -35,109 +47,64 @@ det, horn, flux = io.IOManager.get_det_horn_and_flux_from_string(train_path_dir)
 
 print('WARNING: You are doing testing, be sure you have the correct path to train data! ')
 print('data_train_path: ', train_path)
-datasets, total_events, total_files = io.load_data(train_path, False)
+# only read the events inside the cvnmap, if the files were preprocessed with '--containment mask'.
+# only the hyperslabs of the first --n_events events are read, the later files are skipped.
+# each key is read straight into one array of all the files: the files may hold different numbers of events.
+datasets, total_events, total_files = io.load_data(train_path, False, contained_only=True, contiguous=True,
+                                                   events=slice(0, args.n_events) if args.n_events else None)
 
-# convert the lists to numpy arrays
 print('========================================')
-print('Converting lists to numpy arrays...')
-datasets = {key: np.array(datasets[key]) for key in datasets}
-
-# trust that they are all numpy.arrays AND have the right shape
+# Files preprocessed with '--layout views' are already (N, 100, 80) for each view.
+cvnmap_views = {key: datasets.pop(key) for key in ['cvnmap_xz', 'cvnmap_yz'] if key in datasets}
+# the global id of each event, to find its train/val/test set.
+event_ids = datasets.pop('event_id')
 for key in datasets:
-    print(key)
-    dp.Debug(datasets[key]).printout_type()
-
-print('========================================')
-print('Addressing the bug in the h5 files. Converting firstcellx, firstcelly, firstplane to int type...')
-datasets['firstcellx'] = dp.DataCleaning(datasets['firstcellx'], 'x').remove_unsigned_ints()
-datasets['firstcelly'] = dp.DataCleaning(datasets['firstcelly'], 'y').remove_unsigned_ints()
-datasets['firstplane'] = dp.DataCleaning(datasets['firstplane'], 'z').remove_unsigned_ints()
-# Let's now check to make sure we don't have any gigantic numbers, from unsigned int's.
-# we already know this is the common number we see if wew do this wrong...so check against it.
-file_idx = 0
-for i in [datasets['firstcellx'], datasets['firstcelly']]:
-    event = 0
-    if i[file_idx][event] > 4294967200:  # this a large number, just below the max value of an unsigned int, which should trigger
-        print('i: ', i)
-    event += 1
+    print(key, datasets[key].shape, datasets[key].dtype)
 
 print('========================================')
-print('Converting the vertex coordinates into pixelmap coordinates for the network...')
-# Create the vertex info in pixel map coordinates:
-# convert the vertex location (detector coordinates) to pixel map coordinates
-vtx_x_pixelmap = dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
-vtx_y_pixelmap = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
-vtx_z_pixelmap = dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
-print('Done converting.')
+if 'vtx_x_pixelmap' in datasets:
+    # preprocessed with --bake_labels: the first hits are already signed, and the labels are in pixel map coordinates.
+    print('The pixel map labels are in the preprocessed files. Skipping the cleaning and conversion...')
+    vtx_x_pixelmap = datasets['vtx_x_pixelmap']
+    vtx_y_pixelmap = datasets['vtx_y_pixelmap']
+    vtx_z_pixelmap = datasets['vtx_z_pixelmap']
+else:
+    # the unsigned first hits of the Prod5.1 trimmed files, read back as the signed values they were written from.
+    print('Converting firstcellx, firstcelly, firstplane to signed ints...')
+    datasets['firstcellx'] = dp.remove_unsigned_ints_array(datasets['firstcellx'])
+    datasets['firstcelly'] = dp.remove_unsigned_ints_array(datasets['firstcelly'])
+    datasets['firstplane'] = dp.remove_unsigned_ints_array(datasets['firstplane'])
+
+    print('========================================')
+    print('Converting the vertex coordinates into pixelmap coordinates for the network...')
+    # Create the vertex info in pixel map coordinates:
+    # convert the vertex location (detector coordinates) to pixel map coordinates
+    vtx_x_pixelmap = dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
+    vtx_y_pixelmap = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
+    vtx_z_pixelmap = dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
+    print('Done converting.')
 
 print('========================================')
 # Print out useful info about the shapes of the arrays
-print('========================================')
 print('Useful info about the shapes of the arrays:')
 print('-------------------')
-print('Format of the arrays: (file_idx, event_idx, pixel_idx)......')
+print('Format of the arrays: (event_idx, pixel_idx)......')
 print('the pixel_idx is for cvnmaps only')
 print('-------------------')
-# we set file_idx manually
-print('cvnmap.shape: ', datasets['cvnmap'].shape)
+if cvnmap_views:
+    print('cvnmap views were split at preprocess time, skipping the reshape.....')
+    cvnmap_xz = cvnmap_views['cvnmap_xz']
+    cvnmap_yz = cvnmap_views['cvnmap_yz']
+else:
+    print('cvnmap.shape: ', datasets['cvnmap'].shape)
+    # reshape the pixels into 2 (100,80) views: XZ and YZ.
+    print('reshape the pixels into 2 (100,80) views: XZ and YZ.....')
+    cvnmap_xz, cvnmap_yz = dp.split_cvnmap_views(datasets['cvnmap'])
+print('cvnmap_xz.shape: ', cvnmap_xz.shape)
 print('vtx_x.shape: ', datasets['vtx.x'].shape)
 print('vtx_x_pixelmap.shape: ', vtx_x_pixelmap.shape)
-print('firstcellx.shape: ', datasets['firstcellx'].shape)
-print('-------------------')
-
-# this array should be something like: (2, 10000, 16000)
-cvnmap = datasets['cvnmap']
-print('-------------------')
-print('to access FILE, index in array is: (cvnmap.shape[0]) = ', cvnmap.shape[0], 'files.')  # first dimension is the file
-print('to access EVENT, index in array is: (cvnmap.shape[1]) = ', cvnmap.shape[1], 'events')  # second dimension is the events
-print('to access PIXELS, index in array is: (cvnmap.shape[2]) = ', cvnmap.shape[2], 'pixels')  # third dimension is the pixelmap
 print('-------------------')
 
-print('========================================')
-# reshape the pixels into 2 (100,80) views: XZ and YZ.
-print('reshape the pixels into 2 (100,80) views: XZ and YZ.....')
-
-
-cvnmap_xz = []
-cvnmap_yz = []
-total_event_counter = 0
-file_counter = 0
-
-train_files = int(cvnmap.shape[0])
-
-for file_counter, h5_filename in enumerate(range(train_files)):
-    print(f"Processing train cvnmap file {file_counter + 1} of {train_files}")
-
-    print(f"Reshaping all {cvnmap.shape[1]} events into correct pixel map size (100, 80)")
-    for event in range(cvnmap.shape[1]):
-        reshaped_maps = cvnmap[file_counter][event].reshape(2, 100, 80)
-        cvnmap_xz.append(reshaped_maps[0])
-        cvnmap_yz.append(reshaped_maps[1])
-
-        total_event_counter += 1
-
-    # might work for the (4,) index
-    # reshaped_maps = cvnmap[file_counter].reshape(-1, 2, 100, 80)  # Reshape all events at once
-    # Split into XZ and YZ views
-    # cvnmap_xz = np.concatenate([cvnmap_xz, reshaped_maps[:, 0]], axis=0)  #add to the end of the array
-    # cvnmap_yz = np.concatenate([cvnmap_yz, reshaped_maps[:, 1]], axis=0)
-cvnmap_xz = np.array(cvnmap_xz)
-cvnmap_yz = np.array(cvnmap_yz)
-
-# Validate results
-assert train_files == (file_counter + 1), f"File count mismatch: {file_counter + 1} files processed."
-assert cvnmap.shape[1] * cvnmap.shape[0] == total_event_counter, f"Event count mismatch: {total_event_counter} != {cvnmap.shape[1] * cvnmap.shape[0]}."
-
-print('========================================')
-# must re-shape the vtx_x_pixelmap array to match the cvnmap_resh_xz array
-# I.e. --> remove the first dimension [0], the file.
-print('Reshape vtx_x_pixelmap, vtx_y_pixelmap, vtx_z_pixelmap to be of just the events...')
-print('Before, vtx_x_pixelmap: ', vtx_x_pixelmap.shape)
-vtx_x_pixelmap = vtx_x_pixelmap.reshape(total_events)
-vtx_y_pixelmap = vtx_y_pixelmap.reshape(total_events)
-vtx_z_pixelmap = vtx_z_pixelmap.reshape(total_events)
-print('After, vtx_x_pixelmap: ', vtx_x_pixelmap.shape)
-
 # combine for Nx3 array: [X, Y, Z]
 vtx_coords = np.stack((vtx_x_pixelmap, vtx_y_pixelmap, vtx_z_pixelmap), axis=-1)
 
@@ -146,6 +113,7 @@ vtx_coords = np.stack((vtx_x_pixelmap, vtx_y_pixelmap, vtx_z_pixelmap), axis=-1)
 # dictionary of {keep; np.array, drop: array}
 keep_drop_evts = dp.DataCleaning.sort_events_with_vtxs_outside_cvnmaps(vtx_coords)
 vtx_coords = vtx_coords[keep_drop_evts['keep']]
+event_ids = event_ids[keep_drop_evts['keep']]
 cvnmap_xz = cvnmap_xz[keep_drop_evts['keep']]
 cvnmap_yz = cvnmap_yz[keep_drop_evts['keep']]
 assert cvnmap_xz.shape[0] == cvnmap_yz.shape[0] == vtx_coords.shape[0]
@@ -160,7 +128,19 @@ cvnmap_yz = cvnmap_yz.astype(np.float16)
 # split the data into training (+ val) and testing sets
 # Creates dictionaries for:
 # Train -- for fit(). Val -- for fit(). Test -- for evaluate()
-data_train, data_val, data_test = utils.model.Config.create_test_train_val_datasets(cvnmap_xz, cvnmap_yz, vtx_coords)
+stats = utils.pixel_stats.PixelStats.load(args.stats_file) if args.stats_file else None
+if args.split_file:
+    # the split was made once, for the whole sample. The sets are small here, so they are copied into dictionaries.
+    split = utils.splits.load_split(args.split_file, train_path)
+    if stats is not None and stats.split_digest != utils.splits.split_digest(split['train']):
+        # e.g. the stats of every event (the merged sidecars), or of another split: the val & test events would leak in.
+        raise ValueError(f'{args.stats_file} is not of the training set of {args.split_file}. '
+                         f'Make it with: merge_pixel_stats.py --split_file {args.split_file}')
+    split_rows = utils.splits.split_rows(split, event_ids)
+    data_train, data_val, data_test = [{'xz': cvnmap_xz[split_rows[key]], 'yz': cvnmap_yz[split_rows[key]], 'vtx': vtx_coords[split_rows[key]]}
+                                       for key in utils.splits.SPLIT_KEYS]
+else:
+    data_train, data_val, data_test = utils.model.Config.create_test_train_val_datasets(cvnmap_xz, cvnmap_yz, vtx_coords)
 
 print('========================================')
 utils.model.Hardware.check_gpu_status()
@@ -181,9 +161,16 @@ utils.model.Config.compile_model(model_regCNN)
 print(model_regCNN.summary())
 
 # normalize w MinMaxScaler -- don't fit() the val,test data.
-data_train, data_val, data_test = utils.model.Config.transform_data(data_train,
-                                                                    data_val,
-                                                                    data_test)
+# or from the precomputed pixel stats of the training set, no fit.
+if stats is not None:
+    _, data_train, data_val, data_test = utils.model.Config.transform_data_with_stats(data_train,
+                                                                                      data_val,
+                                                                                      data_test,
+                                                                                      stats)
+else:
+    _, data_train, data_val, data_test = utils.model.Config.transform_data(data_train,
+                                                                           data_val,
+                                                                           data_test)
 
 dp.print_input_data(data_train, data_test, data_val)
 
@@ -14,67 +14,90 @@ import numpy as np
 import pandas as pd
 
 # ML Vtx utils
+import utils.catalog
 import utils.iomanager as io
 import utils.model
 import utils.plot
 import utils.data_processing as dp
+import utils.pixel_stats
+import utils.preprocess
+import utils.shards
+import utils.splits
 ########### begin main script ###########
 
 # collect the arguments for this macro. the horn and swap options are required.
 parser = argparse.ArgumentParser()
 parser.add_argument("--data_train_path", help="path to train data", type=str, required=True)
 parser.add_argument("--epochs", help="number of epochs", default=20, type=int)
+parser.add_argument("--n_shards", help="train on only this many shards (0 = all), if the train data is repacked into shards",
+                    default=0, type=int)
+parser.add_argument("--split_file", help="train/val/test split saved with create_split_file.py (default: split in memory)",
+                    default='', type=str)
+parser.add_argument("--stats_file", help="pixel stats of the training set of --split_file (merge_pixel_stats.py --split_file) "
+                                         "to normalise the cvnmaps from (default: not normalised)",
+                    default='', type=str)
+parser.add_argument("--resolution", help="train on the views downsampled by this factor (files preprocessed with '--pyramid'), "
+                                         "for quick prototyping. The labels (and predictions) are in the downsampled pixels.",
+                    default=1, choices=[1] + utils.preprocess.PYRAMID_FACTORS, type=int)
 args = parser.parse_args()
+if args.resolution != 1 and args.stats_file:
+    parser.error('The pixel stats are of the full resolution cvnmaps, use them with --resolution 1.')
+if args.stats_file and not args.split_file:
+    parser.error('The pixel stats must be of the training set only, use them with the --split_file they were made from.')
 
 # want the final dir, and extract its strings.
 train_path = args.data_train_path
 train_path_dir = os.path.basename(os.path.normpath(train_path))
-det, horn, flux = io.IOManager.get_det_horn_and_flux_from_string(train_path_dir)
+# from the catalog of the dir, if it has an up to date one (see build_catalog.py), else from its name.
+catalog = io.load_catalog(train_path) if os.path.isdir(train_path) else None
+if catalog is not None and all(catalog[part] for part in ['det', 'horn', 'flux']):
+    det, horn, flux = catalog['det'], catalog['horn'], catalog['flux']
+    print(f"From the catalog: {det} {horn} {flux}, {catalog['events']} events in {len(catalog['files'])} files.")
+    if not args.n_shards and args.resolution == 1:
+        load_bytes = utils.catalog.estimate_load_bytes(catalog, contained_only=True)
+        print(f'Loading them needs ~{sum(load_bytes.values()) / 1024 ** 3:.2f} GB.')
+else:
+    det, horn, flux = io.IOManager.get_det_horn_and_flux_from_string(train_path_dir)
 
 print('WARNING: You are doing full training, be sure you have the correct path to train data! ')
 print('data_train_path: ', train_path)
-datasets, total_events, total_files = io.load_data(train_path, False)
+# only read the events inside the cvnmap, if the files were preprocessed with '--containment mask'.
+train_files = None
+if args.n_shards:
+    train_files = utils.shards.shard_files(train_path, args.n_shards)
+    print(f'Training on {len(train_files)} shards: {train_files}')
+# each key is read straight into one array of all the files, so the peak memory is ~the size of the data.
+datasets, total_events, total_files = io.load_data(train_path, False, contained_only=True, files=train_files,
+                                                   resolution=args.resolution, contiguous=True)
 
 print('========================================')
-# Convert all lists in datasets to NumPy arrays with dtype=object (while keeping the arrays within from each file arrays)
-datasets = {key: np.array(value, dtype=object) for key, value in datasets.items()}
-print('to access FILE, index in array is: (cvnmap.shape[0] = ', datasets['cvnmap'].shape[0], 'files.)')  # first dimension is the file
-
-# trust that they are all numpy.arrays AND have the right shape
+# Files preprocessed with '--layout views' are already (N, 100, 80) for each view.
+cvnmap_views = {key: datasets.pop(key) for key in ['cvnmap_xz', 'cvnmap_yz'] if key in datasets}
+# the global id of each event, to find its train/val/test set.
+event_ids = datasets.pop('event_id')
 for key in datasets:
-    print(key)
-    dp.Debug(datasets[key]).printout_type()
-
-print('========================================')
-datasets['firstcellx'] = dp.DataCleaning(datasets['firstcellx'], 'x').remove_unsigned_ints()
-datasets['firstcelly'] = dp.DataCleaning(datasets['firstcelly'], 'y').remove_unsigned_ints()
-datasets['firstplane'] = dp.DataCleaning(datasets['firstplane'], 'z').remove_unsigned_ints()
-# Let's now check to make sure we don't have any gigantic numbers, from unsigned int's.
-# we already know this is the common number we see if wew do this wrong...so check against it.
-file_idx = 0
-for i in [datasets['firstcellx'], datasets['firstcelly']]:
-    event = 0
-    if i[file_idx][event] > 4294967200:  # this a large number, just below the max value of an unsigned int, which should trigger
-        print('i: ', i)
-    event += 1
+    print(key, datasets[key].shape, datasets[key].dtype)
 
 print('========================================')
-print('Converting the vertex coordinates into pixelmap coordinates for the network...')
-datasets['firstcellx'] = dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
-datasets['firstcelly'] = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
-datasets['firstplane'] = dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
-# operate in place, and change key name to 'vtx_i_pixelmap'
-datasets['vtx_x_pixelmap'] = datasets.pop('firstcellx')
-datasets['vtx_y_pixelmap'] = datasets.pop('firstcelly')
-datasets['vtx_z_pixelmap'] = datasets.pop('firstplane')
-
-# concatenate/flatten each vertex array
-print("Reshape datasets['vtx_x_pixelmap'], datasets['vtx_y_pixelmap'], datasets['vtx_z_pixelmap'] to be of just the events...")
-print("Before, datasets['vtx_x_pixelmap']: ", datasets['vtx_x_pixelmap'].shape)
-datasets['vtx_x_pixelmap'] = np.concatenate(datasets['vtx_x_pixelmap'], axis=0)
-datasets['vtx_y_pixelmap'] = np.concatenate(datasets['vtx_y_pixelmap'], axis=0)
-datasets['vtx_z_pixelmap'] = np.concatenate(datasets['vtx_z_pixelmap'], axis=0)
-print("After, datasets['vtx_x_pixelmap']: ", datasets['vtx_x_pixelmap'].shape)
+if 'vtx_x_pixelmap' in datasets:
+    # preprocessed with --bake_labels: the first hits are already signed, and the labels are in pixel map coordinates.
+    print('The pixel map labels are in the preprocessed files. Skipping the cleaning and conversion...')
+else:
+    # the unsigned first hits of the Prod5.1 trimmed files, read back as the signed values they were written from.
+    print('Converting firstcellx, firstcelly, firstplane to signed ints...')
+    datasets['firstcellx'] = dp.remove_unsigned_ints_array(datasets['firstcellx'])
+    datasets['firstcelly'] = dp.remove_unsigned_ints_array(datasets['firstcelly'])
+    datasets['firstplane'] = dp.remove_unsigned_ints_array(datasets['firstplane'])
+
+    print('========================================')
+    print('Converting the vertex coordinates into pixelmap coordinates for the network...')
+    datasets['firstcellx'] = dp.ConvertFarDetCoords(det, 'x').convert_fd_vtx_to_pixelmap(datasets['vtx.x'], datasets['firstcellx'])
+    datasets['firstcelly'] = dp.ConvertFarDetCoords(det, 'y').convert_fd_vtx_to_pixelmap(datasets['vtx.y'], datasets['firstcelly'])
+    datasets['firstplane'] = dp.ConvertFarDetCoords(det, 'z').convert_fd_vtx_to_pixelmap(datasets['vtx.z'], datasets['firstplane'])
+    # operate in place, and change key name to 'vtx_i_pixelmap'
+    datasets['vtx_x_pixelmap'] = datasets.pop('firstcellx')
+    datasets['vtx_y_pixelmap'] = datasets.pop('firstcelly')
+    datasets['vtx_z_pixelmap'] = datasets.pop('firstplane')
 
 # combine for Nx3 array: [X, Y, Z]
 vtx_coords = np.stack((datasets['vtx_x_pixelmap'], datasets['vtx_y_pixelmap'], datasets['vtx_z_pixelmap']), axis=-1)
@@ -82,41 +105,60 @@ print('Done converting.')
 
 
 print('========================================')
-print('Remove the file index, and reshape the pixels into 2 (100,80) views: XZ and YZ.....')
-# this array should be something like: [fileIdx](events_in_file, 16000)
-# reshape the pixels into 2 (100,80) views: XZ and YZ.
-# NOTE: this works regardless how many events are in each file...
-datasets['cvnmap'] = np.concatenate([entry.reshape(-1, 16000) for entry in datasets['cvnmap']], axis=0)  # remove the file index (8,)
-datasets['cvnmap'] = datasets['cvnmap'].reshape(total_events, 100, 80, 2)  # divide into the pixels into the map
-datasets['cvnmap'] = datasets['cvnmap'].reshape(datasets['cvnmap'].shape[0], datasets['cvnmap'].shape[1], datasets['cvnmap'].shape[2], datasets['cvnmap'].shape[3], 1) # add the color channel
-datasets['cvnmap'] = datasets['cvnmap'].astype(np.float16)
-# these are views (without copies) to save memory
-cvnmap_xz = datasets['cvnmap'][:, :, :, 0].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the XZ view and reshape
-cvnmap_yz = datasets['cvnmap'][:, :, :, 1].reshape(datasets['cvnmap'].shape[0], 100, 80, 1)  # Extract the YZ view and reshape
-
-print(datasets['cvnmap'].shape)
-print('XZ: ', cvnmap_xz.shape)
-print('YZ: ', cvnmap_yz.shape)
+if cvnmap_views:
+    # preprocessed with '--layout views': only add the color channel (a view, no copy).
+    print('Using the XZ and YZ views from the preprocessed files.....')
+    cvnmap_xz = cvnmap_views['cvnmap_xz'][..., np.newaxis]
+    cvnmap_yz = cvnmap_views['cvnmap_yz'][..., np.newaxis]
+    print('XZ: ', cvnmap_xz.shape)
+    print('YZ: ', cvnmap_yz.shape)
+else:
+    print('Reshape the pixels into 2 (100,80) views: XZ and YZ.....')
+    # these are views (without copies) of the (N, 16000) uint8 cvnmaps, to save memory
+    cvnmap_xz, cvnmap_yz = dp.split_cvnmap_views(datasets['cvnmap'])
+    cvnmap_xz = cvnmap_xz[..., np.newaxis]  # add the color channel
+    cvnmap_yz = cvnmap_yz[..., np.newaxis]
+
+    print(datasets['cvnmap'].shape)
+    print('XZ: ', cvnmap_xz.shape)
+    print('YZ: ', cvnmap_yz.shape)
 print('========================================')
 
 # Drop the events that are outside the cvnmap!
 # Apply to both features & labels.
 # dictionary of {keep; np.array, drop: array}
-keep_drop_evts = dp.DataCleaning.sort_events_with_vtxs_outside_cvnmaps(vtx_coords)
-vtx_coords = vtx_coords[keep_drop_evts['keep']]
-cvnmap_xz = cvnmap_xz[keep_drop_evts['keep']]
-cvnmap_yz = cvnmap_yz[keep_drop_evts['keep']]
+keep_drop_evts = dp.DataCleaning.sort_events_with_vtxs_outside_cvnmaps(vtx_coords * args.resolution)
+if len(keep_drop_evts['drop']) > 0:  # don't copy the maps if nothing is dropped (e.g. '--containment' when preprocessing)
+    vtx_coords = vtx_coords[keep_drop_evts['keep']]
+    event_ids = event_ids[keep_drop_evts['keep']]
+    cvnmap_xz = cvnmap_xz[keep_drop_evts['keep']]
+    cvnmap_yz = cvnmap_yz[keep_drop_evts['keep']]
 assert cvnmap_xz.shape[0] == cvnmap_yz.shape[0] == vtx_coords.shape[0]
 
-cvnmap_xz = cvnmap_xz.astype(np.uint8)
-cvnmap_yz = cvnmap_yz.astype(np.uint8)
+# no copy if they are already uint8 (i.e. '--layout views')
+cvnmap_xz = cvnmap_xz.astype(np.uint8, copy=False)
+cvnmap_yz = cvnmap_yz.astype(np.uint8, copy=False)
 vtx_coords = vtx_coords.astype(np.float16)
 
 
 # #### Prepare the Training & Test Sets
 # XZ view and YZ view. Train on both views; predict all 3 coordinates.
 # Train -- for fit(). Val -- for fit(). Test -- for evaluate()
-data_train, data_val, data_test = utils.model.Config.create_test_train_val_datasets(cvnmap_xz, cvnmap_yz, vtx_coords)
+stats = utils.pixel_stats.PixelStats.load(args.stats_file) if args.stats_file else None
+if args.split_file:
+    # the split was made once, for the whole sample. Only the row indices of each set, the maps are not copied.
+    split = utils.splits.load_split(args.split_file, train_path)
+    if stats is not None and stats.split_digest != utils.splits.split_digest(split['train']):
+        # e.g. the stats of every event (the merged sidecars), or of another split: the val & test events would leak in.
+        raise ValueError(f'{args.stats_file} is not of the training set of {args.split_file}. '
+                         f'Make it with: merge_pixel_stats.py --split_file {args.split_file}')
+    split_rows = utils.splits.split_rows(split, event_ids)
+    data_train, data_val, data_test = utils.model.Config.create_test_train_val_sequences(cvnmap_xz, cvnmap_yz, vtx_coords,
+                                                                                         split_rows, batch_size=128,
+                                                                                         stats=stats)
+    print('events in train, val, test: ', [len(split_rows[key]) for key in utils.splits.SPLIT_KEYS])
+else:
+    data_train, data_val, data_test = utils.model.Config.create_test_train_val_datasets(cvnmap_xz, cvnmap_yz, vtx_coords)
 
 
 print('========================================')
@@ -127,17 +169,20 @@ print('========================================')
 
 print('using XZ and YZ views to learn `x`, `y`, and `z` coordinates......')
 # define separate models for each view
-model_xz = utils.model.Config.create_conv2d_branch_model_single_view()
-model_yz = utils.model.Config.create_conv2d_branch_model_single_view()
+# (100, 80, 1), or smaller if downsampled.
+input_shape = cvnmap_xz.shape[1:]
+model_xz = utils.model.Config.create_conv2d_branch_model_single_view(input_shape)
+model_yz = utils.model.Config.create_conv2d_branch_model_single_view(input_shape)
 
 # create final model, join the XZ and YZ, add dense layers, and condense to 3.
-model_regCNN = utils.model.Config.assemble_model_output(model_xz, model_yz)
+model_regCNN = utils.model.Config.assemble_model_output(model_xz, model_yz, input_shape)
 
 utils.model.Config.compile_model(model_regCNN)
 print(model_regCNN.summary())
 
 
-dp.print_input_data(data_train, data_test, data_val)
+if not args.split_file:
+    dp.print_input_data(data_train, data_test, data_val)
 
 # fit() the model.
 history = utils.model.train_model(model_regCNN,
@@ -151,6 +196,8 @@ metrics = pd.DataFrame(history.history)
 
 # the default output name
 output_name = f'{args.epochs}epochs_{det}_{horn}_{flux}_{date.today()}_XYZ'
+if args.resolution != 1:
+    output_name += f'_{args.resolution}x'
 
 # save the model
 save_model_dir = f'/home/{io.USER}/output/trained-models/'
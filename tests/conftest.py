@@ -0,0 +1,49 @@
+# conftest.py
+# Fixtures of the tests: a synthetic trimmed sample (see synthetic.py), written once,
+# and its preprocessed versions, each preprocessed once per set of options.
+
+import os
+
+import pytest
+
+# iomanager reads $USER (for the output paths) when imported.
+os.environ.setdefault('USER', 'pytest')
+
+import synthetic  # noqa: E402
+import utils.preprocess  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def trimmed_paths(tmp_path_factory):
+    """
+    :return: sorted list of full paths to the trimmed files of the synthetic sample
+    """
+    return synthetic.write_trimmed_sample(str(tmp_path_factory.mktemp('trimmed') / synthetic.SAMPLE_NAME))
+
+
+@pytest.fixture(scope='session')
+def trimmed_sample(trimmed_paths):
+    """
+    :return: dict of {key: np.array} of every event of the trimmed files (see synthetic.read_trimmed_sample())
+    """
+    return synthetic.read_trimmed_sample(trimmed_paths)
+
+
+@pytest.fixture(scope='session')
+def preprocessed(trimmed_paths, tmp_path_factory):
+    """
+    :return: function of the preprocess_h5_file() options, returning the directory of the sample preprocessed with them
+    """
+    out_dirs = {}
+
+    def preprocess(**options):
+        name = '_'.join(f'{key}-{value}' for key, value in sorted(options.items())) or 'default'
+        name = ''.join(c for c in name if c.isalnum() or c in '-_')
+        if name not in out_dirs:
+            out_dir = str(tmp_path_factory.mktemp(name) / synthetic.SAMPLE_NAME)
+            os.makedirs(out_dir)
+            for path in trimmed_paths:
+                utils.preprocess.preprocess_h5_file(path, out_dir, block_size=32, **options)
+            out_dirs[name] = out_dir
+        return out_dirs[name]
+    return preprocess
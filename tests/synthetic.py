@@ -0,0 +1,113 @@
+# synthetic.py
+# Small synthetic Prod5.1-like trimmed h5 files for the tests: the training Vars, the metadata Vars,
+# and ~10% of the events with the vertex outside the cvnmap. The first hits are stored unsigned, as in the trimmed files.
+
+import os
+
+import h5py
+import numpy as np
+
+import utils.data_processing as dp
+
+SAMPLE_NAME = 'FD-Nominal-FHC-Nonswap'
+EVENTS_PER_FILE = [120, 75, 90]
+
+
+def trimmed_filename(file_number) -> str:
+    """
+    :param file_number: int
+    :return: name of the trimmed h5 file, as the Prod5.1 ones
+    """
+    return f'trimmed_h5_R20-11-25-prod5.1reco.j_{SAMPLE_NAME}_{file_number}_of_28.h5'
+
+
+def write_trimmed_file(path, n_events, seed=0) -> None:
+    """
+    :param path: full path to the trimmed h5 file to write
+    :param n_events: int, events in the file
+    :param seed: int, seed of the contents
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    vtx_x = rng.uniform(-700, 700, n_events).astype(np.float32)
+    vtx_y = rng.uniform(-700, 700, n_events).astype(np.float32)
+    vtx_z = rng.uniform(0, 5900, n_events).astype(np.float32)
+    # the vertex is a few cells (planes) from the first hit, sometimes outside the 80x100 cvnmap.
+    firstcellx = (np.floor(vtx_x / 3.97 + 192) - rng.integers(-2, 82, n_events)).astype(np.int64)
+    firstcelly = (np.floor(vtx_y / 3.97 + 191) - rng.integers(-2, 82, n_events)).astype(np.int64)
+    firstplane = (np.floor(vtx_z / 6.664) - rng.integers(-2, 102, n_events)).astype(np.int64)
+    # a few negative first hits, which the trimmed files store as huge unsigned ints.
+    firstcellx[:3] = -3
+    firstcelly[:2] = -1
+    cvnmap = np.zeros((n_events, 16000), dtype=np.uint8)
+    for event in range(n_events):
+        pixels = rng.choice(16000, rng.integers(0, 400), replace=False)
+        cvnmap[event, pixels] = rng.integers(1, 256, len(pixels))
+    # and an event without any hit pixel.
+    cvnmap[n_events // 2] = 0
+    with h5py.File(path, 'w') as f:
+        f['vtx.x'] = vtx_x
+        f['vtx.y'] = vtx_y
+        f['vtx.z'] = vtx_z
+        f['firstcellx'] = firstcellx.astype(np.uint32)
+        f['firstcelly'] = firstcelly.astype(np.uint32)
+        f['firstplane'] = firstplane.astype(np.uint32)
+        f.create_dataset('cvnmap', data=cvnmap, compression='gzip', chunks=(1, 16000))
+        f['E'] = rng.uniform(0, 10, n_events).astype(np.float32)
+        f['pdg'] = rng.choice([12, 14, -12, -14], n_events).astype(np.int32)
+        f['mode'] = rng.integers(0, 4, n_events).astype(np.int32)
+        f['iscc'] = rng.integers(0, 2, n_events).astype(np.int32)
+        f['interaction'] = rng.integers(0, 10, n_events).astype(np.int32)
+        f['ncid'] = rng.integers(0, 2, n_events).astype(np.int32)
+        f['finalstate'] = rng.integers(0, 5, n_events).astype(np.int32)
+        for key in ['p.px', 'p.py', 'p.pz', 'vtxEA.x', 'vtxEA.y', 'vtxEA.z']:
+            f[key] = rng.normal(size=n_events).astype(np.float32)
+    return None
+
+
+def write_trimmed_sample(sample_dir) -> list:
+    """
+    :param sample_dir: directory to write the trimmed files of a sample into
+    :return: sorted list of full paths to the trimmed files
+    """
+    os.makedirs(sample_dir, exist_ok=True)
+    paths = []
+    for file_number, n_events in enumerate(EVENTS_PER_FILE):
+        paths.append(os.path.join(sample_dir, trimmed_filename(file_number)))
+        write_trimmed_file(paths[-1], n_events, seed=file_number)
+    return paths
+
+
+def read_trimmed_sample(paths) -> dict:
+    """
+    The truth to compare every loader against: the training Vars of the trimmed files, read directly and concatenated,
+    with the XZ & YZ views, the signed first hits, the pixel map labels, the containment of each event, and its global event id.
+    :param paths: sorted list of full paths to the trimmed files
+    :return: dict of {key: np.array} of every event of the sample
+    """
+    columns = {}
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            for key in ['vtx.x', 'vtx.y', 'vtx.z', 'firstcellx', 'firstcelly', 'firstplane', 'cvnmap', 'mode', 'pdg', 'iscc']:
+                columns.setdefault(key, []).append(f[key][:])
+    sample = {key: np.concatenate(value) for key, value in columns.items()}
+    sample['event_id'] = np.arange(len(sample['cvnmap']))
+    # the pixels of a cvnmap are (100, 80, 2), the last index is the view.
+    sample['cvnmap_xz'] = sample['cvnmap'].reshape(-1, 100, 80, 2)[..., 0]
+    sample['cvnmap_yz'] = sample['cvnmap'].reshape(-1, 100, 80, 2)[..., 1]
+    labels = []
+    for coordinate, first_hit_key in zip('xyz', ['firstcellx', 'firstcelly', 'firstplane']):
+        sample[f'signed_{first_hit_key}'] = dp.remove_unsigned_ints_array(sample[first_hit_key], 'int64')
+        labels.append(dp.ConvertFarDetCoords('fd', coordinate).convert_fd_vtx_to_pixelmap(sample[f'vtx.{coordinate}'],
+                                                                                          sample[f'signed_{first_hit_key}']))
+    sample['vtx'] = np.stack(labels, axis=-1)
+    sample['contained'] = dp.contained_in_cvnmap(sample['vtx'])
+    return sample
+
+
+def concatenated(datasets) -> dict:
+    """
+    :param datasets: dict of {key: list of np.array, one per file}, as from iomanager.load_data() (the baseline path)
+    :return: dict of {key: np.array of all the files}
+    """
+    return {key: np.concatenate(value) for key, value in datasets.items()}
@@ -0,0 +1,115 @@
+# test_iomanager.py
+# Every loader reads the same events, whatever the layout (flat, views, sparse) or the backend (h5, Zarr) of the files.
+
+import numpy as np
+import pytest
+
+import synthetic
+import utils.iomanager as io
+
+# the options of each layout & backend, all with the 'contained' mask.
+LAYOUTS = {'flat': {},
+           'views': {'layout': 'views'},
+           'sparse': {'layout': 'sparse'},
+           'zarr': {'backend': 'zarr'},
+           'zarr_sparse': {'backend': 'zarr', 'layout': 'sparse'}}
+
+
+@pytest.fixture(params=list(LAYOUTS))
+def sample_path(request, preprocessed):
+    """
+    :return: directory of the synthetic sample, preprocessed with the options of each of LAYOUTS
+    """
+    return preprocessed(containment='mask', **LAYOUTS[request.param])
+
+
+def test_vertex_dataset_reads_any_rows(sample_path, trimmed_sample):
+    n_events = len(trimmed_sample['event_id'])
+    # any order, with repeats, across the ends of the files.
+    rows = np.random.default_rng(0).integers(0, n_events, 60)
+    with io.VertexDataset(sample_path) as ds:
+        assert len(ds) == n_events
+        for key in ['cvnmap_xz', 'cvnmap_yz', 'vtx.y', 'firstplane', 'event_id']:
+            np.testing.assert_array_equal(ds[key][rows], trimmed_sample[key][rows])
+        if 'cvnmap' in ds:
+            np.testing.assert_array_equal(ds['cvnmap'][rows], trimmed_sample['cvnmap'][rows])
+        np.testing.assert_array_equal(ds['vtx.x'][trimmed_sample['contained']], trimmed_sample['vtx.x'][trimmed_sample['contained']])
+        np.testing.assert_array_equal(ds['cvnmap_xz'][-1], trimmed_sample['cvnmap_xz'][-1])
+        np.testing.assert_array_equal(np.asarray(ds['vtx.z']), trimmed_sample['vtx.z'])
+
+    contained = np.flatnonzero(trimmed_sample['contained'])
+    rows = np.random.default_rng(1).permutation(len(contained))[:40]
+    with io.VertexDataset(sample_path, contained_only=True) as ds:
+        assert len(ds) == len(contained)
+        np.testing.assert_array_equal(ds['event_id'][rows], contained[rows])
+        np.testing.assert_array_equal(ds['cvnmap_yz'][rows], trimmed_sample['cvnmap_yz'][contained[rows]])
+
+
+@pytest.mark.parametrize('contained_only', [False, True])
+def test_contiguous_load_is_the_baseline_load(sample_path, trimmed_sample, contained_only):
+    baseline, total_events, total_files = io.load_data(sample_path, contained_only=contained_only)
+    datasets, contiguous_events, contiguous_files = io.load_data(sample_path, contained_only=contained_only, contiguous=True)
+    assert (contiguous_events, contiguous_files) == (total_events, total_files)
+    assert sorted(datasets) == sorted(baseline)
+    for key, data in datasets.items():
+        assert isinstance(data, np.ndarray) and data.flags.c_contiguous
+        np.testing.assert_array_equal(data, np.concatenate(baseline[key]))
+    event_ids = np.flatnonzero(trimmed_sample['contained']) if contained_only else trimmed_sample['event_id']
+    np.testing.assert_array_equal(datasets['event_id'], event_ids)
+    np.testing.assert_array_equal(datasets['vtx.x'], trimmed_sample['vtx.x'][event_ids])
+
+
+@pytest.mark.parametrize('contiguous', [False, True])
+def test_keys_and_events_select_the_columns_and_events(sample_path, trimmed_sample, contiguous):
+    n_events = len(trimmed_sample['event_id'])
+    # the cvnmap of the layout (the flat cvnmap or the views), and the scalars, of the events asked for only.
+    keys = ['vtx.x', 'firstcellx', 'cvnmap', 'cvnmap_xz']
+    event_ids = np.random.default_rng(2).choice(n_events, 50, replace=False)
+    mask = np.zeros(n_events, dtype=bool)
+    mask[event_ids] = True
+    for events in [event_ids, np.concatenate((event_ids, event_ids[:5])), mask, slice(100, 130)]:
+        datasets, total_events, _ = io.load_data(sample_path, contiguous=contiguous, keys=keys, events=events)
+        if not contiguous:
+            datasets = synthetic.concatenated(datasets)
+        # in order of their event id, once each.
+        selected = np.arange(n_events)[events] if isinstance(events, slice) else np.sort(event_ids)
+        assert total_events == len(selected)
+        assert set(datasets) in [{'vtx.x', 'firstcellx', 'cvnmap', 'event_id'}, {'vtx.x', 'firstcellx', 'cvnmap_xz', 'event_id'}]
+        for key, data in datasets.items():
+            np.testing.assert_array_equal(data, trimmed_sample[key][selected])
+
+
+def test_events_with_contained_only_are_those_inside_the_cvnmap(sample_path, trimmed_sample):
+    n_events = len(trimmed_sample['event_id'])
+    event_ids = np.random.default_rng(2).choice(n_events, 50, replace=False)
+    datasets = io.load_data(sample_path, contained_only=True, contiguous=True, keys=['vtx.y'], events=event_ids)[0]
+    selected = np.sort(event_ids[trimmed_sample['contained'][event_ids]])
+    np.testing.assert_array_equal(datasets['event_id'], selected)
+    np.testing.assert_array_equal(datasets['vtx.y'], trimmed_sample['vtx.y'][selected])
+    # the first N events of the sample, whatever the events per file (e.g. xyz_vertex_training_testsize.py --n_events).
+    for n_first in [70, 150, 200]:
+        datasets = io.load_data(sample_path, contained_only=True, contiguous=True, events=slice(0, n_first))[0]
+        selected = np.flatnonzero(trimmed_sample['contained'][:n_first])
+        np.testing.assert_array_equal(datasets['event_id'], selected)
+        np.testing.assert_array_equal(datasets['vtx.z'], trimmed_sample['vtx.z'][selected])
+    with pytest.raises(IndexError):
+        io.load_data(sample_path, events=[n_events])
+
+
+def test_batches_stream_the_events_across_the_files(sample_path, trimmed_sample):
+    contained = np.flatnonzero(trimmed_sample['contained'])
+    batches = list(io.iter_batches(sample_path, 64, keys=['vtx.x', 'firstcellx']))
+    assert [len(batch['event_id']) for batch in batches[:-1]] == [64] * (len(batches) - 1)
+    batch = {key: np.concatenate([batch[key] for batch in batches]) for key in batches[0]}
+    np.testing.assert_array_equal(batch['event_id'], contained)
+    np.testing.assert_array_equal(batch['xz'][..., 0], trimmed_sample['cvnmap_xz'][contained])
+    np.testing.assert_array_equal(batch['yz'][..., 0], trimmed_sample['cvnmap_yz'][contained])
+    np.testing.assert_allclose(batch['vtx'], trimmed_sample['vtx'][contained], rtol=1e-6)
+    np.testing.assert_array_equal(batch['vtx.x'], trimmed_sample['vtx.x'][contained])
+    # the signed first hits.
+    np.testing.assert_array_equal(batch['firstcellx'], trimmed_sample['signed_firstcellx'][contained])
+
+    everything = list(io.iter_batches(sample_path, 100, drop_outside_map=False, shuffle_files=True, seed=4))
+    event_id = np.concatenate([batch['event_id'] for batch in everything])
+    np.testing.assert_array_equal(np.sort(event_id), trimmed_sample['event_id'])
+    np.testing.assert_array_equal(np.concatenate([batch['xz'] for batch in everything])[..., 0], trimmed_sample['cvnmap_xz'][event_id])
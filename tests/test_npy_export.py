@@ -0,0 +1,38 @@
+# test_npy_export.py
+# The .npy export of a sample, memory mapped by load_data(), holds the same events as the preprocessed files.
+
+import numpy as np
+
+import utils.iomanager as io
+import utils.npy_export
+import utils.preprocess
+
+
+def test_npy_export_round_trip(preprocessed, trimmed_sample, tmp_path):
+    in_files = io.list_preprocessed_files([preprocessed(layout='sparse', containment='mask')])
+    utils.npy_export.export_npy(in_files, str(tmp_path), block_size=32)
+    datasets, total_events, total_files = io.load_data(str(tmp_path), contiguous=True)
+    assert (total_events, total_files) == (len(trimmed_sample['event_id']), 1)
+    assert isinstance(datasets['cvnmap'], np.memmap)
+    for key in utils.preprocess.TRAINING_KEYS + ['event_id']:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key])
+
+    # the events inside the cvnmap, and some of them, keep their event ids.
+    contained = np.flatnonzero(trimmed_sample['contained'])
+    datasets = io.load_data(str(tmp_path), contained_only=True, contiguous=True, keys=['vtx.x'], events=slice(0, 100))[0]
+    assert sorted(datasets) == ['event_id', 'vtx.x']
+    np.testing.assert_array_equal(datasets['event_id'], contained[contained < 100])
+    np.testing.assert_array_equal(datasets['vtx.x'], trimmed_sample['vtx.x'][contained[contained < 100]])
+
+
+def test_contained_only_export_keeps_the_event_ids(preprocessed, trimmed_sample, tmp_path):
+    in_files = io.list_preprocessed_files([preprocessed(containment='mask')])
+    utils.npy_export.export_npy(in_files, str(tmp_path), contained_only=True)
+    contained = np.flatnonzero(trimmed_sample['contained'])
+    datasets, total_events, _ = io.load_data(str(tmp_path), contiguous=True)
+    assert total_events == len(contained)
+    np.testing.assert_array_equal(datasets['event_id'], contained)
+    np.testing.assert_array_equal(datasets['cvnmap'], trimmed_sample['cvnmap'][contained])
+    event_ids = contained[[2, 10, 11]]
+    np.testing.assert_array_equal(io.load_data(str(tmp_path), contiguous=True, events=event_ids)[0]['firstplane'],
+                                  trimmed_sample['firstplane'][event_ids])
@@ -0,0 +1,75 @@
+# test_pixel_stats.py
+# The normalisation from the pixel stats is that of a MinMaxScaler fit on the training maps only.
+
+import numpy as np
+import pytest
+
+import utils.pixel_stats
+import utils.splits
+
+
+def training_views(trimmed_sample, split, set_key='train'):
+    """
+    :return: (XZ, YZ) views (N, 100, 80) of the events of a set of the split, inside the cvnmap, as the training sees them
+    """
+    rows = np.flatnonzero(np.isin(trimmed_sample['event_id'], split[set_key]) & trimmed_sample['contained'])
+    maps = trimmed_sample['cvnmap'][rows].reshape(-1, 100, 80, 2)
+    return maps[..., 0], maps[..., 1]
+
+
+def test_split_stats_are_of_the_training_events_only(preprocessed, trimmed_sample):
+    path = preprocessed()
+    split = utils.splits.create_split(len(trimmed_sample['event_id']), seed=3)
+    stats = utils.pixel_stats.split_stats(path, split, 'train', batch_size=50)
+
+    expected = utils.pixel_stats.PixelStats().update_views(*training_views(trimmed_sample, split))
+    assert stats.count == expected.count < len(split['train'])
+    for key in utils.pixel_stats.STATS_KEYS[1:]:
+        np.testing.assert_array_equal(getattr(stats, key), getattr(expected, key))
+    assert stats.split_digest == utils.splits.split_digest(split['train'])
+    assert stats.split_digest != utils.splits.split_digest(split['test'])
+
+
+def test_split_digest_is_saved(preprocessed, trimmed_sample, tmp_path):
+    split = utils.splits.create_split(len(trimmed_sample['event_id']), seed=3)
+    stats = utils.pixel_stats.split_stats(preprocessed(), split, 'train')
+    stats.save(str(tmp_path / 'train.stats.h5'))
+    loaded = utils.pixel_stats.PixelStats.load(str(tmp_path / 'train.stats.h5'))
+    assert loaded.split_digest == stats.split_digest
+    np.testing.assert_array_equal(loaded.max, stats.max)
+
+
+def test_min_max_scale_is_a_fit_on_the_training_maps(preprocessed, trimmed_sample):
+    split = utils.splits.create_split(len(trimmed_sample['event_id']), seed=3)
+    stats = utils.pixel_stats.split_stats(preprocessed(), split, 'train')
+    train_xz, train_yz = training_views(trimmed_sample, split)
+    test_xz, _ = training_views(trimmed_sample, split, 'test')
+
+    # what MinMaxScaler().fit() on the stacked XZ & YZ training maps does, per pixel position.
+    fit_maps = np.vstack([train_xz.reshape(len(train_xz), -1), train_yz.reshape(len(train_yz), -1)]).astype(np.float64)
+    minimum, maximum = fit_maps.min(axis=0), fit_maps.max(axis=0)
+    data_range = np.where(maximum > minimum, maximum - minimum, 1)
+    expected = ((test_xz.reshape(len(test_xz), -1) - minimum) / data_range).reshape(test_xz.shape)
+
+    scaled = stats.min_max_scale(test_xz)
+    assert scaled.dtype == np.float32
+    np.testing.assert_allclose(scaled, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_transform_data_with_stats_matches_transform_data(trimmed_sample):
+    pytest.importorskip('sklearn')
+    pytest.importorskip('tensorflow')
+    import utils.model
+
+    split = utils.splits.create_split(len(trimmed_sample['event_id']), seed=3)
+    data = {}
+    for set_key in utils.splits.SPLIT_KEYS:
+        xz, yz = training_views(trimmed_sample, split, set_key)
+        data[set_key] = {'xz': xz, 'yz': yz, 'vtx': np.zeros((len(xz), 3))}
+    stats = utils.pixel_stats.PixelStats().update_views(data['train']['xz'], data['train']['yz'])
+
+    _, *fit = utils.model.Config.transform_data({**data['train']}, {**data['val']}, {**data['test']})
+    _, *from_stats = utils.model.Config.transform_data_with_stats({**data['train']}, {**data['val']}, {**data['test']}, stats)
+    for fit_set, stats_set in zip(fit, from_stats):
+        for key in ['xz', 'yz']:
+            np.testing.assert_allclose(stats_set[key], fit_set[key], rtol=1e-6, atol=1e-6)
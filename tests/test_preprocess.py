@@ -0,0 +1,169 @@
+# test_preprocess.py
+# The preprocessed files hold the events of the trimmed files, and the subsets written alongside are kept apart.
+
+import os
+
+import h5py
+import numpy as np
+
+import synthetic
+import utils.catalog
+import utils.iomanager as io
+import utils.metadata
+import utils.preprocess
+import utils.vds
+import utils.zarr_store
+
+
+def test_round_trip(preprocessed, trimmed_sample):
+    datasets, total_events, total_files = io.load_data(preprocessed())
+    assert (total_events, total_files) == (len(trimmed_sample['event_id']), len(synthetic.EVENTS_PER_FILE))
+    datasets = synthetic.concatenated(datasets)
+    for key in utils.preprocess.TRAINING_KEYS + ['event_id']:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key])
+    # without --bake_labels, the first hits are the unsigned ones of the trimmed files, and there are no labels.
+    assert datasets['firstcellx'].dtype == np.uint32
+    assert 'vtx_x_pixelmap' not in datasets
+
+
+def test_baked_labels_are_the_signed_first_hits(preprocessed, trimmed_sample):
+    datasets = synthetic.concatenated(io.load_data(preprocessed(bake_labels=True))[0])
+    for coordinate, key in utils.preprocess.FIRST_HIT_KEYS.items():
+        assert datasets[key].dtype == np.dtype(utils.preprocess.SIGNED_FIRST_HIT_DTYPES[key])
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[f'signed_{key}'])
+        np.testing.assert_array_equal(datasets[utils.preprocess.PIXELMAP_LABEL_KEYS[coordinate]],
+                                      trimmed_sample['vtx'][:, 'xyz'.index(coordinate)].astype(np.float32))
+    assert (datasets['firstcellx'] < 0).any() and (datasets['firstcelly'] < 0).any()
+    np.testing.assert_array_equal(datasets['cvnmap'], trimmed_sample['cvnmap'])
+
+
+def test_labels_are_the_same_baked_or_not(preprocessed):
+    for path, baked_path in zip(io.list_preprocessed_files([preprocessed()]), io.list_preprocessed_files([preprocessed(bake_labels=True)])):
+        with h5py.File(path, 'r') as f, h5py.File(baked_path, 'r') as f_baked:
+            labels, baked = io.file_pixelmap_labels(f), io.file_pixelmap_labels(f_baked)
+        for key in ['firstcellx', 'firstcelly', 'firstplane', 'vtx']:
+            np.testing.assert_array_equal(labels[key], baked[key])
+
+
+def test_views_layout_round_trip(preprocessed, trimmed_sample):
+    path = preprocessed(layout='views')
+    for out_file in io.list_preprocessed_files([path]):
+        with h5py.File(out_file, 'r') as f:
+            assert 'cvnmap' not in f and f['cvnmap_xz'].shape[1:] == (100, 80)
+    datasets = synthetic.concatenated(io.load_data(path)[0])
+    assert 'cvnmap' not in datasets
+    for key in utils.preprocess.CVNMAP_VIEW_KEYS:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key])
+    np.testing.assert_array_equal(datasets['vtx.z'], trimmed_sample['vtx.z'])
+
+
+def test_sparse_layout_round_trip(preprocessed, trimmed_sample):
+    path = preprocessed(layout='sparse')
+    assert not trimmed_sample['cvnmap'].any(axis=1).all()
+    np.testing.assert_array_equal(np.concatenate(io.load_data(path)[0]['cvnmap']), trimmed_sample['cvnmap'])
+    np.testing.assert_array_equal(io.load_data(path, contiguous=True)[0]['cvnmap'], trimmed_sample['cvnmap'])
+
+    # only the pixels of the events asked for are read.
+    first_event = 0
+    n_pixels = 0
+    for out_file, n_events in zip(io.list_preprocessed_files([path]), synthetic.EVENTS_PER_FILE):
+        cvnmap = trimmed_sample['cvnmap'][first_event:first_event + n_events]
+        with h5py.File(out_file, 'r') as f:
+            assert 'cvnmap' not in f
+            rows = np.array([0, 3, 4, n_events // 2, n_events - 1])
+            np.testing.assert_array_equal(io.read_sparse_cvnmaps(f, rows=rows), cvnmap[rows])
+            np.testing.assert_array_equal(io.read_sparse_cvnmaps(f, 5, 17), cvnmap[5:17])
+            assert io.read_sparse_cvnmaps(f, rows=[]).shape == (0, 16000)
+            n_pixels += f.attrs['cvnmap_nonzero_pixels']
+        first_event += n_events
+    assert n_pixels == np.count_nonzero(trimmed_sample['cvnmap'])
+
+
+def test_containment_mask_keeps_the_event_ids_of_the_sample(preprocessed, trimmed_sample):
+    contained = trimmed_sample['contained']
+    assert 0 < contained.sum() < len(contained)
+    path = preprocessed(containment='mask')
+    assert io.load_data(path)[1] == len(contained)
+
+    datasets, total_events, _ = io.load_data(path, contained_only=True)
+    datasets = synthetic.concatenated(datasets)
+    assert total_events == contained.sum()
+    np.testing.assert_array_equal(datasets['event_id'], np.flatnonzero(contained))
+    for key in utils.preprocess.TRAINING_KEYS:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key][contained])
+
+
+def test_containment_drop_renumbers_the_events(preprocessed, trimmed_sample):
+    contained = trimmed_sample['contained']
+    path = preprocessed(containment='drop')
+    events_outside = []
+    for out_file in io.list_preprocessed_files([path]):
+        with h5py.File(out_file, 'r') as f:
+            assert 'contained' not in f
+            assert f.attrs['events_dropped'] == f.attrs['events_outside_cvnmap']
+            events_outside.append(f.attrs['events_outside_cvnmap'])
+    assert sum(events_outside) == len(contained) - contained.sum()
+
+    # the events outside the cvnmap are not in the files, so the event ids are of the events kept.
+    datasets, total_events, _ = io.load_data(path, contained_only=True)
+    datasets = synthetic.concatenated(datasets)
+    assert total_events == contained.sum()
+    np.testing.assert_array_equal(datasets['event_id'], np.arange(contained.sum()))
+    for key in utils.preprocess.TRAINING_KEYS:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key][contained])
+
+
+def test_pyramid_views_and_labels_are_downsampled(preprocessed, trimmed_sample):
+    path = preprocessed(pyramid=[2, 4], layout='sparse')
+    for factor in [2, 4]:
+        datasets, total_events, _ = io.load_data(path, contiguous=True, resolution=factor)
+        assert total_events == len(trimmed_sample['event_id'])
+        assert 'cvnmap' not in datasets
+        for key in utils.preprocess.CVNMAP_VIEW_KEYS:
+            # the sum of the pixels of each factor x factor block.
+            expected = trimmed_sample[key].astype(np.uint16).reshape(-1, 100 // factor, factor, 80 // factor, factor).sum(axis=(2, 4))
+            assert datasets[key].dtype == np.uint16
+            np.testing.assert_array_equal(datasets[key], expected)
+        for coordinate in 'xyz':
+            np.testing.assert_allclose(datasets[utils.preprocess.PIXELMAP_LABEL_KEYS[coordinate]],
+                                       trimmed_sample['vtx'][:, 'xyz'.index(coordinate)] / factor, rtol=1e-6)
+    np.testing.assert_array_equal(io.VertexDataset(path, resolution=4)['cvnmap_yz'][[3, 200]],
+                                  io.load_data(path, contiguous=True, resolution=4, events=[3, 200])[0]['cvnmap_yz'])
+
+
+def test_also_subsets_are_not_events_of_the_sample(preprocessed, trimmed_sample, tmp_path):
+    path = preprocessed(also_subsets=[40], sampling='random', seed=2)
+    n_events = len(trimmed_sample['event_id'])
+
+    datasets, total_events, total_files = io.load_data(path, contiguous=True)
+    assert total_events == n_events and total_files == len(synthetic.EVENTS_PER_FILE)
+    np.testing.assert_array_equal(datasets['vtx.x'], trimmed_sample['vtx.x'])
+    assert len(io.list_preprocessed_files([path])) == len(synthetic.EVENTS_PER_FILE)
+    assert io.sample_event_offsets(path)[1] == n_events
+    assert len(io.VertexDataset(path)) == n_events
+    assert sum(len(batch['event_id']) for batch in io.iter_batches(path, 64, drop_outside_map=False)) == n_events
+    assert utils.catalog.build_catalog(path, str(tmp_path / 'catalog.json'))['events'] == n_events
+    vds_file = utils.vds.build_vds(io.list_preprocessed_files([path]), str(tmp_path / 'sample.vds.h5'))
+    assert io.load_data(vds_file, contiguous=True)[1] == n_events
+
+    # the subsets are a sample of their own, of events of the trimmed files.
+    subset_path = utils.preprocess.subset_directory(path, 40, 'random')
+    assert os.path.basename(subset_path).startswith(synthetic.SAMPLE_NAME)
+    subset, subset_events, _ = io.load_data(subset_path, contiguous=True)
+    assert subset_events == 40 * len(synthetic.EVENTS_PER_FILE)
+    assert np.isin(subset['vtx.x'], trimmed_sample['vtx.x']).all()
+
+
+def test_zarr_store_with_metadata_sidecar(preprocessed):
+    path = preprocessed(backend='zarr', compression='lz4', write_metadata=True, containment='mask')
+    stores = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(utils.zarr_store.ZARR_SUFFIX))
+    assert len(stores) == len(synthetic.EVENTS_PER_FILE)
+    events = []
+    for store in stores:
+        with h5py.File(utils.metadata.metadata_filename(store), 'r') as f:
+            events.append(f['E'].shape[0])
+            np.testing.assert_array_equal(f['input_row'][:], np.arange(events[-1]))
+            # the row in the file, not a global event id.
+            np.testing.assert_array_equal(f['row'][:], np.arange(events[-1]))
+            assert 'event_id' not in f
+    assert events == synthetic.EVENTS_PER_FILE
@@ -0,0 +1,85 @@
+# test_shards.py
+# The shards hold the events of the preprocessed files, in order (repacked) or in one permutation (shuffled),
+# and the index maps them back to their source.
+
+import os
+
+import numpy as np
+
+import synthetic
+import utils.iomanager as io
+import utils.preprocess
+import utils.shards
+
+
+def source_event_ids(index) -> np.array:
+    """
+    :param index: dict, from shards.load_shard_index()
+    :return: np.array, the event id in the (unsharded) sample of each event of the shards
+    """
+    file_offsets = np.concatenate(([0], np.cumsum(synthetic.EVENTS_PER_FILE)))
+    return file_offsets[index['source_file']] + index['source_row']
+
+
+def test_repack_keeps_the_order(preprocessed, trimmed_sample, tmp_path):
+    # sparse, so the pixels are re-offset across the ends of the files & shards.
+    in_files = io.list_preprocessed_files([preprocessed(layout='sparse', containment='mask')])
+    utils.shards.repack_shards(in_files, str(tmp_path), shard_events=100, block_size=32)
+    n_events = len(trimmed_sample['event_id'])
+
+    index = utils.shards.load_shard_index(str(tmp_path))
+    assert index['shard_files'] == [utils.shards.shard_filename(shard, 3) for shard in range(3)]
+    np.testing.assert_array_equal(index['shard'], np.arange(n_events) // 100)
+    np.testing.assert_array_equal(index['row'], np.arange(n_events) % 100)
+    np.testing.assert_array_equal(source_event_ids(index), np.arange(n_events))
+
+    datasets, total_events, total_files = io.load_data(str(tmp_path), contiguous=True)
+    assert (total_events, total_files) == (n_events, 3)
+    for key in utils.preprocess.TRAINING_KEYS + ['event_id']:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key])
+    contained = io.load_data(str(tmp_path), contained_only=True, contiguous=True, keys=['vtx.x'])[0]
+    np.testing.assert_array_equal(contained['event_id'], np.flatnonzero(trimmed_sample['contained']))
+
+
+def test_shuffle_is_a_permutation(preprocessed, trimmed_sample, tmp_path):
+    in_files = io.list_preprocessed_files([preprocessed(layout='sparse')])
+    n_events = len(trimmed_sample['event_id'])
+    for seed in [5, 6]:
+        utils.shards.shuffle_shards(in_files, str(tmp_path / f'seed_{seed}'), shard_events=100, seed=seed, block_size=32)
+    index = utils.shards.load_shard_index(str(tmp_path / 'seed_5'))
+
+    # every event once, not in the order of the files.
+    source = source_event_ids(index)
+    np.testing.assert_array_equal(np.sort(source), np.arange(n_events))
+    assert (source != np.arange(n_events)).any()
+    assert (source != source_event_ids(utils.shards.load_shard_index(str(tmp_path / 'seed_6')))).any()
+
+    # each event is moved whole, to the place in the index.
+    datasets, total_events, _ = io.load_data(str(tmp_path / 'seed_5'), contiguous=True)
+    assert total_events == n_events
+    for key in utils.preprocess.TRAINING_KEYS:
+        np.testing.assert_array_equal(datasets[key], trimmed_sample[key][source])
+
+    # the same seed, the same shards.
+    utils.shards.shuffle_shards(in_files, str(tmp_path / 'again'), shard_events=100, seed=5, block_size=50)
+    np.testing.assert_array_equal(source_event_ids(utils.shards.load_shard_index(str(tmp_path / 'again'))), source)
+
+
+def test_shuffle_into_many_shards(preprocessed, trimmed_sample, tmp_path, monkeypatch):
+    in_files = io.list_preprocessed_files([preprocessed()])
+    n_events = len(trimmed_sample['event_id'])
+    # chunks of 3 events (of the cvnmap), so each bucket is written a few whole chunks at a time, and the rest at the end.
+    monkeypatch.setattr(utils.shards, 'BUCKET_CHUNK_BYTES', 3 * 16000)
+    utils.shards.shuffle_shards(in_files, str(tmp_path), shard_events=7, seed=8, block_size=32)
+    index = utils.shards.load_shard_index(str(tmp_path))
+    assert len(index['shard_files']) == -(-n_events // 7)
+    assert sorted(os.listdir(tmp_path)) == sorted(index['shard_files'] + [utils.shards.SHARD_INDEX_FILENAME])
+
+    source = source_event_ids(index)
+    np.testing.assert_array_equal(np.sort(source), np.arange(n_events))
+    # every column (but the new event ids) follows the index.
+    original = io.load_data(preprocessed(), contiguous=True)[0]
+    datasets = io.load_data(str(tmp_path), contiguous=True)[0]
+    assert sorted(datasets) == sorted(original)
+    for key in datasets.keys() - {'event_id'}:
+        np.testing.assert_array_equal(datasets[key], original[key][source])
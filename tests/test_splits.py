@@ -0,0 +1,36 @@
+# test_splits.py
+# The saved split assigns every event of the sample to one set, and is the same whichever way the sample is loaded.
+
+import numpy as np
+import pytest
+
+import utils.iomanager as io
+import utils.splits
+
+
+def test_split_is_a_partition_of_the_events(preprocessed, trimmed_sample, tmp_path):
+    path = preprocessed(containment='mask')
+    n_events = len(trimmed_sample['event_id'])
+    split = utils.splits.create_split(utils.splits.count_sample_events(path), seed=7)
+    np.testing.assert_array_equal(np.sort(np.concatenate([split[key] for key in utils.splits.SPLIT_KEYS])), np.arange(n_events))
+    assert len(split['test']) == int(np.ceil(0.25 * n_events))
+
+    split_file = str(tmp_path / 'split.h5')
+    utils.splits.save_split(split_file, split, path, 0.25, 0.1, 7)
+    loaded = utils.splits.load_split(split_file, path)
+    for key in utils.splits.SPLIT_KEYS:
+        np.testing.assert_array_equal(loaded[key], split[key])
+    with pytest.raises(ValueError):
+        utils.splits.load_split(split_file, preprocessed(containment='drop'))
+
+
+def test_split_rows_are_the_events_of_each_set(preprocessed, trimmed_sample):
+    path = preprocessed(containment='mask')
+    split = utils.splits.create_split(len(trimmed_sample['event_id']), seed=7)
+    # the events outside the cvnmap are not loaded, so they are in no set.
+    datasets = io.load_data(path, contained_only=True, contiguous=True, keys=['vtx.x'])[0]
+    rows = utils.splits.split_rows(split, datasets['event_id'])
+    for key in utils.splits.SPLIT_KEYS:
+        in_set = split[key][trimmed_sample['contained'][split[key]]]
+        np.testing.assert_array_equal(datasets['event_id'][rows[key]], in_set)
+        np.testing.assert_array_equal(datasets['vtx.x'][rows[key]], trimmed_sample['vtx.x'][in_set])
@@ -0,0 +1,35 @@
+# test_vds.py
+# The virtual dataset file of a sample reads as the sample: every loader gets the events of the preprocessed files.
+
+import numpy as np
+import pytest
+
+import synthetic
+import utils.iomanager as io
+import utils.vds
+
+
+def test_vds_reads_as_the_sample(preprocessed, trimmed_sample, tmp_path):
+    path = preprocessed(containment='mask', bake_labels=True)
+    vds_file = utils.vds.build_vds(io.list_preprocessed_files([path]), str(tmp_path / 'sample.vds.h5'))
+    baseline = synthetic.concatenated(io.load_data(path)[0])
+
+    datasets, total_events, total_files = io.load_data(vds_file)
+    assert (total_events, total_files) == (len(trimmed_sample['event_id']), 1)
+    for key, data in synthetic.concatenated(datasets).items():
+        np.testing.assert_array_equal(data, baseline[key])
+    np.testing.assert_array_equal(baseline['cvnmap'], trimmed_sample['cvnmap'])
+
+    contained = np.flatnonzero(trimmed_sample['contained'])
+    datasets = io.load_data(vds_file, contained_only=True, contiguous=True)[0]
+    np.testing.assert_array_equal(datasets['event_id'], contained)
+    np.testing.assert_array_equal(datasets['firstcellx'], trimmed_sample['signed_firstcellx'][contained])
+    with io.VertexDataset(vds_file) as ds:
+        np.testing.assert_array_equal(ds['cvnmap_xz'][[284, 0, 150]], trimmed_sample['cvnmap_xz'][[284, 0, 150]])
+    event_id = np.concatenate([batch['event_id'] for batch in io.iter_batches(vds_file, 64)])
+    np.testing.assert_array_equal(event_id, contained)
+
+
+def test_sparse_files_are_not_stitched(preprocessed, tmp_path):
+    with pytest.raises(ValueError):
+        utils.vds.build_vds(io.list_preprocessed_files([preprocessed(layout='sparse')]), str(tmp_path / 'sample.vds.h5'))
@@ -0,0 +1,47 @@
+# atomic.py
+# Tools to write an output (file or Zarr store) under a temporary name ('.partial'), and rename it only once complete.
+# So a killed job never leaves a truncated output behind under the final name, and the next run redoes it.
+
+import contextlib
+import os
+import shutil
+
+# appended to the name of an output while it is written.
+PARTIAL_SUFFIX = '.partial'
+
+
+def partial_filename(path) -> str:
+    """
+    :param path: full path to the output
+    :return: full path to write the output under, until it is complete
+    """
+    return path + PARTIAL_SUFFIX
+
+
+def finish_output(path) -> None:
+    """
+    Rename the complete output from partial_filename(path) to `path`, replacing any previous output.
+    :param path: full path to the output
+    :return: None
+    """
+    if os.path.isdir(path):
+        # a Zarr store is a directory, which os.replace() can't replace.
+        shutil.rmtree(path)
+    os.replace(partial_filename(path), path)
+    return None
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Write an output under a temporary name, and rename it once the block is done, e.g.
+        with atomic_output(out_file) as partial_file, h5py.File(partial_file, 'w') as f:
+            ...
+    (the file is closed before it is renamed). If the block raises, the output is not renamed.
+    For an output written across several calls (e.g. preprocess.PreprocessedFileSink),
+    write to partial_filename() and call finish_output() instead.
+    :param path: full path to the output
+    :return: context manager, giving the full path to write the output under
+    """
+    yield partial_filename(path)
+    finish_output(path)
@@ -0,0 +1,168 @@
+# catalog.py
+# Tools to index the preprocessed files of a sample from their metadata only -- no data is read or decompressed:
+# the events, datasets (shape, type, chunks, compression), det/horn/flux and size on disk of every file, in one JSON file.
+# The loaders (see iomanager.load_catalog()), the split and the memory estimates then answer from it, without opening the files.
+
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.iomanager as io
+import utils.shards
+import utils.zarr_store
+
+CATALOG_VERSION = 1
+
+# the strings of each part of the sample's identity, as IOManager.get_det_horn_and_flux_from_string() finds them.
+IDENTITY_TOKENS = {'det': ['FD', 'ND'], 'horn': ['FHC', 'RHC'], 'flux': ['Fluxswap', 'Nonswap', 'Combined']}
+
+# the keys load_data() reads (if in the files), for the memory estimates.
+LOADED_KEYS = ['cvnmap', 'cvnmap_xz', 'cvnmap_yz', 'vtx.x', 'vtx.y', 'vtx.z', 'firstcellx', 'firstcelly', 'firstplane',
+               'vtx_x_pixelmap', 'vtx_y_pixelmap', 'vtx_z_pixelmap']
+
+
+def json_value(value):
+    """
+    :param value: an h5 (or Zarr) attribute, e.g. np.int64, np.bool_, np.array or bytes
+    :return: the same value as a JSON type
+    """
+    if isinstance(value, bytes):
+        return value.decode()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def sample_identity(*names) -> dict:
+    """
+    The det, horn and flux of a sample, from its names, e.g. the file name and then its directory (the shards have none in theirs).
+    Unlike IOManager.get_det_horn_and_flux_from_string(), doesn't exit if one is missing.
+    :param names: str, file or directory names, searched in order
+    :return: dict of {'det', 'horn', 'flux': str, '' if in none of the names}
+    """
+    identity = {}
+    for part, tokens in IDENTITY_TOKENS.items():
+        identity[part] = next((token for name in names for token in tokens if token in name), '')
+    return identity
+
+
+def describe_dataset(dset) -> dict:
+    """
+    :param dset: h5py.Dataset or zarr.Array (events first)
+    :return: dict of its shape, dtype, chunks, compression and uncompressed bytes (from the metadata only)
+    """
+    if isinstance(dset, h5py.Dataset):
+        compression = dset.compression
+    else:
+        compression = dset.compressor.codec_id if dset.compressor is not None else None
+    return {'shape': list(dset.shape),
+            'dtype': np.dtype(dset.dtype).str,
+            'chunks': list(dset.chunks) if dset.chunks else None,
+            'compression': compression,
+            'nbytes': int(np.prod(dset.shape, dtype=np.int64)) * np.dtype(dset.dtype).itemsize}
+
+
+def describe_file(path) -> dict:
+    """
+    The catalog entry of a preprocessed file (or Zarr store), from its metadata only.
+    :param path: full path to the preprocessed file
+    :return: dict, or None if the file holds no events (e.g. a sidecar, the shard index or a VDS file)
+    """
+    with io.open_preprocessed(path) as f:
+        if not io.has_cvnmap(f):
+            return None
+        n_events = io.events_in_file(f)
+        attrs = {key: json_value(f.attrs[key]) for key in utils.shards.LAYOUT_ATTRS if key in f.attrs}
+        # all the events are inside the cvnmap if they were dropped, else the mask counted them.
+        contained_events = None
+        if attrs.get('containment') == 'drop':
+            contained_events = n_events
+        elif attrs.get('containment') == 'mask' and 'events_outside_cvnmap' in f.attrs:
+            contained_events = n_events - int(f.attrs['events_outside_cvnmap'])
+        datasets = {key: describe_dataset(f[key]) for key in f.keys()}
+    filename = os.path.basename(os.path.normpath(path))
+    entry = {'file': filename,
+             'backend': 'zarr' if utils.zarr_store.is_zarr(path) else 'h5',
+             'events': n_events,
+             'contained_events': contained_events,
+             'size_bytes': io.path_size(path),
+             'mtime': os.path.getmtime(path),
+             'attrs': attrs,
+             'datasets': datasets}
+    entry.update(sample_identity(filename, os.path.basename(os.path.dirname(os.path.abspath(path)))))
+    return entry
+
+
+def build_catalog(input_dir, catalog_file=None) -> dict:
+    """
+    Catalog the preprocessed files (and Zarr stores) of a directory, in order of their (sorted) names,
+    with the global event id of the first event of each (the same as iomanager.sample_event_offsets()).
+    Written with atomic.atomic_output().
+    :param input_dir: directory of the preprocessed files of a sample
+    :param catalog_file: full path to the JSON file to write (default: <input_dir>/catalog.json)
+    :return: dict, the catalog
+    """
+    catalog_file = catalog_file or os.path.join(input_dir, io.CATALOG_FILENAME)
+    files = []
+    skipped = []
+    total_events = 0
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
+            continue
+        entry = describe_file(os.path.join(input_dir, filename))
+        if entry is None:
+            # listed, so the catalog isn't taken as out of date because of it.
+            skipped.append(filename)
+            continue
+        entry['first_event_id'] = total_events
+        total_events += entry['events']
+        files.append(entry)
+        print(f"{filename}: {entry['events']} events, {entry['size_bytes'] / 1024 ** 2:.1f} MB")
+
+    contained = [entry['contained_events'] for entry in files]
+    catalog = {'catalog_version': CATALOG_VERSION,
+               'created': time.ctime(),
+               'path': os.path.abspath(input_dir),
+               'events': total_events,
+               'contained_events': sum(contained) if None not in contained else None,
+               'size_bytes': sum(entry['size_bytes'] for entry in files),
+               'files': files,
+               'skipped': skipped}
+    catalog.update(sample_identity(os.path.basename(os.path.normpath(input_dir))))
+
+    with utils.atomic.atomic_output(catalog_file) as partial_file, open(partial_file, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, indent=1)
+    print(f'Catalog of {len(files)} files and {total_events} events saved: {catalog_file}')
+    return catalog
+
+
+def estimate_load_bytes(catalog, contained_only=False, keys=None) -> dict:
+    """
+    The memory of the arrays of load_data(..., contiguous=True), i.e. ~its peak memory, from the catalog only.
+    :param catalog: dict, from build_catalog() or iomanager.load_catalog()
+    :param contained_only: only the events with the vertex inside the cvnmap (all events, if not known)
+    :param keys: list of the keys to count (default: LOADED_KEYS). 'event_id' is always counted.
+    :return: dict of {key: bytes} of the keys in every file, with 'cvnmap' dense for the sparse files
+    """
+    keys = LOADED_KEYS if keys is None else keys
+    n_events = catalog['events']
+    if contained_only and catalog['contained_events'] is not None:
+        n_events = catalog['contained_events']
+    event_bytes = None
+    for entry in catalog['files']:
+        file_bytes = {}
+        for key, dataset in entry['datasets'].items():
+            itemsize = np.dtype(dataset['dtype']).itemsize
+            if key == 'cvnmap_value' and 'cvnmap' in keys:
+                # densified when loaded.
+                file_bytes['cvnmap'] = 16000 * itemsize
+            elif key in keys:
+                file_bytes[key] = int(np.prod(dataset['shape'][1:], dtype=np.int64)) * itemsize
+        event_bytes = file_bytes if event_bytes is None else {key: value for key, value in event_bytes.items() if key in file_bytes}
+    # the global id of each event.
+    event_bytes = dict(event_bytes or {}, event_id=8)
+    return {key: n_events * value for key, value in event_bytes.items()}
@@ -2,7 +2,7 @@
 # Useful utilities for doing the training.
 
 from pandas import DataFrame, read_csv
-from numpy import ndarray, array, where
+from numpy import ndarray, array, asarray, where, arange, bincount, cumsum, nonzero, repeat, zeros
 
 # coordinate conversion functions. These are global.
 # Far Detector conversions.
@@ -49,6 +49,103 @@ def convert_nd_vtx_z_to_pixelmap(vtx_z_array, firstplane_array):
     return vtx_z_array / 6.61 - firstplane_array
 
 
+def remove_unsigned_ints_array(first_hit_array, dtype='int32') -> ndarray:
+    """
+    Same fix as DataCleaning.remove_unsigned_ints(), for a single array, without the printout.
+    Rather than add 40, convert to `int`, subtract 40 -- which only recovers values down to -40 --
+    read the 32-bit unsigned values back as the signed values they were written from.
+    Used when preprocessing, to write the signed firstcellx, firstcelly, firstplane once.
+    :param first_hit_array: np.array, `firstcellx`, `firstcelly` or `firstplane` (unsigned)
+    :param dtype: the signed type to return
+    :return: np.array of signed ints
+    """
+    first_hit = asarray(first_hit_array).astype('int64')
+    first_hit[first_hit >= 2 ** 31] -= 2 ** 32
+    return first_hit.astype(dtype)
+
+
+def split_cvnmap_views(cvnmap):
+    """
+    Split the flat cvnmaps (16000 pixels) into the XZ and YZ views.
+    The pixels are stored as (100, 80, 2): the last index is the view.
+    NOTE: these are views of the input array (no copies), so they are not contiguous.
+    :param cvnmap: np.array [N, 16000]
+    :return: (cvnmap_xz, cvnmap_yz), each np.array [N, 100, 80]
+    """
+    maps = cvnmap.reshape(-1, 100, 80, 2)
+    return maps[..., 0], maps[..., 1]
+
+
+def pool_cvnmap_view(view, factor, pooling='sum'):
+    """
+    Downsample a view of the cvnmaps by `factor` in both directions, e.g. (100, 80) -> (50, 40) for 2.
+    The 'sum' keeps the total charge (so the type is widened to uint16, the sum of 16 uint8 pixels fits),
+    the 'max' keeps the brightest pixel (and the type).
+    :param view: np.array [N, 100, 80], e.g. from split_cvnmap_views()
+    :param factor: int, the downsampling factor (divides 100 and 80: 2, 4, 5, ...)
+    :param pooling: str, 'sum' or 'max'
+    :return: np.array [N, 100 / factor, 80 / factor]
+    """
+    n_events, height, width = view.shape
+    blocks = view.reshape(n_events, height // factor, factor, width // factor, factor)
+    if pooling == 'max':
+        return blocks.max(axis=(2, 4))
+    return blocks.sum(axis=(2, 4), dtype='uint16')
+
+
+def sparsify_cvnmaps(cvnmap) -> tuple:
+    """
+    Encode a block of flat cvnmaps as only their non-zero pixels, which are a small fraction of the 16000.
+    The pixels are in event order, so the events are recovered from the pixel count of each.
+    :param cvnmap: np.array [N, 16000]
+    :return: (counts [N] of int64, pixel indices [nnz] of uint16, pixel values [nnz])
+    """
+    events, pixels = nonzero(cvnmap)
+    return bincount(events, minlength=cvnmap.shape[0]), pixels.astype('uint16'), cvnmap[events, pixels]
+
+
+def densify_sparse_cvnmaps(offsets, indices, values, events=None, n_pixels=16000, out=None) -> ndarray:
+    """
+    Decode sparse cvnmaps (see sparsify_cvnmaps()) back into the flat (dense) cvnmaps, for a whole batch at once.
+    Event i has the pixels indices[offsets[i] - offsets[0]:offsets[i + 1] - offsets[0]],
+    so `offsets` can be a slice of the file's offsets, with `indices` and `values` read for that slice only.
+    Only numpy, so it can be used in an input pipeline (e.g. wrapped by tf.numpy_function).
+    :param offsets: np.array [M + 1], where each event's pixels start (and the end of the last)
+    :param indices: np.array of the pixel indices (0-15999), from offsets[0]
+    :param values: np.array of the pixel values, from offsets[0]
+    :param events: np.array of the events (0 to M-1) to decode. None decodes all M.
+    :param n_pixels: pixels in a flat cvnmap
+    :param out: np.array [len(events), n_pixels] to decode into (it is zeroed first). None allocates it.
+    :return: np.array [len(events), n_pixels], same type as `values` (`out`, if given)
+    """
+    offsets = asarray(offsets, dtype='int64')
+    if events is None:
+        events = arange(len(offsets) - 1)
+    starts = offsets[events] - offsets[0]
+    counts = offsets[asarray(events) + 1] - offsets[events]
+    # the position of every wanted pixel in `indices`/`values`: each event's start, plus its running pixel count.
+    entries = arange(counts.sum()) + repeat(starts - (cumsum(counts) - counts), counts)
+    if out is None:
+        dense = zeros((len(counts), n_pixels), dtype=values.dtype)
+    else:
+        dense = out
+        dense[...] = 0
+    dense[repeat(arange(len(counts)), counts), indices[entries]] = values[entries]
+    return dense
+
+
+def contained_in_cvnmap(vtx_coords) -> ndarray:
+    """
+    Mask of the events with the vertex inside the cvnmaps, which are 80x100 pixel images.
+    :param vtx_coords: np.array [N,3], the vertex in pixel map coordinates
+    :return: np.array [N] of bool, True if inside the cvnmap
+    """
+    filter_xy =  ((vtx_coords[:, 0] >= 0) & (vtx_coords[:, 0] < 80)
+                & (vtx_coords[:, 1] >= 0) & (vtx_coords[:, 1] < 80))
+    filter_z =    (vtx_coords[:, 2] >= 0) & (vtx_coords[:, 2] < 100)
+    return filter_xy & filter_z
+
+
 def print_input_data(d_tr, d_te, d_va) -> None:
     """
     print out the shapes of the input datasets into model
@@ -215,12 +312,7 @@ class DataCleaning:
         :param vtx_coords: np.array [N,3]
         :return: dict {str, np.array} ("keep", "drop". in that order)
         """
-        filter_xy =  ((vtx_coords[:, 0] >= 0) & (vtx_coords[:, 0] < 80)
-                    & (vtx_coords[:, 1] >= 0) & (vtx_coords[:, 1] < 80))
-        filter_z =    (vtx_coords[:, 2] >= 0) & (vtx_coords[:, 2] < 100)
-        filter_cvnmap = filter_xy & filter_z
-
-        assert vtx_coords[filter_cvnmap].shape == vtx_coords[filter_xy & filter_z].shape, "Filtering masks give different shapes..."
+        filter_cvnmap = contained_in_cvnmap(vtx_coords)
 
         rows_to_keep = where(filter_cvnmap)[0]  # [0] gives the row index
         rows_to_drop = where(~filter_cvnmap)[0]
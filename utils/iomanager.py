@@ -2,61 +2,611 @@
 # Tools to assist reading and writing.
 
 import h5py
+import json
+import numpy as np
 import os
 import psutil
 import time
 
+import utils.data_processing as dp
+import utils.zarr_store
+
 
 # create user variable
 USER = os.environ['USER']
 
+# the schema of a directory of .npy columns, exported from the preprocessed files (see npy_export.export_npy()).
+NPY_SCHEMA_FILENAME = 'schema.json'
+
+# the catalog of the preprocessed files of a directory, from their metadata (see catalog.build_catalog()).
+CATALOG_FILENAME = 'catalog.json'
+
+# most rows read at once through the gaps of the selected rows (see read_rows()), i.e. ~16 MB of cvnmaps.
+READ_THROUGH_ROWS = 1024
+
 # Print memory usage
 def print_memory_usage():
     mem = psutil.virtual_memory()
     print(f"{time.ctime()}: {mem.percent}% used, {mem.available / (1024 ** 3):.2f} GB available\n")
 
-def load_data(path_to_data, load_elasticarms = False):
+def path_size(path) -> int:
+    """
+    :param path: full path to a file, or a directory (e.g. a Zarr store)
+    :return: int, bytes on disk of the file, or of every file in the directory
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def open_preprocessed(path):
+    """
+    :param path: full path to a preprocessed h5 file, or Zarr store (see zarr_store.py)
+    :return: the open h5py.File or zarr.Group (read only), to use with `with`
+    """
+    if utils.zarr_store.is_zarr(path):
+        return utils.zarr_store.open_zarr(path, 'r')
+    return h5py.File(path, 'r')
+
+
+def read_dataset(dset, rows=None, out=None):
+    """
+    Read a whole dataset, or only the selected rows (i.e. events).
+    h5 datasets are read with coalesced hyperslabs (see read_rows()),
+    Zarr arrays with the chunks decompressed in parallel (see zarr_store.read_array()).
+    :param dset: h5py.Dataset or zarr.Array (events first)
+    :param rows: sorted np.array of row indices (or a boolean mask). None reads every row.
+    :param out: np.array to read into (e.g. this file's part of a larger array), of the rows read. None allocates it.
+    :return: np.array (`out`, if given)
+    """
+    if not isinstance(dset, h5py.Dataset):
+        return utils.zarr_store.read_array(dset, rows=rows, out=out)
+    if rows is None:
+        if out is None:
+            return dset[:]
+        if dset.shape[0]:
+            dset.read_direct(out)
+        return out
+    # read through gaps smaller than a chunk, it's cheaper than another chunk lookup.
+    chunk_events = dset.chunks[0] if dset.chunks else 0
+    return read_rows(dset, rows, max_gap=chunk_events, out=out)
+
+
+def measure_read_throughput(h5_file, key='cvnmap', batch_size=1024, n_threads=utils.zarr_store.DEFAULT_READ_THREADS) -> dict:
+    """
+    Time reading one dataset of a (preprocessed) h5 file, front to back, in batches of events,
+    i.e. the way the training reads it. NOTE: a second read of the same file is from the OS page cache.
+    For the 'cvnmap' of a file preprocessed with '--layout sparse', the sparse pixels are read,
+    and densified, so the rate compares with the dense layouts.
+    A Zarr store (see zarr_store.py) is read the same way, each batch decompressed in parallel threads.
+    :param h5_file: full path to the h5 file (or Zarr store)
+    :param key: dataset to read
+    :param batch_size: int, events per read
+    :param n_threads: int, threads to decompress the chunks of a Zarr store with
+    :return: dict of the layout, the file size and the read rates
+    """
+    file_size = path_size(h5_file)
+    zarr = utils.zarr_store.is_zarr(h5_file)
+    with open_preprocessed(h5_file) as f:
+        sparse = key == 'cvnmap' and key not in f and 'cvnmap_offsets' in f
+        if sparse:
+            dset = f['cvnmap_index']  # the layout of the pixels is what's reported
+            n_events = f['cvnmap_offsets'].shape[0] - 1
+            event_bytes = 16000 * f['cvnmap_value'].dtype.itemsize
+        else:
+            dset = f[key]
+            n_events = dset.shape[0]
+            event_bytes = dset.size * dset.dtype.itemsize / max(n_events, 1)
+        start = time.time()
+        for batch_start in range(0, n_events, batch_size):
+            if sparse:
+                read_sparse_cvnmaps(f, batch_start, batch_start + batch_size)
+            elif zarr:
+                utils.zarr_store.read_array(dset, batch_start, batch_start + batch_size, n_threads=n_threads)
+            else:
+                # read (and decompress) the batch, only to time it.
+                _ = dset[batch_start:batch_start + batch_size]
+        seconds = time.time() - start
+
+        if zarr:
+            codec = dset.compressor.get_config() if dset.compressor else {}
+            compression = {'compression': codec.get('cname', codec.get('id', 'none')),
+                           'compression_opts': codec.get('clevel', codec.get('level')),
+                           'shuffle': codec.get('shuffle', 0) > 0}
+        else:
+            compression = {'compression': dset.compression or 'none',
+                           'compression_opts': dset.compression_opts,
+                           'shuffle': dset.shuffle}
+        return {'file': os.path.basename(os.path.normpath(h5_file)),
+                'backend': f'zarr ({n_threads} threads)' if zarr else 'h5',
+                **compression,
+                'chunks': dset.chunks,
+                'events': n_events,
+                'file_size_GB': file_size / 1024 ** 3,
+                'disk_bytes_per_event': file_size / max(n_events, 1),
+                'read_seconds': seconds,
+                'events_per_s': n_events / max(seconds, 1e-9),
+                'MB_per_s_uncompressed': n_events * event_bytes / 1024 ** 2 / max(seconds, 1e-9)}
+
+
+def has_cvnmap(f, include_virtual=False) -> bool:
+    """
+    :param f: h5py.File, the open h5 file
+    :param include_virtual: count a virtual dataset file (see vds.py) as holding events.
+                            It only maps the events of other files, so not in a directory listing.
+    :return: True if the file holds events (a cvnmap, in any layout), False for e.g. the shard index or a metadata sidecar
+    """
+    if f.attrs.get('virtual', False) and not include_virtual:
+        return False
+    return any(key in f for key in ['cvnmap', 'cvnmap_offsets', 'cvnmap_xz'])
+
+
+def list_preprocessed_files(input_dirs) -> list:
+    """
+    :param input_dirs: list of directories of preprocessed h5 files
+    :return: sorted list of full paths to the h5 files holding events (not the sidecars)
+    """
+    h5_files = []
+    for input_dir in input_dirs:
+        for h5_filename in sorted(os.listdir(input_dir)):
+            if not h5_filename.endswith('.h5'):
+                continue
+            with h5py.File(os.path.join(input_dir, h5_filename), 'r') as f:
+                if has_cvnmap(f):
+                    h5_files.append(os.path.join(input_dir, h5_filename))
+    return h5_files
+
+
+def events_in_file(f) -> int:
+    """
+    The number of events in a (preprocessed) h5 file, from the metadata only, for any cvnmap layout.
+    :param f: h5py.File, the open h5 file
+    :return: int
+    """
+    if 'cvnmap' in f:
+        return f['cvnmap'].shape[0]
+    if 'cvnmap_offsets' in f:
+        return f['cvnmap_offsets'].shape[0] - 1
+    return f['cvnmap_xz'].shape[0]
+
+
+def read_sparse_cvnmaps(f, start=0, stop=None, rows=None, out=None):
+    """
+    Read the cvnmaps of a file preprocessed with '--layout sparse', as the flat (dense) cvnmaps.
+    Only the non-zero pixels of the events wanted are read from disk.
+    :param f: h5py.File, the open preprocessed h5 file
+    :param start: int, first event to read
+    :param stop: int, one past the last event to read. None reads to the end.
+    :param rows: sorted np.array of the events to read (or a boolean mask), instead of start & stop
+    :param out: np.array [N, 16000] to decode into. None allocates it.
+    :return: np.array [N, 16000] (`out`, if given)
+    """
+    n_events = f['cvnmap_offsets'].shape[0] - 1
+    if rows is not None:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        if len(rows) == 0:
+            return np.zeros((0, 16000), dtype=f['cvnmap_value'].dtype) if out is None else out
+        start, stop = int(rows[0]), int(rows[-1]) + 1
+        rows = rows - start
+    stop = n_events if stop is None else min(stop, n_events)
+    offsets = f['cvnmap_offsets'][start:stop + 1]
+    indices = f['cvnmap_index'][offsets[0]:offsets[-1]]
+    values = f['cvnmap_value'][offsets[0]:offsets[-1]]
+    return dp.densify_sparse_cvnmaps(offsets, indices, values, rows, out=out)
+
+
+def read_rows(dset, rows, max_gap=0, out=None):
     """
-    :param path_to_data: the _complete_ path (works for training AND test/validation)
+    Read only the selected rows (i.e. events) of an h5 dataset.
+    The sorted rows are coalesced into contiguous hyperslabs, one read each,
+    rather than one read per row. Runs separated by <= `max_gap` unselected rows
+    are read as one hyperslab (in pieces of <= READ_THROUGH_ROWS rows), and the extra rows discarded in memory.
+    :param dset: h5py.Dataset (events first)
+    :param rows: sorted np.array of row indices (or a boolean mask)
+    :param max_gap: int, largest gap of rows to read through
+    :param out: np.array [len(rows), ...] to read into. None allocates it.
+    :return: np.array of the selected rows (`out`, if given)
+    """
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+    if out is None:
+        out = np.empty((len(rows),) + dset.shape[1:], dtype=dset.dtype)
+    if len(rows) == 0:
+        return out
+
+    # the start of each hyperslab, where the gap to the previous row is too large.
+    breaks = np.flatnonzero(np.diff(rows) > max_gap + 1) + 1
+    for run_start, run_stop in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(rows)]))):
+        first, last = rows[run_start], rows[run_stop - 1]
+        if last - first + 1 == run_stop - run_start:
+            dset.read_direct(out, np.s_[first:last + 1], np.s_[run_start:run_stop])
+        else:
+            # in pieces, so a run through a whole file (e.g. the 'contained' rows) is never all in memory twice.
+            for piece_start in range(first - first % READ_THROUGH_ROWS, last + 1, READ_THROUGH_ROWS):
+                lo, hi = run_start + np.searchsorted(rows[run_start:run_stop], [piece_start, piece_start + READ_THROUGH_ROWS])
+                if hi > lo:
+                    np.take(dset[rows[lo]:rows[hi - 1] + 1], rows[lo:hi] - rows[lo], axis=0, out=out[lo:hi])
+    return out
+
+
+def load_catalog(path_to_data):
+    """
+    The catalog of a directory of preprocessed files (see catalog.build_catalog()), if it is up to date:
+    the same files, with the same size and modification time. Only the catalog is read, the files are not opened.
+    :param path_to_data: directory of the preprocessed files
+    :return: dict, the catalog, or None if there is none, or it is out of date
+    """
+    catalog_file = os.path.join(path_to_data, CATALOG_FILENAME)
+    if not os.path.isfile(catalog_file):
+        return None
+    with open(catalog_file, 'r', encoding='utf-8') as f:
+        catalog = json.load(f)
+    filenames = sorted(filename for filename in os.listdir(path_to_data)
+                       if filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)))
+    up_to_date = filenames == sorted([entry['file'] for entry in catalog['files']] + catalog['skipped'])
+    for entry in catalog['files'] if up_to_date else []:
+        path = os.path.join(path_to_data, entry['file'])
+        # a Zarr store is a directory, its size would mean listing every chunk.
+        if os.path.getmtime(path) != entry['mtime'] or (os.path.isfile(path) and os.path.getsize(path) != entry['size_bytes']):
+            up_to_date = False
+            break
+    if not up_to_date:
+        print(f'WARNING: {catalog_file} is out of date, not using it. Rebuild it with build_catalog.py.')
+        return None
+    return catalog
+
+
+def sample_event_offsets(path_to_data) -> (dict, int):
+    """
+    The global event ids of a sample: the events of its h5 files, in order of the (sorted) file names.
+    Only the metadata is read, or only the catalog, if the directory has an up to date one (see load_catalog()).
+    :param path_to_data: directory of the (preprocessed) h5 files, or Zarr stores
+    :return: dict of {file name: event id of its first event}, total events
+    """
+    catalog = load_catalog(path_to_data)
+    if catalog is not None:
+        return {entry['file']: entry['first_event_id'] for entry in catalog['files']}, catalog['events']
+    offsets = {}
+    total_events = 0
+    for h5_filename in sorted(os.listdir(path_to_data)):
+        if not h5_filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
+            continue
+        with open_preprocessed(os.path.join(path_to_data, h5_filename)) as f:
+            if not has_cvnmap(f):
+                continue
+            offsets[h5_filename] = total_events
+            total_events += events_in_file(f)
+    return offsets, total_events
+
+
+def selected_event_ids(events, n_events) -> np.array:
+    """
+    :param events: the events to read (see load_data()): a slice, a boolean mask of the sample's events, or an array of event ids
+    :param n_events: int, events in the sample
+    :return: sorted np.array of the unique global event ids selected
+    """
+    if isinstance(events, slice):
+        return np.sort(np.arange(*events.indices(n_events)))
+    events = np.asarray(events)
+    if events.dtype == bool:
+        if len(events) != n_events:
+            raise ValueError(f'The mask of the events is of {len(events)} events, the sample has {n_events}.')
+        return np.flatnonzero(events)
+    event_ids = np.unique(events.astype(np.int64))
+    if len(event_ids) and (event_ids[0] < 0 or event_ids[-1] >= n_events):
+        raise IndexError(f'Event ids out of range for {n_events} events.')
+    return event_ids
+
+
+def select_file_rows(f, first_event_id, contained_only=False, event_ids=None):
+    """
+    The rows of a preprocessed file to read, of the selected events and/or those inside the cvnmap.
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :param first_event_id: int, the global event id of its first event
+    :param contained_only: only the events with the vertex inside the cvnmap (the 'contained' mask, if in the file)
+    :param event_ids: sorted np.array of the global event ids to read, see selected_event_ids(). None reads every event.
+    :return: sorted np.array of the rows, or None for every row
+    """
+    rows = None
+    if event_ids is not None:
+        first, stop = np.searchsorted(event_ids, [first_event_id, first_event_id + events_in_file(f)])
+        rows = event_ids[first:stop] - first_event_id
+        if len(rows) == 0:
+            return rows
+    if contained_only:
+        if 'contained' in f:
+            contained = f['contained'][:]
+            rows = np.flatnonzero(contained) if rows is None else rows[contained[rows]]
+        else:
+            print("WARNING: no 'contained' mask in this file, reading all events.")
+    return rows
+
+
+def load_npy_data(path_to_data, contained_only=False, mmap_mode='r', keys=None, events=None):
+    """
+    Open the .npy columns exported with npy_export.export_npy() as memory maps: nothing is read or copied here,
+    the pages are read from disk (or the OS page cache, shared by all jobs on the node) as they are used.
+    Same return as load_data(), i.e. each column is a list of one (memory-mapped) array.
+    :param path_to_data: directory of the .npy columns and the schema
+    :param contained_only: only the events with the vertex inside the cvnmap. If the export was not
+                           already contained only, these events are copied into memory.
+    :param mmap_mode: np.load() memory map mode, 'r' (read only) or 'c' (copy on write)
+    :param keys: list of the columns to open (default: all of them), see load_data()
+    :param events: the events to read (default: all of them), see load_data(). These are copied into memory too.
+    :return: datasets dictionary (of all relevant Vars), event count, file count (1)
+    """
+    with open(os.path.join(path_to_data, NPY_SCHEMA_FILENAME), 'r', encoding='utf-8') as f:
+        schema = json.load(f)
+    print(f"Memory mapping {len(schema['columns'])} .npy columns of {schema['events']} events: {list(schema['columns'])}")
+
+    rows = None
+    if contained_only and not schema['contained_only']:
+        if 'contained' in schema['columns']:
+            rows = np.flatnonzero(np.load(os.path.join(path_to_data, schema['columns']['contained']['file'])))
+            print(f"reading the {len(rows)} of {schema['events']} events inside the cvnmap (copied into memory)")
+        else:
+            print("WARNING: no 'contained' mask in this export, reading all events.")
+    if events is not None:
+        event_ids = selected_event_ids(events, schema.get('sample_events', schema['events']))
+        if 'event_id' in schema['columns']:
+            # the export may be contained only, so find the selected ids in its (sorted) event ids.
+            event_id = np.load(os.path.join(path_to_data, schema['columns']['event_id']['file']), mmap_mode=mmap_mode)
+            selected = np.searchsorted(event_id, event_ids)
+            selected = selected[(selected < len(event_id)) & (event_id[np.minimum(selected, len(event_id) - 1)] == event_ids)]
+        elif not schema['contained_only']:
+            # an export of every event (without the event ids): the rows are the event ids.
+            selected = event_ids
+        else:
+            raise ValueError(f'No event ids in {path_to_data} to select the events by, export it again.')
+        rows = selected if rows is None else np.intersect1d(rows, selected)
+        print(f"reading the {len(rows)} selected events (copied into memory)")
+
+    datasets = {}
+    for key, column in schema['columns'].items():
+        if key == 'contained' or (keys is not None and key not in keys and key != 'event_id'):
+            continue
+        data = np.load(os.path.join(path_to_data, column['file']), mmap_mode=mmap_mode)
+        datasets[key] = [data if rows is None else data[rows]]
+    total_events = schema['events'] if rows is None else len(rows)
+    print('Loaded 1 .npy export, and {} total events.'.format(total_events), flush=True)
+    return datasets, total_events, 1
+
+
+def load_data_contiguous(path_to_data, h5_filenames, event_offsets, source_keys, contained_only=False, single_file=False,
+                         event_ids=None):
+    """
+    The reading of load_data(..., contiguous=True): each column is allocated once, for the events of all the files,
+    and each file is read straight into its part of it (h5py read_direct, or the Zarr chunks decompressed into it).
+    Only the metadata (and the 'contained' masks) are read first, for the events of each file and the shape & type of each column.
+    So the peak memory is the size of the returned arrays, plus the read of one column of one file for
+    the sparse pixels, the Zarr arrays read with `contained_only`, and the columns with a different type in some files.
+    :param path_to_data: directory of the preprocessed files (or of the single file)
+    :param h5_filenames: list of the file names in `path_to_data` to read, in order
+    :param event_offsets: dict of {file name: event id of its first event}, see sample_event_offsets()
+    :param source_keys: dict of {key: dataset read for it}, see load_data()
+    :param contained_only: read only the events with the vertex inside the cvnmap
+    :param single_file: `h5_filenames` is a single file, e.g. a virtual dataset file
+    :param event_ids: sorted np.array of the global event ids to read, see selected_event_ids(). None reads every event.
+    :return: same as load_data(), with each column one np.array of all the files
+    """
+    # the metadata only: the rows of each file, and the (event) shape & type of each column in it.
+    file_rows = {}
+    events_per_file = {}
+    columns = {key: [] for key in source_keys}
+    for h5_filename in h5_filenames:
+        if not h5_filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
+            print('Skipping this file or dir:', h5_filename)
+            continue
+        with open_preprocessed(os.path.join(path_to_data, h5_filename)) as f:
+            if not has_cvnmap(f, include_virtual=single_file):
+                # e.g. the index of the shards, or a metadata sidecar.
+                print('No cvnmap in this file, skipping:', h5_filename)
+                continue
+            downsampled = [source_key for key, source_key in source_keys.items() if source_key != key and source_key not in f]
+            if downsampled:
+                raise ValueError(f"No {downsampled} in {h5_filename}, preprocess with '--pyramid'.")
+            rows = select_file_rows(f, event_offsets[h5_filename], contained_only, event_ids)
+            if rows is not None and len(rows) == 0:
+                print('No events selected in this file, skipping:', h5_filename)
+                continue
+            file_rows[h5_filename] = rows
+            events_per_file[h5_filename] = events_in_file(f) if rows is None else len(rows)
+            for key, source_key in source_keys.items():
+                if key == 'event_id':
+                    columns[key].append(((), np.dtype(np.int64)))
+                elif key == 'cvnmap' and 'cvnmap_offsets' in f:
+                    columns[key].append(((16000,), np.dtype(f['cvnmap_value'].dtype)))
+                elif source_key in f:
+                    columns[key].append((tuple(f[source_key].shape[1:]), np.dtype(f[source_key].dtype)))
+    total_files = len(events_per_file)
+    total_events = sum(events_per_file.values())
+
+    # one array per column, of the keys in (all of) the files.
+    datasets = {}
+    for key, column in columns.items():
+        if not column or len(column) != total_files:
+            if column:
+                print(f'WARNING: {key} is only in {len(column)} of {total_files} files. Not loading it.')
+            continue
+        if len({shape for shape, _ in column}) > 1:
+            raise ValueError(f'{key} has a different shape in some files: {sorted({shape for shape, _ in column})}')
+        datasets[key] = np.empty((total_events,) + column[0][0], dtype=np.result_type(*[dtype for _, dtype in column]))
+    print(f'Allocated {sum(data.nbytes for data in datasets.values()) / 1024 ** 3:.2f} GB for {total_events} events '
+          f'of {total_files} files: {list(datasets)}', flush=True)
+
+    first_event = 0
+    for file_number, h5_filename in enumerate(events_per_file):
+        print(f'Processing... {file_number} of {total_files}', end="\r", flush=True)
+        print('file: ', h5_filename)
+        rows = file_rows[h5_filename]
+        stop = first_event + events_per_file[h5_filename]
+        with open_preprocessed(os.path.join(path_to_data, h5_filename)) as f:
+            for key, data in datasets.items():
+                out = data[first_event:stop]
+                if key == 'event_id':
+                    out[:] = event_offsets[h5_filename] + (np.arange(len(out)) if rows is None else rows)
+                elif key == 'cvnmap' and 'cvnmap_offsets' in f:
+                    # preprocessed with '--layout sparse', densify the pixels straight into the flat cvnmaps.
+                    if f['cvnmap_value'].dtype == data.dtype:
+                        read_sparse_cvnmaps(f, rows=rows, out=out)
+                    else:
+                        out[:] = read_sparse_cvnmaps(f, rows=rows)
+                elif f[source_keys[key]].dtype == data.dtype:
+                    read_dataset(f[source_keys[key]], rows, out=out)
+                else:
+                    # e.g. the unsigned firstcellx of a file preprocessed before the others.
+                    out[:] = read_dataset(f[source_keys[key]], rows)
+        print('events in file: ', events_per_file[h5_filename])
+        first_event = stop
+
+    print('total events: ', total_events)
+    print('Files read successfully.')
+    print('Loaded {} files, and {} total events.'.format(total_files, total_events), flush=True)
+    return datasets, total_events, total_files
+
+
+def load_data(path_to_data, load_elasticarms = False, contained_only=False, files=None, resolution=1, contiguous=False,
+              keys=None, events=None):
+    """
+    :param path_to_data: the _complete_ path (works for training AND test/validation),
+                         or a single h5 file, e.g. the virtual dataset file of a sample (see vds.py)
     :param load_elasticarms: include E.A. info in dataset to load
-    :return: datasets dictionary (of all relevant Vars), file count, event count
-    """
-    datasets = {
-        "cvnmap": [],
-        "vtx.x": [],
-        "vtx.y": [],
-        "vtx.z": [],
-        "firstcellx": [],
-        "firstcelly": [],
-        "firstplane": []
-    }
+    :param contained_only: read only the events with the vertex inside the cvnmap,
+                           for files preprocessed with '--containment mask'.
+    :param files: list of the h5 file names in `path_to_data` to read, in order (default: all of them),
+                  e.g. some of the shards of a sample (see shards.shard_files()).
+    :param resolution: int, 1 for the full 100x80 cvnmaps, or a factor the files were preprocessed with '--pyramid',
+                       to load the downsampled views (as 'cvnmap_xz' and 'cvnmap_yz', (N, 100 / factor, 80 / factor))
+                       and the labels in the downsampled pixel map coordinates (as 'vtx_{x,y,z}_pixelmap').
+    :param contiguous: return each column as one np.array of all the files, not a list of one array per file.
+                       Each column is allocated once and filled file by file (see load_data_contiguous()),
+                       so the peak memory is ~the size of the arrays returned, not several times it.
+    :param keys: list of the keys to read (default: those below), e.g. only the labels, so no cvnmap is decompressed.
+                 Any dataset of the files can be asked for. 'event_id' is always included.
+    :param events: the events to read (default: all of them), by global event id (see 'event_id'): a slice (e.g. slice(0, 10000),
+                   the first 10000 events of the sample), a boolean mask of the sample's events, or an array of event ids.
+                   With contained_only, those of them inside the cvnmap. Only the hyperslabs of these events are read,
+                   and the files without any are skipped. The events are returned in order of their event id.
+    :return: datasets dictionary (of all relevant Vars), file count, event count.
+             The files are read in order of their (sorted) names, and 'event_id' is the global id
+             of each event in the sample (see sample_event_offsets()), which doesn't change with contained_only or `files`.
+             If the files were preprocessed with --bake_labels, the signed firstcell{x,y}, firstplane
+             and the vtx_{x,y,z}_pixelmap labels are included -- no need to clean or convert them.
+             If the files were preprocessed with '--layout views', 'cvnmap_xz' and 'cvnmap_yz'
+             (N, 100, 80) are included instead of 'cvnmap'.
+             If the files were preprocessed with '--layout sparse', the 'cvnmap' is densified when read.
+             Zarr stores (files preprocessed with '--backend zarr') are read like the h5 files,
+             with the chunks decompressed in parallel threads.
+             If `path_to_data` is an .npy export (see npy_export.export_npy()), the columns are memory mapped,
+             see load_npy_data().
+    """
+    if os.path.exists(os.path.join(path_to_data, NPY_SCHEMA_FILENAME)):
+        datasets, total_events, total_files = load_npy_data(path_to_data, contained_only, keys=keys, events=events)
+        if contiguous:
+            # already one (memory-mapped) array per column.
+            datasets = {key: column[0] for key, column in datasets.items()}
+        return datasets, total_events, total_files
+
+    if keys is not None:
+        datasets = {key: [] for key in list(keys) + ['event_id']}
+    else:
+        datasets = {
+            "cvnmap": [],
+            "vtx.x": [],
+            "vtx.y": [],
+            "vtx.z": [],
+            "firstcellx": [],
+            "firstcelly": [],
+            "firstplane": [],
+            # only in files preprocessed with --bake_labels
+            "vtx_x_pixelmap": [],
+            "vtx_y_pixelmap": [],
+            "vtx_z_pixelmap": [],
+            # only in files preprocessed with '--layout views', instead of 'cvnmap'
+            "cvnmap_xz": [],
+            "cvnmap_yz": [],
+            # the global id of each event, e.g. to look up the train/val/test split of the sample
+            "event_id": []
+        }
     if load_elasticarms:
         print('adding E.A. info to \'datasets\'...')
         datasets["vtxEA.x"] = []
         datasets["vtxEA.y"] = []
         datasets["vtxEA.z"] = []
 
+    # the dataset read for each key: the same, or its downsampled version.
+    source_keys = {key: key for key in datasets}
+    if resolution != 1:
+        print(f'Loading the views & labels downsampled by {resolution}...')
+        datasets.pop('cvnmap', None)
+        for key in ['cvnmap_xz', 'cvnmap_yz', 'vtx_x_pixelmap', 'vtx_y_pixelmap', 'vtx_z_pixelmap']:
+            if key in datasets:
+                source_keys[key] = f'{key}_{resolution}x'
+
     total_files = 0
     total_events = 0
+    single_file = os.path.isfile(path_to_data) or utils.zarr_store.is_zarr(path_to_data)
+    if single_file:
+        # one file, its events are the whole sample.
+        path_to_data, h5_filenames = os.path.split(os.path.normpath(path_to_data))
+        h5_filenames = [h5_filenames]
+        event_offsets = {h5_filenames[0]: 0}
+        with open_preprocessed(os.path.join(path_to_data, h5_filenames[0])) as f:
+            sample_events = events_in_file(f)
+    else:
+        h5_filenames = sorted(os.listdir(path_to_data)) if files is None else files
+        event_offsets, sample_events = sample_event_offsets(path_to_data)
+    event_ids = None
+    if events is not None:
+        event_ids = selected_event_ids(events, sample_events)
+        print(f'Reading {len(event_ids)} of the {sample_events} events of the sample.')
+    if contiguous:
+        return load_data_contiguous(path_to_data, h5_filenames, event_offsets,
+                                    {key: source_keys[key] for key in datasets}, contained_only, single_file, event_ids)
     # Process each file
-    for h5_filename in os.listdir(path_to_data):
-        if not h5_filename.endswith('.h5'):
+    for h5_filename in h5_filenames:
+        if not h5_filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
             print('Skipping this file or dir:', h5_filename)
             continue
 
-        print(f'Processing... {total_files} of {len(os.listdir(path_to_data))}', end="\r", flush=True)
+        print(f'Processing... {total_files} of {len(h5_filenames)}', end="\r", flush=True)
         print('file: ', h5_filename)
 
-        with h5py.File(os.path.join(path_to_data, h5_filename), 'r') as f:
+        with open_preprocessed(os.path.join(path_to_data, h5_filename)) as f:
+            if not has_cvnmap(f, include_virtual=single_file):
+                # e.g. the index of the shards, or a metadata sidecar.
+                print('No cvnmap in this file, skipping:', h5_filename)
+                continue
             if total_files == 0:
                 print('Keys in the file:', list(f.keys()))
+            if any(source_key != key and source_key not in f for key, source_key in source_keys.items()):
+                raise ValueError(f"No views downsampled by {resolution} in {h5_filename}, preprocess with '--pyramid {resolution}'.")
 
-            events_per_file_validation = len(f['cvnmap'][:])
+            # from the metadata, not by reading the cvnmaps.
+            events_per_file_validation = events_in_file(f)
+
+            # the events to read, if only some (or only those inside the cvnmap) are wanted.
+            rows = select_file_rows(f, event_offsets[h5_filename], contained_only, event_ids)
+            if rows is not None:
+                if len(rows) == 0:
+                    print('No events selected in this file, skipping:', h5_filename)
+                    continue
+                print(f"reading the {len(rows)} of {events_per_file_validation} events selected")
+                events_per_file_validation = len(rows)
 
             # Loop over each dataset and append the data
             for key in datasets:
-                if key in f:
-                    datasets[key].append(f[key][:])
+                if key == 'event_id':
+                    n_events = events_in_file(f)
+                    datasets[key].append(event_offsets[h5_filename] + (np.arange(n_events) if rows is None else rows))
+                elif key == 'cvnmap' and 'cvnmap_offsets' in f:
+                    # preprocessed with '--layout sparse', densify the pixels back into the flat cvnmap.
+                    datasets[key].append(read_sparse_cvnmaps(f, rows=rows))
+                elif source_keys[key] in f:
+                    datasets[key].append(read_dataset(f[source_keys[key]], rows))
 
             total_events += events_per_file_validation
             print('events in file: ', events_per_file_validation)
@@ -64,11 +614,350 @@ def load_data(path_to_data, load_elasticarms = False):
 
     print('total events: ', total_events)
 
+    # drop the keys not in (all of) the files, e.g. the pixel map labels of files preprocessed without them.
+    for key in list(datasets):
+        if len(datasets[key]) != total_files:
+            if datasets[key]:
+                print(f'WARNING: {key} is only in {len(datasets[key])} of {total_files} files. Not loading it.')
+            del datasets[key]
+
     print('Files read successfully.')
     print('Loaded {} files, and {} total events.'.format(total_files, total_events), flush=True)
     return datasets, total_events, total_files
 
 
+class VertexColumn:
+    """
+    One key of a VertexDataset, indexed by the global event number: column[rows] reads only those rows.
+    """
+    def __init__(self, dataset, key):
+        """
+        :param dataset: VertexDataset
+        :param key: str, dataset name (see VertexDataset.keys())
+        """
+        self.dataset = dataset
+        self.key = key
+        self.shape, self.dtype = dataset.event_shape(key)
+        self.shape = (len(dataset),) + self.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.dataset.read(self.key, index)
+
+    def __array__(self, dtype=None, copy=None):
+        # the column is read from the files into a new array, so there is nothing to view without a copy.
+        if copy is False:
+            raise ValueError(f'{self.key} is read from the files, it can not be converted to an array without a copy.')
+        data = self.dataset.read(self.key, slice(None))
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+class VertexDataset:
+    """
+    The events of a sample -- a directory of preprocessed files (h5 or Zarr, in any layout), or a single file (e.g. the VDS) --
+    indexed globally, without reading them: only the event count of each file (and the 'contained' masks) is read up front.
+    ds[key][rows] then reads only the rows asked for, from each file they are in, e.g.
+        ds = VertexDataset(path, contained_only=True)
+        labels = ds['vtx_x_pixelmap'][:]
+        maps = ds['cvnmap_xz'][batch_rows]
+    The rows are the position of the events in the dataset (i.e. after `contained_only` & `files`),
+    'event_id' is the global id of each event in the sample, the same as from load_data().
+    """
+    def __init__(self, path_to_data, files=None, contained_only=False, resolution=1):
+        """
+        :param path_to_data: directory of the preprocessed files, or a single file (e.g. the VDS file of a sample)
+        :param files: list of the file names in `path_to_data`, in order (default: all of them)
+        :param contained_only: only the events with the vertex inside the cvnmap ('--containment mask' files)
+        :param resolution: int, 1, or a factor the files were preprocessed with '--pyramid' (see load_data())
+        """
+        single_file = os.path.isfile(path_to_data) or utils.zarr_store.is_zarr(path_to_data)
+        if single_file:
+            path_to_data, filename = os.path.split(os.path.normpath(path_to_data))
+            filenames = [filename]
+            event_offsets = {filename: 0}
+        else:
+            filenames = sorted(os.listdir(path_to_data)) if files is None else files
+            event_offsets, _ = sample_event_offsets(path_to_data)
+
+        self.paths = []
+        # the event id of the first event of each file, and the rows of each file (None = all of them).
+        self.event_id_offsets = []
+        self.file_rows = []
+        events_per_file = []
+        keys = None
+        for filename in filenames:
+            if not filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
+                continue
+            with open_preprocessed(os.path.join(path_to_data, filename)) as f:
+                if not has_cvnmap(f, include_virtual=single_file):
+                    continue
+                rows = None
+                if contained_only and 'contained' in f:
+                    rows = np.flatnonzero(f['contained'][:])
+                elif contained_only:
+                    print(f"WARNING: no 'contained' mask in {filename}, reading all events.")
+                n_events = events_in_file(f)
+                # the datasets of one row per event (not e.g. the sparse pixels, or the list of files of the VDS).
+                file_keys = {key for key in f.keys() if getattr(f[key], 'shape', ())[:1] == (n_events,)}
+                if 'cvnmap_offsets' in f:
+                    file_keys.add('cvnmap')
+                if 'cvnmap' in file_keys:
+                    # the views are split from the flat (or sparse) cvnmap when read.
+                    file_keys.update(['cvnmap_xz', 'cvnmap_yz'])
+                keys = file_keys if keys is None else keys & file_keys
+                events_per_file.append(n_events if rows is None else len(rows))
+            self.paths.append(os.path.join(path_to_data, filename))
+            self.event_id_offsets.append(event_offsets.get(filename, 0))
+            self.file_rows.append(rows)
+        if not self.paths:
+            raise ValueError(f'No preprocessed files in {path_to_data}.')
+        self.offsets = np.concatenate(([0], np.cumsum(events_per_file))).astype(np.int64)
+
+        # the dataset read for each key: the same, or its downsampled version.
+        self.source_keys = {key: key for key in keys}
+        self.source_keys['event_id'] = 'event_id'
+        if resolution != 1:
+            for key in ['cvnmap_xz', 'cvnmap_yz', 'vtx_x_pixelmap', 'vtx_y_pixelmap', 'vtx_z_pixelmap']:
+                if f'{key}_{resolution}x' not in keys:
+                    raise ValueError(f"No {key} downsampled by {resolution}, preprocess with '--pyramid {resolution}'.")
+                self.source_keys[key] = f'{key}_{resolution}x'
+            self.source_keys.pop('cvnmap', None)
+        self.open_files = {}
+        print(f'{len(self)} events in {len(self.paths)} files, keys: {self.keys()}')
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key) -> VertexColumn:
+        if key not in self.source_keys:
+            raise KeyError(f'{key} is not in (all of) the files. Keys: {self.keys()}')
+        return VertexColumn(self, key)
+
+    def __contains__(self, key):
+        return key in self.source_keys
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keys(self) -> list:
+        """
+        :return: sorted list of the keys in every file (and 'event_id')
+        """
+        return sorted(self.source_keys)
+
+    def file(self, file_number):
+        """
+        :param file_number: int, index of the file in self.paths
+        :return: the open h5py.File or zarr.Group, kept open for the next reads
+        """
+        if file_number not in self.open_files:
+            self.open_files[file_number] = open_preprocessed(self.paths[file_number])
+        return self.open_files[file_number]
+
+    def close(self) -> None:
+        """
+        Close the files opened by the reads.
+        :return: None
+        """
+        for f in self.open_files.values():
+            if isinstance(f, h5py.File):
+                f.close()
+        self.open_files = {}
+        return None
+
+    def event_shape(self, key) -> tuple:
+        """
+        :param key: str, one of keys()
+        :return: (shape of one event, dtype) of the key, from the first file
+        """
+        if key == 'event_id':
+            return (), np.dtype(np.int64)
+        f = self.file(0)
+        source_key = self.source_keys[key]
+        if source_key in f:
+            return tuple(f[source_key].shape[1:]), np.dtype(f[source_key].dtype)
+        dtype = np.dtype(f['cvnmap_value' if 'cvnmap_offsets' in f else 'cvnmap'].dtype)
+        return ((16000,) if key == 'cvnmap' else (100, 80)), dtype
+
+    def locate(self, rows) -> (np.array, np.array):
+        """
+        :param rows: np.array of int, positions in the dataset
+        :return: (the file number of each row, its row in that file)
+        """
+        file_numbers = np.searchsorted(self.offsets, rows, side='right') - 1
+        file_rows = rows - self.offsets[file_numbers]
+        for file_number in np.unique(file_numbers):
+            if self.file_rows[file_number] is not None:
+                in_file = file_numbers == file_number
+                file_rows[in_file] = self.file_rows[file_number][file_rows[in_file]]
+        return file_numbers, file_rows
+
+    def read_file(self, file_number, key, rows) -> np.array:
+        """
+        :param file_number: int, index of the file in self.paths
+        :param key: str, one of keys()
+        :param rows: sorted np.array of unique rows of the file
+        :return: np.array of those rows
+        """
+        if key == 'event_id':
+            return self.event_id_offsets[file_number] + rows
+        f = self.file(file_number)
+        source_key = self.source_keys[key]
+        if source_key in f:
+            return read_dataset(f[source_key], rows)
+        # the cvnmap of a '--layout sparse' file, or a view split from the flat (or sparse) cvnmap.
+        maps = read_sparse_cvnmaps(f, rows=rows) if 'cvnmap_offsets' in f else read_dataset(f['cvnmap'], rows)
+        if key == 'cvnmap':
+            return maps
+        return np.ascontiguousarray(dp.split_cvnmap_views(maps)[['cvnmap_xz', 'cvnmap_yz'].index(key)])
+
+    def read(self, key, index) -> np.array:
+        """
+        Read the rows of a key, from each file they are in. Each file is read once, in order of its rows.
+        :param key: str, one of keys()
+        :param index: int, slice, np.array of int (any order, repeats allowed), or a boolean mask
+        :return: np.array, in the order of `index`
+        """
+        if key not in self.source_keys:
+            raise KeyError(f'{key} is not in (all of) the files. Keys: {self.keys()}')
+        if isinstance(index, slice):
+            rows = np.arange(*index.indices(len(self)))
+        else:
+            rows = np.asarray(index)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            rows = np.where(rows < 0, rows + len(self), rows).astype(np.int64)
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError(f'index out of range for {len(self)} events')
+        single_row = rows.ndim == 0
+        rows = rows.reshape(-1)
+
+        event_shape, dtype = self.event_shape(key)
+        out = np.empty((len(rows),) + event_shape, dtype=dtype)
+        file_numbers, file_rows = self.locate(rows)
+        for file_number in np.unique(file_numbers):
+            in_file = np.flatnonzero(file_numbers == file_number)
+            unique_rows, inverse = np.unique(file_rows[in_file], return_inverse=True)
+            out[in_file] = self.read_file(file_number, key, unique_rows)[inverse.reshape(-1)]
+        return out[0] if single_row else out
+
+
+def file_pixelmap_labels(f) -> dict:
+    """
+    The signed first hits, and the true vertex in pixel map coordinates, of every event of a preprocessed file:
+    from the file if preprocessed with --bake_labels, else converted here (as the training does).
+    Only the scalar columns are read.
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :return: dict of {'firstcellx', 'firstcelly', 'firstplane': np.array [N] of signed ints, 'vtx': np.array [N, 3] float32}
+    """
+    first_hit_keys = {'x': 'firstcellx', 'y': 'firstcelly', 'z': 'firstplane'}
+    labels = {}
+    vtx = []
+    for coordinate, first_hit_key in first_hit_keys.items():
+        if f'vtx_{coordinate}_pixelmap' in f:
+            labels[first_hit_key] = read_dataset(f[first_hit_key])
+            vtx.append(read_dataset(f[f'vtx_{coordinate}_pixelmap']))
+        else:
+            labels[first_hit_key] = dp.remove_unsigned_ints_array(read_dataset(f[first_hit_key]))
+            vtx.append(dp.ConvertFarDetCoords('fd', coordinate).convert_fd_vtx_to_pixelmap(
+                read_dataset(f[f'vtx.{coordinate}']), labels[first_hit_key]))
+    labels['vtx'] = np.stack(vtx, axis=-1).astype(np.float32)
+    return labels
+
+
+def read_batch(f, rows, labels, keys=(), first_event_id=0) -> dict:
+    """
+    Read the events of a batch: the XZ and YZ views (for any cvnmap layout), ready for the model, and their labels.
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :param rows: sorted np.array of the rows of the file to read
+    :param labels: dict, from file_pixelmap_labels()
+    :param keys: the other keys to read. The first hits are the signed ones of `labels`.
+    :param first_event_id: int, the global event id of the first event of the file
+    :return: dict of {'xz', 'yz': np.array [B, 100, 80, 1], 'vtx': np.array [B, 3], 'event_id': np.array [B], and `keys`}
+    """
+    if 'cvnmap_xz' in f:
+        # preprocessed with '--layout views'.
+        cvnmap_xz, cvnmap_yz = read_dataset(f['cvnmap_xz'], rows), read_dataset(f['cvnmap_yz'], rows)
+    else:
+        maps = read_sparse_cvnmaps(f, rows=rows) if 'cvnmap_offsets' in f else read_dataset(f['cvnmap'], rows)
+        cvnmap_xz, cvnmap_yz = [np.ascontiguousarray(view) for view in dp.split_cvnmap_views(maps)]
+    batch = {'xz': cvnmap_xz[..., np.newaxis],
+             'yz': cvnmap_yz[..., np.newaxis],
+             'vtx': labels['vtx'][rows],
+             'event_id': first_event_id + rows}
+    for key in keys:
+        if key in labels:
+            batch[key] = labels[key][rows]
+        elif key in f:
+            batch[key] = read_dataset(f[key], rows)
+        else:
+            raise KeyError(f'{key} is not in (all of) the files.')
+    return batch
+
+
+def iter_batches(path_to_data, batch_size=1024, keys=(), shuffle_files=False, drop_outside_map=True, seed=None, files=None):
+    """
+    Stream the events of a sample in batches ready for the model, file by file, and batch by batch within a file:
+    the memory is ~one batch of cvnmaps (and the scalar columns of one file), however many files, e.g.
+        for batch in io.iter_batches(path, 1024, keys=['vtx.x', 'firstcellx']):
+            pred = model.predict_on_batch([batch['xz'], batch['yz']])
+    Every batch has `batch_size` events but the last: a batch at the end of a file is filled from the next one.
+    :param path_to_data: directory of the preprocessed files (h5 or Zarr, in any layout), or a single file (e.g. the VDS)
+    :param batch_size: int, events per batch
+    :param keys: list of the other keys to include in each batch, e.g. the truth & the first hits, to convert the predictions back.
+                 'firstcellx', 'firstcelly' and 'firstplane' are the signed ones.
+    :param shuffle_files: read the files in a random order (of `seed`), not in order of their names. The events of each file stay in order.
+    :param drop_outside_map: skip the events with the vertex outside the cvnmap (as the training does). They are never read.
+    :param seed: int, seed of the order of the files (with `shuffle_files`)
+    :param files: list of the file names in `path_to_data` to read (default: all of them)
+    :yield: dict of {'xz', 'yz': np.array [B, 100, 80, 1] (same type as the cvnmaps), 'vtx': np.array [B, 3] float32,
+            the true vertex in pixel map coordinates, 'event_id': np.array [B], the global id of each event, and each of `keys`}
+    """
+    single_file = os.path.isfile(path_to_data) or utils.zarr_store.is_zarr(path_to_data)
+    if single_file:
+        path_to_data, filename = os.path.split(os.path.normpath(path_to_data))
+        filenames = [filename]
+        event_offsets = {filename: 0}
+    else:
+        filenames = sorted(os.listdir(path_to_data)) if files is None else list(files)
+        event_offsets, _ = sample_event_offsets(path_to_data)
+    if shuffle_files:
+        np.random.default_rng(seed).shuffle(filenames)
+
+    # the end of a file, to fill from the next one.
+    pending = None
+    for filename in filenames:
+        if not filename.endswith(('.h5', utils.zarr_store.ZARR_SUFFIX)):
+            continue
+        with open_preprocessed(os.path.join(path_to_data, filename)) as f:
+            if not has_cvnmap(f, include_virtual=single_file):
+                continue
+            labels = file_pixelmap_labels(f)
+            rows = np.arange(len(labels['vtx']))
+            if drop_outside_map:
+                rows = np.flatnonzero(dp.contained_in_cvnmap(labels['vtx']))
+            print(f'file: {filename}, streaming {len(rows)} of {len(labels["vtx"])} events')
+            start = 0
+            while start < len(rows):
+                n_events = batch_size if pending is None else batch_size - len(pending['event_id'])
+                batch = read_batch(f, rows[start:start + n_events], labels, keys, event_offsets.get(filename, 0))
+                start += n_events
+                if pending is not None:
+                    batch = {key: np.concatenate((pending[key], batch[key])) for key in batch}
+                    pending = None
+                if len(batch['event_id']) < batch_size:
+                    pending = batch
+                else:
+                    yield batch
+    if pending is not None:
+        yield pending
+
+
 class IOManager:
     def __init__(self, filename_stub):
         self.filename_stub = filename_stub
@@ -0,0 +1,53 @@
+# metadata.py
+# Tools to write the per-event truth & reco scalars of the preprocessed events into a small sidecar h5 file,
+# so the analysis reads them without opening the trimmed files (or the cvnmaps).
+
+import os
+
+import h5py
+import numpy as np
+
+import utils.atomic
+
+# the per-event truth & reco scalars for the analysis, written to a small sidecar (see metadata_filename()).
+METADATA_KEYS = ['E', 'pdg', 'interaction', 'iscc', 'mode', 'ncid', 'finalstate',
+                 'p.px', 'p.py', 'p.pz', 'vtxEA.x', 'vtxEA.y', 'vtxEA.z']
+
+
+def metadata_filename(out_file) -> str:
+    """
+    :param out_file: full path to the preprocessed h5 file
+    :return: full path to its metadata sidecar (the METADATA_KEYS of each event, no cvnmaps)
+    """
+    return os.path.splitext(out_file)[0] + '.metadata.h5'
+
+
+def write_metadata_sidecar(f_in, metadata_file, input_rows, contained=None, storage_kwargs=None) -> None:
+    """
+    Write the METADATA_KEYS (the truth & reco scalars the analysis reads) of the events written,
+    into a small h5 file next to the preprocessed file. Same dataset names as the trimmed file.
+    Written with atomic.atomic_output().
+    :param f_in: h5py.File, the open trimmed h5 file
+    :param metadata_file: full path to the metadata sidecar
+    :param input_rows: np.array, the row in the trimmed file of each event written
+    :param contained: np.array of bool, the 'contained' mask of the events written (None if not computed)
+    :param storage_kwargs: function of the shape of a dataset, returning its create_dataset() keywords,
+                           e.g. preprocess.dataset_storage_kwargs() with the compression of the file (default: uncompressed)
+    :return: None
+    """
+    with utils.atomic.atomic_output(metadata_file) as partial_file, h5py.File(partial_file, 'w') as f_meta:
+        # the row in the preprocessed file, not the global event id: that depends on the files before it in the sample
+        # (the row + their events, see iomanager.sample_event_offsets()).
+        columns = {'row': np.arange(len(input_rows)), 'input_row': input_rows}
+        if contained is not None:
+            columns['contained'] = contained
+        for key in METADATA_KEYS:
+            if key not in f_in:
+                print(f'WARNING: {key} is not in the trimmed file, not in the metadata.')
+                continue
+            columns[key] = f_in[key][:][input_rows]
+        for key, value in columns.items():
+            f_meta.create_dataset(key, data=value, **(storage_kwargs(value.shape) if storage_kwargs else {}))
+        f_meta.attrs['source_file'] = os.path.abspath(f_in.filename)
+    print(f'Metadata sidecar created: {metadata_file} ({list(columns)})')
+    return None
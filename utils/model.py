@@ -79,15 +79,35 @@ class Config:
         val = {'xz': map_val_xz, 'yz': map_val_yz, 'vtx': vtx_val}
         return train, val, test
 
+    @staticmethod
+    def create_test_train_val_sequences(map_xz, map_yz, vtx_coords, split_rows, batch_size=32, seed=101, stats=None) -> Tuple:
+        """
+        Same as create_test_train_val_datasets(), but for a split saved beforehand (see utils/splits.py):
+        the train, val and test sets are only row indices, and the batches are drawn from the single copy of the arrays.
+        :param map_xz: cvnmap for XZ view (features)
+        :param map_yz: cvnmap for YZ view (features)
+        :param vtx_coords: (x,y,z) true coordinates (labels)
+        :param split_rows: dict of {'train', 'val', 'test': np.array of rows}, from splits.split_rows()
+        :param batch_size: int (how many maps should model see)
+        :param seed: int, seed to shuffle the train set every epoch
+        :param stats: PixelStats (see utils/pixel_stats.py), to normalise each batch (None = not normalised)
+        :return: train, val, test IndexBatchSequence
+        """
+        train = IndexBatchSequence(map_xz, map_yz, vtx_coords, split_rows['train'], batch_size, shuffle=True, seed=seed, stats=stats)
+        val = IndexBatchSequence(map_xz, map_yz, vtx_coords, split_rows['val'], batch_size, stats=stats)
+        test = IndexBatchSequence(map_xz, map_yz, vtx_coords, split_rows['test'], batch_size, stats=stats)
+        return train, val, test
+
 # or assemble_model_conv_inputs() ?
     @staticmethod
-    def create_conv2d_branch_model_single_view() -> Sequential:
+    def create_conv2d_branch_model_single_view(input_shape=(100, 80, 1)) -> Sequential:
         """
         Create the branch model for the XZ or YZ view.
+        :param input_shape: shape of one view, e.g. (50, 40, 1) for the views downsampled by 2 ('--pyramid')
         :return: Sequential() model
         """
         m = Sequential([
-            Conv2D(filters=32, kernel_size=(2, 2), strides=(1, 1), activation='relu', input_shape=(100, 80, 1)),
+            Conv2D(filters=32, kernel_size=(2, 2), strides=(1, 1), activation='relu', input_shape=input_shape),
             MaxPool2D(pool_size=(2, 2)),
             Flatten(),
             Dense(256, activation='relu'),
@@ -100,8 +120,7 @@ class Config:
         return m
 
     @staticmethod
-    def assemble_model_output(model_xz, model_yz) -> Model:
-        input_shape = (100, 80, 1)
+    def assemble_model_output(model_xz, model_yz, input_shape=(100, 80, 1)) -> Model:
         input_xz = Input(shape=input_shape, name='xz')
         input_yz = Input(shape=input_shape, name='yz')
 
@@ -191,6 +210,71 @@ class Config:
         data_test = transform_single_dataset(data_test, scaler)
         return scaler, data_train, data_val, data_test
 
+    @staticmethod
+    def transform_data_with_stats(data_train, data_val, data_test, stats):
+        """
+        The per-pixel min-max scaling of transform_data(), but from precomputed pixel stats (see utils/pixel_stats.py),
+        so no fit, and no stacked copy of the training maps. Each view is scaled to float32 (not float64).
+        It is the same normalization ONLY if the stats are of the events of data_train, e.g. PixelStats().update_views()
+        of its maps, or pixel_stats.split_stats() of the same split. The stats of the preprocessing sidecars are of
+        every event written (val & test too), so they would leak the held-out events into the scaling.
+        We do NOT transform the labels, 'vtx', features only of course.
+        :param data_train: dict
+        :param data_val: dict
+        :param data_test: dict
+        :param stats: PixelStats of the training events only
+        :return: stats, data_train, data_val, data_test
+        """
+        for data in [data_train, data_val, data_test]:
+            for k in data:
+                if k != 'vtx':
+                    data[k] = stats.min_max_scale(data[k])
+        return stats, data_train, data_val, data_test
+
+class IndexBatchSequence(tf.keras.utils.Sequence):
+    """
+    Batches of ({'xz', 'yz'}, vtx) for fit() & evaluate(), drawn by row index from the resident (or memory mapped) arrays.
+    Only a batch is ever copied, never the whole train/val/test set.
+    """
+    def __init__(self, map_xz, map_yz, vtx_coords, rows, batch_size=32, shuffle=False, seed=None, stats=None):
+        """
+        :param map_xz: cvnmap for XZ view (features)
+        :param map_yz: cvnmap for YZ view (features)
+        :param vtx_coords: (x,y,z) true coordinates (labels)
+        :param rows: np.array, the rows of this set
+        :param batch_size: int
+        :param shuffle: bool, shuffle the rows every epoch (train set)
+        :param seed: int, seed of the shuffle
+        :param stats: PixelStats, to normalise each batch (None = not normalised)
+        """
+        super().__init__()
+        self.map_xz = map_xz
+        self.map_yz = map_yz
+        self.vtx_coords = vtx_coords
+        self.rows = np.array(rows)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.stats = stats
+        if self.shuffle:
+            self.rng.shuffle(self.rows)
+
+    def __len__(self):
+        return int(np.ceil(len(self.rows) / self.batch_size))
+
+    def __getitem__(self, batch):
+        # sorted, so the reads from a memory map are in order.
+        rows = np.sort(self.rows[batch * self.batch_size:(batch + 1) * self.batch_size])
+        maps = {'xz': self.map_xz[rows], 'yz': self.map_yz[rows]}
+        if self.stats is not None:
+            maps = {key: self.stats.min_max_scale(value) for key, value in maps.items()}
+        return maps, self.vtx_coords[rows]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.rows)
+
+
 def train_model(model_output,
                 data_training,
                 data_validation,
@@ -199,21 +283,29 @@ def train_model(model_output,
     """
     Perform fit() func, i.e. do the training.
     :param model_output: Model (expected output)
-    :param data_training: dict (training data, should already be divided for validation)
-    :param data_validation: dict (validation data, should already be divided)
+    :param data_training: dict (training data, should already be divided for validation), or IndexBatchSequence
+    :param data_validation: dict (validation data, should already be divided), or IndexBatchSequence
     :param epochs: int (from args.epoch)
-    :param batch_size: int (how many maps should model see)
+    :param batch_size: int (how many maps should model see). Ignored for an IndexBatchSequence, it has its own.
     :return: History.history
     """
     start = time.time()
-    history = model_output.fit(
-        x={'xz': data_training['xz'], 'yz': data_training['yz']},
-        y=data_training['vtx'],
-        epochs=epochs,
-        batch_size=batch_size,
-        validation_data=({'xz': data_validation['xz'], 'yz': data_validation['yz']}, data_validation['vtx']),
-        callbacks=Config.create_early_stop()
-    )
+    if isinstance(data_training, IndexBatchSequence):
+        history = model_output.fit(
+            data_training,
+            epochs=epochs,
+            validation_data=data_validation,
+            callbacks=Config.create_early_stop()
+        )
+    else:
+        history = model_output.fit(
+            x={'xz': data_training['xz'], 'yz': data_training['yz']},
+            y=data_training['vtx'],
+            epochs=epochs,
+            batch_size=batch_size,
+            validation_data=({'xz': data_validation['xz'], 'yz': data_validation['yz']}, data_validation['vtx']),
+            callbacks=Config.create_early_stop()
+        )
 
     stop = time.time()
     elapsed = (stop - start) / 60
@@ -224,26 +316,27 @@ def evaluate_model(model_output, data_train, data_test, evaluate_dir):
     """
     Evaluate the average loss on the model on the train AND testing data.
     :param model_output: Model (output from model)
-    :param data_train: dict (training data, should already be divided for training)
-    :param data_test: dict (test data, should already be divided for testing)
+    :param data_train: dict (training data, should already be divided for training), or IndexBatchSequence
+    :param data_test: dict (test data, should already be divided for testing), or IndexBatchSequence
     :param evaluate_dir: str (directory to save evaluation results)
     :return: evaluation: array (single values for each metric)
     """
+    def evaluate(data):
+        if isinstance(data, IndexBatchSequence):
+            return model_output.evaluate(data)
+        return model_output.evaluate(x={'xz': data['xz'], 'yz': data['yz']}, y=data['vtx'])
+
     # Training data first
     start_eval_train = time.time()
     print('Evaluation on the train set...')
-    evaluation_train = model_output.evaluate(
-        x={'xz': data_train['xz'], 'yz': data_train['yz']},
-        y=data_train['vtx'])
+    evaluation_train = evaluate(data_train)
     stop_eval = time.time()
     time_elapsed_train = stop_eval - start_eval_train
 
     # Now test data
     start_eval_test = time.time()
     print('Evaluation on the test set...')
-    evaluation_test = model_output.evaluate(
-        x={'xz': data_test['xz'], 'yz': data_test['yz']},
-        y=data_test['vtx'])
+    evaluation_test = evaluate(data_test)
     stop_eval = time.time()
     time_elapsed_test = stop_eval - start_eval_test
 
@@ -0,0 +1,93 @@
+# npy_export.py
+# Tools to export the preprocessed h5 files of a sample as raw, uncompressed .npy columns,
+# which the training memory maps (see iomanager.load_npy_data()) instead of decompressing the files.
+
+import json
+import os
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.iomanager as io
+import utils.preprocess
+
+
+def export_npy(in_files, out_dir, contained_only=False, block_size=utils.preprocess.DEFAULT_BLOCK_SIZE) -> str:
+    """
+    Export preprocessed h5 files into one uncompressed .npy file per column (dataset), all files concatenated,
+    plus a JSON schema (io.NPY_SCHEMA_FILENAME) of the columns. The .npy data is aligned (64 bytes),
+    so the columns can be opened with np.load(..., mmap_mode='r') -- i.e. paged in lazily from the OS page cache,
+    and shared by every job reading them on the same node. See iomanager.load_npy_data().
+    The sparse cvnmaps are written dense (the 'cvnmap'), the views stay as they are.
+    The 'event_id' column is the global id of each event (in order of `in_files`), as load_data() gives them.
+    The events are streamed across in blocks of `block_size` events.
+    :param in_files: list of full paths to the preprocessed h5 files (all preprocessed with the same options)
+    :param out_dir: directory to save the .npy columns and the schema
+    :param contained_only: export only the events with the vertex inside the cvnmap ('contained', from '--containment mask')
+    :param block_size: int, events copied at a time
+    :return: full path to the schema
+    """
+    if not in_files:
+        raise ValueError('No preprocessed files to export.')
+    # the columns, their shape and type, from the first file. The events from every file.
+    with h5py.File(in_files[0], 'r') as f:
+        keys = [key for key in f.keys() if key not in utils.preprocess.CVNMAP_SPARSE_KEYS]
+        if contained_only and 'contained' not in f:
+            raise ValueError(f"No 'contained' mask in {in_files[0]}, preprocess with '--containment mask'.")
+        columns = {key: (f[key].shape[1:], f[key].dtype) for key in keys}
+        if 'cvnmap_offsets' in f:
+            columns['cvnmap'] = ((16000,), f['cvnmap_value'].dtype)
+        # the global id of each event, as load_data() gives them (for the split of the sample).
+        columns['event_id'] = ((), np.dtype('int64'))
+        attrs = {key: f.attrs[key].item() if hasattr(f.attrs[key], 'item') else f.attrs[key]
+                 for key in ['labels_baked', 'layout', 'containment'] if key in f.attrs}
+    events_per_file = []
+    for in_file in in_files:
+        with h5py.File(in_file, 'r') as f:
+            events_per_file.append(int(f['contained'][:].sum()) if contained_only else io.events_in_file(f))
+    total_events = int(np.sum(events_per_file))
+    print(f'Exporting {total_events} events from {len(in_files)} files into {len(columns)} .npy columns')
+
+    npy = {key: np.lib.format.open_memmap(os.path.join(out_dir, f'{key}.npy'), mode='w+',
+                                          dtype=dtype, shape=(total_events,) + tuple(shape))
+           for key, (shape, dtype) in columns.items()}
+    out_start = 0
+    first_event_id = 0
+    for in_file in in_files:
+        print(f'exporting {in_file}')
+        with h5py.File(in_file, 'r') as f:
+            n_events = io.events_in_file(f)
+            contained = f['contained'][:] if contained_only else np.ones(n_events, dtype=bool)
+            for start, stop in utils.preprocess.iter_event_blocks(n_events, block_size):
+                keep_block = contained[start:stop]
+                n_keep = int(keep_block.sum())
+                for key in npy:
+                    if key == 'event_id':
+                        block = np.arange(first_event_id + start, first_event_id + stop)
+                    elif key == 'cvnmap' and 'cvnmap_offsets' in f:
+                        block = io.read_sparse_cvnmaps(f, start, stop)
+                    else:
+                        block = f[key][start:stop]
+                    npy[key][out_start:out_start + n_keep] = block[keep_block]
+                out_start += n_keep
+        first_event_id += n_events
+    for key in npy:
+        npy[key].flush()
+    del npy
+
+    schema = {'schema_version': utils.preprocess.SCHEMA_VERSION,
+              'events': total_events,
+              'contained_only': contained_only,
+              'columns': {key: {'file': f'{key}.npy', 'dtype': np.dtype(dtype).str, 'shape': [total_events] + list(shape)}
+                          for key, (shape, dtype) in columns.items()},
+              'source_files': [os.path.abspath(in_file) for in_file in in_files],
+              'source_events': events_per_file,
+              'sample_events': first_event_id,
+              **attrs}
+    # the schema is written last, so its presence means the export is complete.
+    schema_file = os.path.join(out_dir, io.NPY_SCHEMA_FILENAME)
+    with utils.atomic.atomic_output(schema_file) as partial_file, open(partial_file, 'w', encoding='utf-8') as f:
+        json.dump(schema, f, indent=2)
+    print('Schema created: ', schema_file)
+    return schema_file
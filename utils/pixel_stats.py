@@ -0,0 +1,197 @@
+# pixel_stats.py
+# Tools to accumulate, merge and apply the pixel intensity statistics of the cvnmaps.
+# The statistics are sums (and min/max), so those of each preprocessed file merge into those of the whole sample.
+# The training normalises from those of its training set only (see split_stats()), instead of fitting a MinMaxScaler.
+
+import os
+import time
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.iomanager as io
+import utils.splits
+
+# the cvnmap intensities are uint8.
+N_PIXELS = 16000
+N_INTENSITIES = 256
+
+# the datasets of a stats file. They are all mergeable.
+STATS_KEYS = ['count', 'min', 'max', 'sum', 'sum_sq', 'histogram']
+
+
+def stats_filename(out_file) -> str:
+    """
+    :param out_file: full path to the preprocessed h5 file (or Zarr store)
+    :return: full path to its pixel statistics sidecar
+    """
+    return os.path.splitext(out_file)[0] + '.stats.h5'
+
+
+class PixelStats:
+    """
+    Per-pixel (and global) min, max, mean and std of the cvnmap intensities, and the intensity histogram of each view.
+    Everything is kept as counts & sums, so update() with any number of blocks, and merge() any number of files.
+    """
+    def __init__(self, n_pixels=N_PIXELS):
+        """
+        :param n_pixels: int, pixels of the (flat) cvnmap, the XZ and YZ views interleaved
+        """
+        self.count = 0
+        self.min = np.full(n_pixels, np.iinfo(np.uint8).max, dtype=np.uint8)
+        self.max = np.zeros(n_pixels, dtype=np.uint8)
+        # float64 sums of uint8 are exact up to ~1e11 events.
+        self.sum = np.zeros(n_pixels, dtype=np.float64)
+        self.sum_sq = np.zeros(n_pixels, dtype=np.float64)
+        # one histogram per view (view 0 = XZ, 1 = YZ), over every pixel.
+        self.histogram = np.zeros((2, N_INTENSITIES), dtype=np.int64)
+        # the set of a split the events are, if only those (see split_stats()). '' = every event written.
+        self.split_digest = ''
+
+    def update(self, cvnmaps):
+        """
+        Add a block of events.
+        :param cvnmaps: np.array of uint8, (N, 16000) flat cvnmaps
+        :return: self
+        """
+        if len(cvnmaps) == 0:
+            return self
+        self.count += len(cvnmaps)
+        np.minimum(self.min, cvnmaps.min(axis=0), out=self.min)
+        np.maximum(self.max, cvnmaps.max(axis=0), out=self.max)
+        self.sum += cvnmaps.sum(axis=0, dtype=np.float64)
+        self.sum_sq += np.square(cvnmaps, dtype=np.float64).sum(axis=0)
+        for view in range(2):
+            self.histogram[view] += np.bincount(cvnmaps[:, view::2].reshape(-1), minlength=N_INTENSITIES)
+        return self
+
+    def update_views(self, cvnmap_xz, cvnmap_yz):
+        """
+        Add a block of events, from their XZ and YZ views (e.g. a batch of iomanager.iter_batches()).
+        :param cvnmap_xz: np.array of uint8, (N, 100, 80) or (N, 100, 80, 1) XZ views
+        :param cvnmap_yz: np.array of uint8, the YZ views, same shape
+        :return: self
+        """
+        n_events = len(cvnmap_xz)
+        cvnmaps = np.stack([cvnmap_xz.reshape(n_events, 100, 80), cvnmap_yz.reshape(n_events, 100, 80)], axis=-1)
+        return self.update(cvnmaps.reshape(n_events, -1))
+
+    def merge(self, other):
+        """
+        Add the statistics of other events (e.g. another file).
+        :param other: PixelStats
+        :return: self
+        """
+        self.count += other.count
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.histogram += other.histogram
+        return self
+
+    def mean(self) -> np.array:
+        """
+        :return: np.array, mean of each pixel
+        """
+        return self.sum / max(self.count, 1)
+
+    def std(self) -> np.array:
+        """
+        :return: np.array, standard deviation of each pixel
+        """
+        return np.sqrt(np.maximum(self.sum_sq / max(self.count, 1) - self.mean() ** 2, 0))
+
+    def global_stats(self) -> dict:
+        """
+        :return: dict of the min, max, mean and std over every pixel of every event
+        """
+        n = max(self.count * len(self.sum), 1)
+        mean = self.sum.sum() / n
+        return {'events': self.count,
+                'min': int(self.min.min()),
+                'max': int(self.max.max()),
+                'mean': mean,
+                'std': np.sqrt(max(self.sum_sq.sum() / n - mean ** 2, 0))}
+
+    def min_max_scale(self, cvnmap_view) -> np.array:
+        """
+        Scale a view to [0, 1] per pixel position, with the min & max over BOTH views
+        -- what MinMaxScaler does when fit on the XZ and YZ maps stacked together.
+        A pixel that is always the same is scaled to 0. Returns float32, never float64.
+        :param cvnmap_view: np.array, (N, 100, 80) or (N, 100, 80, 1) maps of either view
+        :return: np.array of float32, same shape
+        """
+        minimum = self.min.reshape(100, 80, 2).min(axis=-1).astype(np.float32)
+        maximum = self.max.reshape(100, 80, 2).max(axis=-1).astype(np.float32)
+        data_range = maximum - minimum
+        scale = np.divide(1, data_range, out=np.ones_like(data_range), where=data_range > 0)
+        if cvnmap_view.ndim == 4:
+            minimum, scale = minimum[..., np.newaxis], scale[..., np.newaxis]
+        scaled = np.subtract(cvnmap_view, minimum, dtype=np.float32)
+        scaled *= scale
+        return scaled
+
+    def save(self, stats_file) -> None:
+        """
+        Save into an h5 file (with atomic.atomic_output()).
+        :param stats_file: full path to the stats h5 file
+        :return: None
+        """
+        with utils.atomic.atomic_output(stats_file) as partial_file, h5py.File(partial_file, 'w') as f:
+            f.create_dataset('count', data=self.count)
+            for key in STATS_KEYS[1:]:
+                f.create_dataset(key, data=getattr(self, key), compression='gzip')
+            for key, value in self.global_stats().items():
+                f.attrs[f'global_{key}'] = value
+            f.attrs['split_digest'] = self.split_digest
+            f.attrs['created'] = time.ctime()
+        print(f'Pixel stats of {self.count} events saved to: {stats_file}')
+        return None
+
+    @staticmethod
+    def load(stats_file):
+        """
+        :param stats_file: full path to the stats h5 file
+        :return: PixelStats
+        """
+        with h5py.File(stats_file, 'r') as f:
+            stats = PixelStats(f['sum'].shape[0])
+            stats.count = int(f['count'][()])
+            for key in STATS_KEYS[1:]:
+                setattr(stats, key, f[key][:])
+            stats.split_digest = str(f.attrs.get('split_digest', ''))
+        return stats
+
+
+def merge_stats_files(stats_files) -> PixelStats:
+    """
+    :param stats_files: list of full paths to stats h5 files (e.g. one per preprocessed file)
+    :return: PixelStats of all their events
+    """
+    stats = PixelStats()
+    for stats_file in stats_files:
+        stats.merge(PixelStats.load(stats_file))
+    print(f'Merged the pixel stats of {len(stats_files)} files, {stats.count} events.')
+    return stats
+
+
+def split_stats(path_to_data, split, set_key='train', batch_size=1024) -> PixelStats:
+    """
+    The stats of only the events of one set of a split, e.g. the training set, as the training sees them:
+    those with the vertex inside the cvnmap. Unlike the sidecars (of every event written), no held-out event is in them.
+    The cvnmaps are streamed in batches (see iomanager.iter_batches()), so the memory is ~one batch.
+    :param path_to_data: directory of the preprocessed files (in any layout), or a single file (e.g. the VDS)
+    :param split: dict, from splits.load_split()
+    :param set_key: str, one of splits.SPLIT_KEYS
+    :param batch_size: int, events read at a time
+    :return: PixelStats, with the split_digest of the set
+    """
+    stats = PixelStats()
+    for batch in io.iter_batches(path_to_data, batch_size, drop_outside_map=True):
+        in_set = np.isin(batch['event_id'], split[set_key])
+        stats.update_views(batch['xz'][in_set], batch['yz'][in_set])
+    stats.split_digest = utils.splits.split_digest(split[set_key])
+    print(f'Pixel stats of the {stats.count} {set_key} events of the split (of {len(split[set_key])}, inside the cvnmap).')
+    return stats
@@ -0,0 +1,710 @@
+# preprocess.py
+# Tools to slim the Prod5.1 trimmed h5 files down to what the training needs.
+
+import functools
+import hashlib
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.data_processing as dp
+import utils.iomanager as io
+import utils.metadata
+import utils.pixel_stats
+import utils.zarr_store
+
+# the only Vars we keep for training.
+TRAINING_KEYS = ['vtx.x', 'vtx.y', 'vtx.z', 'firstcellx', 'firstcelly', 'firstplane', 'cvnmap']
+
+# events copied at a time when streaming a file.
+DEFAULT_BLOCK_SIZE = 1024
+
+# compression options for the preprocessed h5 datasets. 'none' is uncompressed.
+COMPRESSION_CODECS = ['gzip', 'lzf', 'none']
+
+# where the preprocessed data is written: an h5 file, or a Zarr store (see zarr_store.py, Blosc compression).
+BACKENDS = ['h5', 'zarr']
+
+# when the labels are baked into the preprocessed file:
+# the signed types of the first hits (FD has 384 cells, 896 planes),
+# and the vertex in pixel map coordinates, for each coordinate.
+SIGNED_FIRST_HIT_DTYPES = {'firstcellx': 'int16', 'firstcelly': 'int16', 'firstplane': 'int32'}
+PIXELMAP_LABEL_KEYS = {'x': 'vtx_x_pixelmap', 'y': 'vtx_y_pixelmap', 'z': 'vtx_z_pixelmap'}
+FIRST_HIT_KEYS = {'x': 'firstcellx', 'y': 'firstcelly', 'z': 'firstplane'}
+
+# what to do with the events with the vertex outside the 80x100 cvnmap.
+CONTAINMENT_OPTIONS = ['none', 'mask', 'drop']
+
+# how the cvnmap is stored. 'flat': 'cvnmap' (N, 16000), as in the trimmed files.
+# 'views': 'cvnmap_xz' and 'cvnmap_yz' (N, 100, 80) each, ready for the training.
+# 'sparse': only the non-zero pixels. Event i has the pixels cvnmap_index[cvnmap_offsets[i]:cvnmap_offsets[i + 1]],
+#           with values cvnmap_value[cvnmap_offsets[i]:cvnmap_offsets[i + 1]].
+CVNMAP_LAYOUTS = ['flat', 'views', 'sparse']
+CVNMAP_VIEW_KEYS = ['cvnmap_xz', 'cvnmap_yz']
+CVNMAP_SPARSE_KEYS = ['cvnmap_offsets', 'cvnmap_index', 'cvnmap_value']
+
+# the sparse pixel datasets grow as the file is streamed, so they need a fixed chunk (in pixels).
+SPARSE_CHUNK_PIXELS = 65536
+
+# the downsampled cvnmap views (and labels) that can be written as well, for cheap prototyping (see pyramid_view_keys()):
+# the factor, and how the pixels are pooled ('sum' is uint16).
+PYRAMID_FACTORS = [2, 4]
+PYRAMID_POOLING = ['sum', 'max']
+
+# how to pick a subset of the events of a file, and the Vars to stratify by.
+SAMPLING_OPTIONS = ['first', 'random', 'stratified']
+STRATIFY_KEYS = ['mode', 'pdg', 'iscc']
+
+# version of the preprocessed file contents. Bump it when the datasets written change,
+# so the outputs of an older version are not taken as complete.
+SCHEMA_VERSION = 1
+
+
+def preprocessed_filename(infile, subset_events=0, sampling='first', backend='h5') -> str:
+    """
+    :param infile: trimmed h5 file name (or full path)
+    :param subset_events: int, events in the subset (0 = all events)
+    :param sampling: str, one of SAMPLING_OPTIONS, how the subset was picked
+    :param backend: str, one of BACKENDS. A Zarr store ends with '.zarr' instead of '.h5'.
+    :return: name of the preprocessed h5 file
+    """
+    name = os.path.basename(infile)
+    if backend == 'zarr':
+        name = os.path.splitext(name)[0] + utils.zarr_store.ZARR_SUFFIX
+    if subset_events:
+        return f'preprocessed_{subset_events}_events_{sampling}_{name}'
+    return f'preprocessed_{name}'
+
+
+def select_events(f_in, subset_events, sampling='first', stratify_by=None, seed=None):
+    """
+    Pick a subset of the events of a file. Only the scalar columns are read.
+    'first': the first `subset_events` events (biased, the files are not shuffled).
+    'random': a uniform random sample.
+    'stratified': a random sample with each combination of the `stratify_by` Vars
+                  (e.g. interaction mode, neutrino pdg, CC/NC) in the same proportion as in the file.
+    :param f_in: h5py.File, the open trimmed h5 file
+    :param subset_events: int, events to pick (all events if larger than the file)
+    :param sampling: str, one of SAMPLING_OPTIONS
+    :param stratify_by: list of str, the Vars to stratify by (default: STRATIFY_KEYS)
+    :param seed: int, seed of the random sample
+    :return: sorted np.array of the events picked
+    """
+    if sampling not in SAMPLING_OPTIONS:
+        raise ValueError(f'Sampling {sampling} is not valid. Use one of {SAMPLING_OPTIONS}.')
+    stratify_by = STRATIFY_KEYS if stratify_by is None else stratify_by
+    n_events = f_in['cvnmap'].shape[0]
+    subset_events = min(subset_events, n_events)
+    if sampling == 'first':
+        return np.arange(subset_events)
+
+    rng = np.random.default_rng(seed)
+    if sampling == 'random':
+        return np.sort(rng.choice(n_events, subset_events, replace=False))
+
+    strata = np.stack([f_in[key][:].reshape(-1) for key in stratify_by], axis=-1)
+    _, stratum, counts = np.unique(strata, axis=0, return_inverse=True, return_counts=True)
+    stratum = stratum.reshape(-1)
+    # proportional share of each stratum, the rounding remainder goes to the largest fractions.
+    share = subset_events * counts / n_events
+    quota = np.floor(share).astype(int)
+    remainder = subset_events - quota.sum()
+    quota[np.argsort(quota - share)[:remainder]] += 1
+    print(f'stratified by {stratify_by}: {len(counts)} strata')
+    events = [rng.choice(np.flatnonzero(stratum == i), quota[i], replace=False)
+              for i in np.flatnonzero(quota)]
+    return np.sort(np.concatenate(events))
+
+
+def pyramid_view_keys(factor) -> list:
+    """
+    :param factor: int, one of PYRAMID_FACTORS
+    :return: names of the XZ & YZ view datasets downsampled by `factor`, (N, 100 / factor, 80 / factor)
+    """
+    return [f'{key}_{factor}x' for key in CVNMAP_VIEW_KEYS]
+
+
+def pyramid_label_keys(factor) -> dict:
+    """
+    :param factor: int, one of PYRAMID_FACTORS
+    :return: dict of {coordinate: name of the label dataset in the pixel map coordinates downsampled by `factor`}
+    """
+    return {coordinate: f'{key}_{factor}x' for coordinate, key in PIXELMAP_LABEL_KEYS.items()}
+
+
+def subset_directory(out_path, subset_events, sampling='first') -> str:
+    """
+    Where the subsets written next to the full files (preprocess_h5_file(..., also_subsets=...)) go: their own directory,
+    so the readers of `out_path` never take their events as more events of the sample.
+    Named after `out_path`, so it has the det, horn & flux of the sample too.
+    :param out_path: directory of the full preprocessed files
+    :param subset_events: int, events in the subset
+    :param sampling: str, one of SAMPLING_OPTIONS, how the subset was picked
+    :return: full path to the directory of the subsets
+    """
+    sample_name = os.path.basename(os.path.normpath(out_path))
+    return os.path.join(out_path, f'{sample_name}_subset_{subset_events}_{sampling}')
+
+
+def manifest_filename(out_file) -> str:
+    """
+    :param out_file: full path to the preprocessed h5 file
+    :return: full path to its manifest, written once the file is complete
+    """
+    return f'{out_file}.manifest.json'
+
+
+def file_sha256(path, block_bytes=16 * 1024 ** 2) -> str:
+    """
+    :param path: full path to a file, or a directory (e.g. a Zarr store)
+    :param block_bytes: int, bytes read at a time
+    :return: str, hex sha256 checksum of the file (of the names & contents of every file in the directory)
+    """
+    checksum = hashlib.sha256()
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for file_path in paths:
+        if file_path != path:
+            # only the files of a directory are named, so the checksum of a file is that of its contents.
+            checksum.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(functools.partial(f.read, block_bytes), b''):
+                checksum.update(block)
+    return checksum.hexdigest()
+
+
+def input_fingerprint(in_file_path) -> dict:
+    """
+    :param in_file_path: full path to the trimmed h5 file
+    :return: dict of the path, size and modification time of the input, to tell if it changed
+    """
+    stat = os.stat(in_file_path)
+    return {'input_path': os.path.abspath(in_file_path),
+            'input_size': stat.st_size,
+            'input_mtime': stat.st_mtime}
+
+
+def output_is_complete(in_file_path, out_file, options) -> bool:
+    """
+    Check a preprocessed file against its manifest: it is complete only if the manifest exists,
+    was written for the same input (path, size, mtime), schema version and options,
+    and the file has the size and checksum recorded once it was fully written.
+    :param in_file_path: full path to the trimmed h5 file
+    :param out_file: full path to the preprocessed h5 file
+    :param options: dict of the preprocess_h5_file() options that change the output (i.e. not the block size)
+    :return: bool
+    """
+    manifest_file = manifest_filename(out_file)
+    if not os.path.exists(out_file) or not os.path.exists(manifest_file):
+        print('No manifest for this file, it is not known to be complete.')
+        return False
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except ValueError as e:
+        print(f'Unreadable manifest {manifest_file}: {e}')
+        return False
+
+    if options.get('write_metadata') and not os.path.exists(utils.metadata.metadata_filename(out_file)):
+        print('No metadata sidecar for this file.')
+        return False
+    if options.get('write_stats') and not os.path.exists(utils.pixel_stats.stats_filename(out_file)):
+        print('No pixel stats sidecar for this file.')
+        return False
+    expected = {**input_fingerprint(in_file_path), 'schema_version': SCHEMA_VERSION, 'options': options}
+    for key, value in expected.items():
+        if manifest.get(key) != value:
+            print(f'Manifest {key} is {manifest.get(key)}, expected {value}.')
+            return False
+    if io.path_size(out_file) != manifest.get('output_size'):
+        print('File size does not match the manifest.')
+        return False
+    if file_sha256(out_file) != manifest.get('output_sha256'):
+        print('File checksum does not match the manifest.')
+        return False
+    return True
+
+
+def write_manifest(in_file_path, out_file, options, n_events) -> None:
+    """
+    Write the manifest of a complete preprocessed file (atomically, like the file itself).
+    :param in_file_path: full path to the trimmed h5 file
+    :param out_file: full path to the preprocessed h5 file
+    :param options: dict of the preprocess_h5_file() options that change the output (i.e. not the block size)
+    :param n_events: int, events in the preprocessed file
+    :return: None
+    """
+    manifest = {**input_fingerprint(in_file_path),
+                'output_file': os.path.abspath(out_file),
+                'output_size': io.path_size(out_file),
+                'output_sha256': file_sha256(out_file),
+                'events': n_events,
+                'schema_version': SCHEMA_VERSION,
+                'options': options,
+                'created': time.ctime()}
+    manifest_file = manifest_filename(out_file)
+    with utils.atomic.atomic_output(manifest_file) as partial_file, open(partial_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return None
+
+
+def iter_event_blocks(n_events, block_size):
+    """
+    Generator of the (start, stop) event ranges to copy a file in fixed blocks of events.
+    :param n_events: int, events in the file
+    :param block_size: int, events per block
+    :return: yields (start, stop)
+    """
+    for start in range(0, n_events, block_size):
+        yield start, min(start + block_size, n_events)
+
+
+def dataset_storage_kwargs(shape, compression='gzip', compression_level=4, shuffle=False, chunk_events=1) -> dict:
+    """
+    The h5py create_dataset() keywords for the compression and chunk layout of one dataset.
+    Each chunk holds `chunk_events` events, so a read of a batch of events needs
+    one decompression and one B-tree lookup per `chunk_events` events, instead of one per event.
+    :param shape: tuple, shape of the dataset (events first)
+    :param compression: str, one of COMPRESSION_CODECS
+    :param compression_level: int, gzip level 0-9 (ignored for the others)
+    :param shuffle: bool, apply the HDF5 byte-shuffle filter before compressing
+    :param chunk_events: int, events per chunk
+    :return: dict of keywords
+    """
+    if compression not in COMPRESSION_CODECS:
+        raise ValueError(f'Compression {compression} is not valid. Use one of {COMPRESSION_CODECS}.')
+
+    kwargs = {}
+    if compression == 'gzip':
+        kwargs['compression'] = 'gzip'
+        kwargs['compression_opts'] = compression_level
+    elif compression == 'lzf':
+        kwargs['compression'] = 'lzf'
+    if shuffle:
+        kwargs['shuffle'] = True
+
+    # a chunk can't be larger than the dataset itself.
+    chunk_events = max(1, min(chunk_events, shape[0]))
+    if int(np.prod(shape[1:])) > 1:
+        kwargs['chunks'] = (chunk_events,) + tuple(shape[1:])
+    elif kwargs:
+        # the scalar columns are tiny, so use big chunks -- never less than one chunk of maps.
+        kwargs['chunks'] = (max(chunk_events, min(shape[0], 65536)),) + tuple(shape[1:])
+    return kwargs
+
+
+def compute_pixelmap_labels(f_in) -> dict:
+    """
+    Do the work every consumer otherwise repeats after loading, once:
+    remove the unsigned ints of firstcellx, firstcelly, firstplane,
+    and convert the vertex into pixel map coordinates.
+    Only the scalar columns are read, which are small compared to the cvnmap.
+    :param f_in: h5py.File, the open trimmed h5 file
+    :return: dict of {key: np.array} of the signed first hits & the pixel map labels (float64, as the consumers get)
+    """
+    labels = {}
+    for coordinate, first_hit_key in FIRST_HIT_KEYS.items():
+        first_hit = dp.remove_unsigned_ints_array(f_in[first_hit_key][:], 'int64')
+        labels[first_hit_key] = first_hit.astype(SIGNED_FIRST_HIT_DTYPES[first_hit_key])
+        labels[PIXELMAP_LABEL_KEYS[coordinate]] = dp.ConvertFarDetCoords('fd', coordinate).convert_fd_vtx_to_pixelmap(
+            f_in[f'vtx.{coordinate}'][:], first_hit)
+    return labels
+
+
+class PreprocessedFileSink:
+    """
+    One product of a pass over a trimmed h5 file: a preprocessed file (h5 or Zarr store) of all of its events,
+    or of a subset, in any cvnmap layout, with the containment mask, the downsampled views, and the stats & metadata sidecars.
+    preprocess_h5_file_sinks() reads the input once, and hands every block of events to each sink,
+    so another product (e.g. a 10k subset next to the full file) costs CPU & disk writes, not another decompression of the input.
+    """
+    def __init__(self, in_file_path, out_path,
+                 compression='gzip', compression_level=4, shuffle=False, chunk_events=1,
+                 bake_labels=False, containment='none', layout='flat',
+                 subset_events=0, sampling='first', stratify_by=None, seed=None,
+                 write_metadata=False, write_stats=False, backend='h5', pyramid=(), pyramid_pooling='sum'):
+        """
+        :param in_file_path: full path to the trimmed h5 file
+        :param out_path: directory to save the preprocessed file
+        :param ...: the options of preprocess_h5_file()
+        """
+        if containment not in CONTAINMENT_OPTIONS:
+            raise ValueError(f'Containment {containment} is not valid. Use one of {CONTAINMENT_OPTIONS}.')
+        if layout not in CVNMAP_LAYOUTS:
+            raise ValueError(f'Layout {layout} is not valid. Use one of {CVNMAP_LAYOUTS}.')
+        if backend not in BACKENDS:
+            raise ValueError(f'Backend {backend} is not valid. Use one of {BACKENDS}.')
+        if pyramid_pooling not in PYRAMID_POOLING:
+            raise ValueError(f'Pyramid pooling {pyramid_pooling} is not valid. Use one of {PYRAMID_POOLING}.')
+        for factor in pyramid:
+            if 100 % factor or 80 % factor:
+                raise ValueError(f'Pyramid factor {factor} does not divide the 100x80 views.')
+        codecs = utils.zarr_store.ZARR_CODECS if backend == 'zarr' else COMPRESSION_CODECS
+        if compression not in codecs:
+            raise ValueError(f'Compression {compression} is not valid for the {backend} backend. Use one of {codecs}.')
+        stratify_by = STRATIFY_KEYS if stratify_by is None else stratify_by
+        self.in_file_path = in_file_path
+        self.compression = compression
+        self.compression_level = compression_level
+        self.shuffle = shuffle
+        self.chunk_events = chunk_events
+        self.bake_labels = bake_labels
+        self.containment = containment
+        self.layout = layout
+        self.subset_events = subset_events
+        self.sampling = sampling
+        self.stratify_by = stratify_by
+        self.seed = seed
+        self.write_metadata = write_metadata
+        self.write_stats = write_stats
+        self.backend = backend
+        self.pyramid = list(pyramid)
+        self.pyramid_pooling = pyramid_pooling
+
+        self.out_file = os.path.join(out_path, preprocessed_filename(in_file_path, subset_events, sampling, backend))
+        self.partial_file = utils.atomic.partial_filename(self.out_file)
+        # the options that change the output (i.e. not the block size), checked against the manifest.
+        self.options = {'compression': compression, 'compression_level': compression_level, 'shuffle': shuffle,
+                        'chunk_events': chunk_events, 'bake_labels': bake_labels, 'containment': containment, 'layout': layout}
+        if subset_events:
+            self.options.update({'subset_events': subset_events, 'sampling': sampling,
+                                 'stratify_by': list(stratify_by), 'seed': seed})
+        if write_metadata:
+            self.options['write_metadata'] = True
+        if write_stats:
+            self.options['write_stats'] = True
+        if backend != 'h5':
+            self.options['backend'] = backend
+        if pyramid:
+            self.options.update({'pyramid': list(pyramid), 'pyramid_pooling': pyramid_pooling})
+
+        # set by select() & open().
+        self.rows = None
+        self.contained = None
+        self.n_events = 0
+        self.n_selected = 0
+        self.events_outside_cvnmap = -1
+        self.copy_keys = []
+        self.hf = None
+        self.stats = None
+        self.written = 0
+
+    def storage_kwargs(self, shape) -> dict:
+        """
+        :param shape: tuple, shape of the dataset (events first)
+        :return: dict of the create_dataset() keywords of the backend
+        """
+        if self.backend == 'zarr':
+            return utils.zarr_store.zarr_storage_kwargs(shape, self.compression, self.compression_level, self.shuffle, self.chunk_events)
+        return dataset_storage_kwargs(shape, self.compression, self.compression_level, self.shuffle, self.chunk_events)
+
+    def is_complete(self) -> bool:
+        """
+        :return: True if the output already exists, and is verifiably complete (see output_is_complete())
+        """
+        print(f'Creating file...{self.out_file}')
+        if not os.path.exists(self.out_file):
+            return False
+        if output_is_complete(self.in_file_path, self.out_file, self.options):
+            print('File already exists, and is complete. Don\'t want to overwrite! Skipping...')
+            return True
+        print('File already exists, but is NOT verifiably complete. Preprocessing it again...')
+        return False
+
+    def needs_labels(self) -> bool:
+        """
+        :return: True if the signed first hits & the pixel map labels are needed (see compute_pixelmap_labels())
+        """
+        return self.bake_labels or self.containment != 'none' or bool(self.pyramid)
+
+    def select(self, f_in, labels) -> np.array:
+        """
+        Pick the events of the input to write: all of them, or the subset, without those outside the cvnmap if dropped.
+        Only the scalar columns are read.
+        :param f_in: h5py.File, the open trimmed h5 file
+        :param labels: dict, from compute_pixelmap_labels() (empty if not needs_labels())
+        :return: sorted np.array, the row in the input of each event to write
+        """
+        self.n_events = f_in['cvnmap'].shape[0]
+        selected = np.arange(self.n_events)
+        if self.subset_events:
+            selected = select_events(f_in, self.subset_events, self.sampling, self.stratify_by, self.seed)
+            print(f'Selected {len(selected)} of {self.n_events} events ({self.sampling})')
+        self.n_selected = len(selected)
+
+        # every event is kept, unless we drop those outside the cvnmap.
+        contained = np.ones(len(selected), dtype=bool)
+        if self.containment != 'none':
+            contained = dp.contained_in_cvnmap(np.stack([labels[PIXELMAP_LABEL_KEYS[c]][selected].reshape(-1) for c in 'xyz'], axis=-1))
+            print(f'{len(selected) - contained.sum()} of {len(selected)} events have the vertex outside the cvnmap.')
+        keep = contained if self.containment == 'drop' else np.ones(len(selected), dtype=bool)
+        self.rows = selected[keep]
+        self.contained = contained[keep]
+        self.events_outside_cvnmap = len(selected) - int(contained.sum())
+        return self.rows
+
+    def open(self, f_in, labels) -> None:
+        """
+        Create the (partial) output: preallocate the datasets copied block by block,
+        write the label (and mask) columns, which are small, in one go, and the attributes.
+        :param f_in: h5py.File, the open trimmed h5 file
+        :param labels: dict, from compute_pixelmap_labels() (empty if not needs_labels())
+        :return: None
+        """
+        n_out = len(self.rows)
+        open_output = utils.zarr_store.open_zarr if self.backend == 'zarr' else h5py.File
+        self.hf = hf = open_output(self.partial_file, 'w')
+
+        written = {}
+        if self.bake_labels:
+            for coordinate in 'xyz':
+                written[FIRST_HIT_KEYS[coordinate]] = labels[FIRST_HIT_KEYS[coordinate]][self.rows]
+                written[PIXELMAP_LABEL_KEYS[coordinate]] = labels[PIXELMAP_LABEL_KEYS[coordinate]][self.rows].astype(np.float32)
+        for factor in self.pyramid:
+            for coordinate, key in pyramid_label_keys(factor).items():
+                written[key] = (labels[PIXELMAP_LABEL_KEYS[coordinate]][self.rows] / factor).astype(np.float32)
+        if self.containment == 'mask':
+            written['contained'] = self.contained
+        self.copy_keys = [key for key in TRAINING_KEYS if key not in written]
+
+        # preallocate the output, same shape & type as the input.
+        for key in self.copy_keys:
+            if key == 'cvnmap' and self.layout == 'views':
+                for view_key in CVNMAP_VIEW_KEYS:
+                    shape = (n_out, 100, 80)
+                    hf.create_dataset(view_key, shape=shape, dtype=f_in[key].dtype, **self.storage_kwargs(shape))
+                continue
+            if key == 'cvnmap' and self.layout == 'sparse':
+                shape = (n_out + 1,)
+                hf.create_dataset('cvnmap_offsets', shape=shape, dtype='int64', **self.storage_kwargs(shape))
+                hf['cvnmap_offsets'][0] = 0
+                # the number of non-zero pixels is only known once streamed, so these are resizable.
+                pixel_kwargs = self.storage_kwargs((SPARSE_CHUNK_PIXELS,))
+                pixel_kwargs['chunks'] = pixel_kwargs.get('chunks') or (SPARSE_CHUNK_PIXELS,)
+                if self.backend == 'h5':
+                    pixel_kwargs['maxshape'] = (None,)
+                hf.create_dataset('cvnmap_index', shape=(0,), dtype='uint16', **pixel_kwargs)
+                hf.create_dataset('cvnmap_value', shape=(0,), dtype=f_in[key].dtype, **pixel_kwargs)
+                continue
+            shape = (n_out,) + f_in[key].shape[1:]
+            hf.create_dataset(key, shape=shape, dtype=f_in[key].dtype, **self.storage_kwargs(shape))
+        for factor in self.pyramid:
+            shape = (n_out, 100 // factor, 80 // factor)
+            for view_key in pyramid_view_keys(factor):
+                hf.create_dataset(view_key, shape=shape, dtype='uint16' if self.pyramid_pooling == 'sum' else f_in['cvnmap'].dtype,
+                                  **self.storage_kwargs(shape))
+        for key, value in written.items():
+            hf.create_dataset(key, data=value, **self.storage_kwargs((n_out,) + value.shape[1:]))
+        hf.attrs['schema_version'] = SCHEMA_VERSION
+        hf.attrs['labels_baked'] = self.bake_labels
+        # record the layout used, so the files are self-describing.
+        hf.attrs['compression'] = self.compression
+        hf.attrs['compression_level'] = self.compression_level if self.compression in ['gzip'] + utils.zarr_store.BLOSC_CODECS else -1
+        hf.attrs['shuffle'] = self.shuffle
+        hf.attrs['chunk_events'] = self.chunk_events
+        hf.attrs['layout'] = self.layout
+        # and the count of events with the vertex outside the cvnmap (-1 if not computed).
+        hf.attrs['containment'] = self.containment
+        hf.attrs['events_in_input'] = self.n_events
+        hf.attrs['events_outside_cvnmap'] = self.events_outside_cvnmap if self.containment != 'none' else -1
+        hf.attrs['events_dropped'] = self.n_selected - n_out
+        # and the subset of the input events, if not all of them (0).
+        hf.attrs['subset_events'] = self.subset_events
+        hf.attrs['sampling'] = self.sampling if self.subset_events else 'none'
+        # and the downsampled views, if any.
+        hf.attrs['pyramid'] = [int(factor) for factor in self.pyramid]
+        hf.attrs['pyramid_pooling'] = self.pyramid_pooling if self.pyramid else 'none'
+
+        self.stats = utils.pixel_stats.PixelStats() if self.write_stats else None
+        self.written = 0
+        return None
+
+    def write(self, block_rows, blocks) -> None:
+        """
+        Write the events of a block that are in this output (in order, so each call appends).
+        :param block_rows: sorted np.array, the row in the input of each event of the block
+        :param blocks: dict of {key: np.array} of the block, for (at least) the copy_keys
+        :return: None
+        """
+        hf = self.hf
+        stop = int(np.searchsorted(self.rows, block_rows[-1], side='right'))
+        rows = self.rows[self.written:stop]
+        if len(rows) == 0:
+            return None
+        # where this output's events are in the block (all of it, if the same events).
+        picks = None if len(rows) == len(block_rows) else np.searchsorted(block_rows, rows)
+        out_start, n_keep = self.written, len(rows)
+        for key in self.copy_keys:
+            block = blocks[key] if picks is None else blocks[key][picks]
+            if key == 'cvnmap' and self.stats is not None:
+                self.stats.update(block)
+            if key == 'cvnmap':
+                for factor in self.pyramid:
+                    for view_key, view in zip(pyramid_view_keys(factor), dp.split_cvnmap_views(block)):
+                        hf[view_key][out_start:out_start + n_keep] = dp.pool_cvnmap_view(view, factor, self.pyramid_pooling)
+            if key == 'cvnmap' and self.layout == 'views':
+                for view_key, view in zip(CVNMAP_VIEW_KEYS, dp.split_cvnmap_views(block)):
+                    hf[view_key][out_start:out_start + n_keep] = view
+            elif key == 'cvnmap' and self.layout == 'sparse':
+                counts, indices, values = dp.sparsify_cvnmaps(block)
+                n_pixels = hf['cvnmap_index'].shape[0]
+                for pixel_key, pixels in [('cvnmap_index', indices), ('cvnmap_value', values)]:
+                    hf[pixel_key].resize((n_pixels + len(pixels),))
+                    hf[pixel_key][n_pixels:] = pixels
+                hf['cvnmap_offsets'][out_start + 1:out_start + n_keep + 1] = n_pixels + np.cumsum(counts)
+            else:
+                hf[key][out_start:out_start + n_keep] = block
+        self.written = stop
+        return None
+
+    def close(self, f_in) -> int:
+        """
+        Finish the output: the sparse pixel count, the sidecars, then rename it and write its manifest.
+        :param f_in: h5py.File, the open trimmed h5 file
+        :return: number of events written
+        """
+        hf = self.hf
+        n_out = len(self.rows)
+        print(f'\nadded {list(hf.keys())}')
+        if self.layout == 'sparse':
+            n_pixels = hf['cvnmap_index'].shape[0]
+            hf.attrs['cvnmap_nonzero_pixels'] = n_pixels
+            print(f'{n_pixels} non-zero pixels, {100 * n_pixels / max(n_out * 16000, 1):.2f}% of the cvnmap pixels.')
+        if self.containment == 'drop':
+            print(f'Dropped {self.n_selected - n_out} of {self.n_selected} events outside the cvnmap.')
+        if self.write_metadata:
+            # the sidecar is always an h5 file, so the Blosc codecs of a Zarr store fall back to gzip.
+            compression = self.compression if self.compression in COMPRESSION_CODECS else 'gzip'
+            utils.metadata.write_metadata_sidecar(f_in, utils.metadata.metadata_filename(self.out_file), self.rows,
+                                                  self.contained if self.containment != 'none' else None,
+                                                  functools.partial(dataset_storage_kwargs, compression=compression,
+                                                                    compression_level=self.compression_level, shuffle=self.shuffle))
+        if self.stats is not None:
+            self.stats.save(utils.pixel_stats.stats_filename(self.out_file))
+        self.abort()
+
+        # only now is the file complete.
+        utils.atomic.finish_output(self.out_file)
+        write_manifest(self.in_file_path, self.out_file, self.options, n_out)
+        print('File created: ', self.out_file)
+        return n_out
+
+    def abort(self) -> None:
+        """
+        Close the (partial) output, if open. A partial output is never renamed, so it is redone next time.
+        :return: None
+        """
+        if isinstance(self.hf, h5py.File):
+            self.hf.close()
+        self.hf = None
+        return None
+
+
+def preprocess_h5_file_sinks(in_file_path, sinks, block_size=DEFAULT_BLOCK_SIZE) -> list:
+    """
+    The preprocessing engine: open the trimmed h5 file ONCE, and stream the events any of the sinks needs
+    (all of them, or the union of the subsets) across in blocks of `block_size` events,
+    handing each block to every sink (see PreprocessedFileSink). So each input chunk is decompressed once,
+    however many products are written, and the peak memory is ~`block_size` pixel maps per sink.
+    The sinks already complete are skipped, and the input isn't opened if they all are.
+    :param in_file_path: full path to the trimmed h5 file
+    :param sinks: list of PreprocessedFileSink, of the same input file
+    :param block_size: int, events read at a time (1024 events of cvnmap is ~16 MB)
+    :return: list of the number of events written by each sink (0 if it was already complete)
+    """
+    print('Processing h5 file: ' + os.path.basename(in_file_path))
+    todo = [sink for sink in sinks if not sink.is_complete()]
+    if not todo:
+        return [0] * len(sinks)
+
+    print(f'Opening file.....{in_file_path}')
+    with h5py.File(in_file_path, 'r') as f_in:
+        labels = {}
+        if any(sink.needs_labels() for sink in todo):
+            print('Computing the signed first hits and the pixel map labels...')
+            labels = compute_pixelmap_labels(f_in)
+        rows = np.unique(np.concatenate([sink.select(f_in, labels) for sink in todo]))
+        print(f'{len(rows)} events for {len(todo)} output(s), reading in blocks of {block_size} events')
+
+        try:
+            for sink in todo:
+                sink.open(f_in, labels)
+            read_keys = [key for key in TRAINING_KEYS if any(key in sink.copy_keys for sink in todo)]
+            for start, stop in iter_event_blocks(len(rows), block_size):
+                block_rows = rows[start:stop]
+                blocks = {}
+                for key in read_keys:
+                    if block_rows[-1] - block_rows[0] + 1 == len(block_rows):
+                        blocks[key] = f_in[key][block_rows[0]:block_rows[-1] + 1]
+                    else:
+                        # read through gaps smaller than a chunk, it's cheaper than another chunk lookup.
+                        chunk_events = f_in[key].chunks[0] if f_in[key].chunks else 0
+                        blocks[key] = io.read_rows(f_in[key], block_rows, max_gap=chunk_events)
+                for sink in todo:
+                    sink.write(block_rows, blocks)
+                print(f'copied events {start}-{stop} of {len(rows)}', end='\r', flush=True)
+            events_written = {sink: sink.close(f_in) for sink in todo}
+        finally:
+            for sink in todo:
+                sink.abort()
+    return [events_written.get(sink, 0) for sink in sinks]
+
+
+def preprocess_h5_file(in_file_path, out_path, block_size=DEFAULT_BLOCK_SIZE, also_subsets=(), **kwargs) -> int:
+    """
+    Copy the training Vars (vtx.{x,y,z}, firstcell{x,y}, firstplane, cvnmap)
+    from one trimmed h5 file into a new preprocessed h5 file in `out_path`.
+    The input is opened ONCE, the output datasets are preallocated,
+    and the events are streamed across in blocks of `block_size` events.
+    So the peak memory is ~`block_size` pixel maps, regardless of the file size.
+    The file is written under a temporary name, and renamed once complete (see atomic.py),
+    with a manifest next to it (see write_manifest()). So a killed job never leaves a truncated file behind.
+    Will NOT redo a file that is verifiably complete (see output_is_complete()),
+    but will replace a file without a manifest, or that doesn't match it.
+    :param in_file_path: full path to the trimmed h5 file
+    :param out_path: directory to save the preprocessed file
+    :param block_size: int, events copied at a time (1024 events of cvnmap is ~16 MB)
+    :param also_subsets: list of int, also write subsets of these many events (same options, picked with `sampling`),
+                         from the same pass over the input (see preprocess_h5_file_sinks()), each into its own directory
+                         in `out_path` (see subset_directory())
+    :param compression: str, one of COMPRESSION_CODECS
+    :param compression_level: int, gzip level 0-9
+    :param shuffle: bool, apply the HDF5 byte-shuffle filter
+    :param chunk_events: int, events per chunk (default 1, i.e. one pixel map per chunk)
+    :param bake_labels: bool, write the signed firstcellx, firstcelly, firstplane,
+                        and the vtx_{x,y,z}_pixelmap labels (see compute_pixelmap_labels())
+    :param containment: str, one of CONTAINMENT_OPTIONS, for the events with the vertex outside the 80x100 cvnmap.
+                        'none': keep all events. 'mask': keep all events, and store the boolean 'contained' dataset.
+                        'drop': write only the contained events.
+    :param layout: str, one of CVNMAP_LAYOUTS. 'views' stores the XZ and YZ views of the cvnmap
+                   as separate (N, 100, 80) datasets, chunked by `chunk_events`, so no reshaping when loading.
+                   'sparse' stores only the non-zero pixels of the cvnmap (see dp.sparsify_cvnmaps()).
+    :param subset_events: int, write only a subset of this many events (0 = all events), see select_events().
+                          The subset is read with coalesced reads of the sorted events.
+    :param sampling: str, one of SAMPLING_OPTIONS, how to pick the subset
+    :param stratify_by: list of str, the Vars to stratify the subset by (default: STRATIFY_KEYS)
+    :param seed: int, seed of the random subset
+    :param write_metadata: bool, also write the metadata.METADATA_KEYS of each event written (and its 'row' in the file,
+                           'input_row', the row in the trimmed file) to a sidecar file (see metadata.metadata_filename()),
+                           so the analysis doesn't need to open the trimmed file.
+    :param write_stats: bool, also accumulate the pixel intensity statistics of the events written
+                        into a sidecar file (see pixel_stats.stats_filename()), to normalise from when training.
+    :param backend: str, one of BACKENDS. 'zarr' writes a Zarr store instead of an h5 file (see zarr_store.py),
+                    with the compression one of zarr_store.ZARR_CODECS (Blosc 'lz4' or 'zstd', with `shuffle` the bit-shuffle).
+    :param pyramid: list of int, also write the XZ & YZ views downsampled by these factors (see pyramid_view_keys()),
+                    and the pixel map labels divided by the factor (see pyramid_label_keys()), in any layout.
+    :param pyramid_pooling: str, one of PYRAMID_POOLING, how the pixels are pooled (see dp.pool_cvnmap_view())
+    :return: number of events written (0 if the file was already complete)
+    """
+    print('Saving for training to ' + out_path)
+    sinks = [PreprocessedFileSink(in_file_path, out_path, **kwargs)]
+    for subset_events in also_subsets:
+        subset_path = subset_directory(out_path, subset_events, kwargs.get('sampling', 'first'))
+        os.makedirs(subset_path, exist_ok=True)
+        sinks.append(PreprocessedFileSink(in_file_path, subset_path, **{**kwargs, 'subset_events': subset_events}))
+    return preprocess_h5_file_sinks(in_file_path, sinks, block_size)[0]
@@ -0,0 +1,90 @@
+# preprocess_cli.py
+# The command line options shared by the preprocessing scripts (single file, subset, and parallel),
+# and the wrapper of preprocess.preprocess_h5_file() the parallel script runs in its process pool.
+
+import time
+
+import utils.preprocess
+import utils.zarr_store
+
+
+def add_preprocess_arguments(parser) -> None:
+    """
+    Add the preprocessing options to the argparse parser of a preprocessing script,
+    so the single-file and the parallel scripts share them.
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument("--block_size", help="events copied at a time (sets the peak memory)",
+                        default=utils.preprocess.DEFAULT_BLOCK_SIZE, type=int)
+    parser.add_argument("--backend", help="write an h5 file, or a Zarr store (needs zarr<3, decompressed in parallel when loading)",
+                        default='h5', choices=utils.preprocess.BACKENDS, type=str)
+    parser.add_argument("--compression", help="compression codec of the output datasets ('lz4' & 'zstd' are Blosc, '--backend zarr' only)",
+                        default='gzip', choices=utils.preprocess.COMPRESSION_CODECS + utils.zarr_store.BLOSC_CODECS, type=str)
+    parser.add_argument("--compression_level", help="gzip (or Blosc) compression level (0-9)", default=4, type=int)
+    parser.add_argument("--shuffle", help="apply the HDF5 byte-shuffle filter (Blosc bit-shuffle for '--backend zarr') before compressing",
+                        default=False, action='store_true')
+    parser.add_argument("--chunk_events", help="events per HDF5 chunk", default=1, type=int)
+    parser.add_argument("--bake_labels", help="write signed firstcell{x,y}/firstplane and the vtx_{x,y,z}_pixelmap labels",
+                        default=False, action='store_true')
+    parser.add_argument("--containment", help="events with the vertex outside the cvnmap: keep ('none'), "
+                                              "store a boolean 'contained' dataset ('mask'), or don't write them ('drop')",
+                        default='none', choices=utils.preprocess.CONTAINMENT_OPTIONS, type=str)
+    parser.add_argument("--write_metadata", help="also write the truth & reco scalars (E, pdg, mode, ...) to a metadata sidecar",
+                        default=False, action='store_true')
+    parser.add_argument("--write_stats", help="also write the pixel intensity statistics (min, max, mean, std, histogram) "
+                                              "to a stats sidecar, to normalise from when training",
+                        default=False, action='store_true')
+    parser.add_argument("--pyramid", help="also write the views (and labels) downsampled by these factors, e.g. '--pyramid 2 4'",
+                        nargs='*', default=[], choices=utils.preprocess.PYRAMID_FACTORS, type=int)
+    parser.add_argument("--pyramid_pooling", help="pool the downsampled pixels by their 'sum' (uint16) or 'max'",
+                        default='sum', choices=utils.preprocess.PYRAMID_POOLING, type=str)
+    parser.add_argument("--layout", help="store the cvnmap 'flat' (N, 16000), as the XZ and YZ 'views' (N, 100, 80), "
+                                         "or only its non-zero pixels ('sparse')",
+                        default='flat', choices=utils.preprocess.CVNMAP_LAYOUTS, type=str)
+    parser.add_argument("--also_subsets", help="also write subsets of these many events (e.g. '--also_subsets 10000'), "
+                                               "from the same pass over the input, each into its own dir in the output dir",
+                        nargs='*', default=[], type=int)
+    parser.add_argument("--sampling", help="how to pick the events of a subset", default='stratified',
+                        choices=utils.preprocess.SAMPLING_OPTIONS, type=str)
+    parser.add_argument("--stratify_by", help="Vars to stratify a subset by (for --sampling stratified)",
+                        nargs='+', default=utils.preprocess.STRATIFY_KEYS, type=str)
+    parser.add_argument("--seed", help="seed of a random subset", default=1, type=int)
+    return None
+
+
+def preprocess_kwargs(args) -> dict:
+    """
+    :param args: argparse.Namespace, from a parser with add_preprocess_arguments()
+    :return: dict of keywords for preprocess.preprocess_h5_file()
+    """
+    return {'block_size': args.block_size,
+            'compression': args.compression,
+            'compression_level': args.compression_level,
+            'shuffle': args.shuffle,
+            'chunk_events': args.chunk_events,
+            'bake_labels': args.bake_labels,
+            'containment': args.containment,
+            'layout': args.layout,
+            'write_metadata': args.write_metadata,
+            'write_stats': args.write_stats,
+            'backend': args.backend,
+            'pyramid': args.pyramid,
+            'pyramid_pooling': args.pyramid_pooling,
+            'also_subsets': args.also_subsets,
+            'sampling': args.sampling,
+            'stratify_by': args.stratify_by,
+            'seed': args.seed}
+
+
+def preprocess_h5_file_timed(in_file_path, out_path, **kwargs) -> tuple:
+    """
+    Wrapper of utils.preprocess.preprocess_h5_file() for the process pool -- also reports the wall time.
+    :param in_file_path: full path to the trimmed h5 file
+    :param out_path: directory to save the preprocessed file
+    :param kwargs: passed to utils.preprocess.preprocess_h5_file()
+    :return: (in_file_path, events written, seconds)
+    """
+    start = time.time()
+    n_events = utils.preprocess.preprocess_h5_file(in_file_path, out_path, **kwargs)
+    return in_file_path, n_events, time.time() - start
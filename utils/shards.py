@@ -0,0 +1,369 @@
+# shards.py
+# Tools to repack (or shuffle) the preprocessed h5 files into equal-size shards of events, with a global event index.
+
+import os
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.data_processing as dp
+import utils.iomanager as io
+import utils.preprocess
+
+# events per shard, the last shard holds the remainder.
+DEFAULT_SHARD_EVENTS = 65536
+
+# the global index: event id -> (shard, row), and where the event came from.
+SHARD_INDEX_FILENAME = 'shard_index.h5'
+
+# bytes of a chunk of the shuffle buckets: within the default (1 MB) chunk cache of h5py, and written whole.
+BUCKET_CHUNK_BYTES = 1024 ** 2
+
+# the file attributes that describe the layout, the same for every input file (and so every shard).
+LAYOUT_ATTRS = ['schema_version', 'labels_baked', 'compression', 'compression_level', 'shuffle',
+                'chunk_events', 'layout', 'containment', 'pyramid', 'pyramid_pooling']
+
+
+def shard_filename(shard, n_shards) -> str:
+    """
+    :param shard: int, shard number
+    :param n_shards: int, total number of shards
+    :return: name of the shard h5 file
+    """
+    return f'shard_{shard:05d}_of_{n_shards:05d}.h5'
+
+
+def storage_like(dset, n_events) -> dict:
+    """
+    The h5py create_dataset() keywords to store a dataset the same way as `dset`,
+    with the chunk no larger than `n_events`.
+    :param dset: h5py.Dataset, the input dataset
+    :param n_events: int, events (rows) of the new dataset
+    :return: dict of keywords
+    """
+    kwargs = {}
+    if dset.compression:
+        kwargs['compression'] = dset.compression
+        kwargs['compression_opts'] = dset.compression_opts
+    if dset.shuffle:
+        kwargs['shuffle'] = True
+    if dset.chunks:
+        kwargs['chunks'] = (max(1, min(dset.chunks[0], n_events)),) + dset.chunks[1:]
+    return kwargs
+
+
+def check_same_layout(in_files) -> (list, dict, list):
+    """
+    The datasets, layout and event count of every input file. They must all match.
+    :param in_files: list of full paths to the preprocessed h5 files
+    :return: sorted dataset names, layout attributes, events in each file
+    """
+    if not in_files:
+        raise ValueError('No preprocessed files to repack.')
+    events_per_file = []
+    for in_file in in_files:
+        with h5py.File(in_file, 'r') as f:
+            layout = {key: f.attrs.get(key) for key in LAYOUT_ATTRS}
+            keys = sorted(f.keys())
+            if not events_per_file:
+                first_layout, first_keys = layout, keys
+            elif keys != first_keys or str(layout) != str(first_layout):
+                raise ValueError(f'{in_file} does not have the same datasets or layout as {in_files[0]}.')
+            events_per_file.append(io.events_in_file(f))
+    return first_keys, first_layout, events_per_file
+
+
+def open_shard(out_dir, shard, n_shards, n_shard, f_in, event_keys, layout) -> h5py.File:
+    """
+    Create a shard under a temporary name (see atomic.py), its datasets stored like those of `f_in`.
+    :param out_dir: directory of the shards
+    :param shard: int, shard number
+    :param n_shards: int, total number of shards
+    :param n_shard: int, events in this shard
+    :param f_in: h5py.File, an open input file
+    :param event_keys: list of the per-event datasets (the sparse cvnmap datasets are added if in `f_in`)
+    :param layout: dict of the layout attributes
+    :return: the open h5py.File, to close with close_shard()
+    """
+    hf = h5py.File(utils.atomic.partial_filename(os.path.join(out_dir, shard_filename(shard, n_shards))), 'w')
+    for key in event_keys:
+        hf.create_dataset(key, shape=(n_shard,) + f_in[key].shape[1:], dtype=f_in[key].dtype,
+                          **storage_like(f_in[key], n_shard))
+    if 'cvnmap_offsets' in f_in:
+        hf.create_dataset('cvnmap_offsets', shape=(n_shard + 1,), dtype='int64',
+                          **storage_like(f_in['cvnmap_offsets'], n_shard + 1))
+        for key in ['cvnmap_index', 'cvnmap_value']:
+            hf.create_dataset(key, shape=(0,), maxshape=(None,), dtype=f_in[key].dtype,
+                              **storage_like(f_in[key], f_in[key].chunks[0]))
+    for key, value in layout.items():
+        if value is not None:
+            hf.attrs[key] = value
+    hf.attrs['shard'] = shard
+    hf.attrs['n_shards'] = n_shards
+    hf.attrs['events_in_shard'] = n_shard
+    return hf
+
+
+def close_shard(hf) -> None:
+    """
+    Close a shard, and rename it now it is complete.
+    :param hf: h5py.File, from open_shard()
+    :return: None
+    """
+    shard_file = hf.filename[:-len(utils.atomic.PARTIAL_SUFFIX)]
+    hf.close()
+    utils.atomic.finish_output(shard_file)
+    print(f'Shard created: {shard_file}')
+    return None
+
+
+def write_shard_index(out_dir, shard_events, n_shards, source_file, source_row, in_files) -> str:
+    """
+    Write the global index (SHARD_INDEX_FILENAME): event id -> (shard, row) & (source file, source row).
+    :param out_dir: directory of the shards
+    :param shard_events: int, events per shard
+    :param n_shards: int, total number of shards
+    :param source_file: np.array, the input file number of each event id
+    :param source_row: np.array, the row in its input file of each event id
+    :param in_files: list of full paths to the input files
+    :return: full path to the shard index
+    """
+    event_id = np.arange(len(source_file))
+    index_file = os.path.join(out_dir, SHARD_INDEX_FILENAME)
+    with utils.atomic.atomic_output(index_file) as partial_file, h5py.File(partial_file, 'w') as f_index:
+        f_index.create_dataset('shard', data=(event_id // shard_events).astype('int32'))
+        f_index.create_dataset('row', data=event_id % shard_events)
+        f_index.create_dataset('source_file', data=np.asarray(source_file, dtype='int32'))
+        f_index.create_dataset('source_row', data=source_row)
+        f_index.create_dataset('shard_files', data=[shard_filename(i, n_shards) for i in range(n_shards)])
+        f_index.create_dataset('source_files', data=[os.path.abspath(in_file) for in_file in in_files])
+        f_index.attrs['shard_events'] = shard_events
+        f_index.attrs['total_events'] = len(source_file)
+    print(f'Shard index created: {index_file}')
+    return index_file
+
+
+def repack_shards(in_files, out_dir, shard_events=DEFAULT_SHARD_EVENTS, block_size=utils.preprocess.DEFAULT_BLOCK_SIZE) -> str:
+    """
+    Repack preprocessed h5 files (of any number of events each) into shards of `shard_events` events each,
+    in the order of `in_files`. The shards are preprocessed files too (same datasets, layout and attributes),
+    so they load the same way. The events are streamed across in blocks of `block_size` events,
+    and each shard is renamed only once complete (see open_shard()).
+    The global index (SHARD_INDEX_FILENAME) maps each event id (its position across all the shards)
+    to its shard & row, and to its source file & row.
+    :param in_files: list of full paths to the preprocessed h5 files
+    :param out_dir: directory to save the shards and the index
+    :param shard_events: int, events per shard
+    :param block_size: int, events copied at a time
+    :return: full path to the shard index
+    """
+    first_keys, first_layout, events_per_file = check_same_layout(in_files)
+    total_events = int(np.sum(events_per_file))
+    n_shards = -(-total_events // shard_events)
+    shard_sizes = [min(shard_events, total_events - shard * shard_events) for shard in range(n_shards)]
+    print(f'Repacking {total_events} events from {len(in_files)} files into {n_shards} shards of {shard_events} events')
+
+    # sparse cvnmaps are re-offset when copied, every other dataset is one row per event.
+    sparse = 'cvnmap_offsets' in first_keys
+    event_keys = [key for key in first_keys if key not in utils.preprocess.CVNMAP_SPARSE_KEYS]
+
+    hf = None
+    shard, row = 0, 0
+    for file_number, in_file in enumerate(in_files):
+        with h5py.File(in_file, 'r') as f_in:
+            n_events = events_per_file[file_number]
+            start = 0
+            while start < n_events:
+                if hf is None:
+                    hf = open_shard(out_dir, shard, n_shards, shard_sizes[shard], f_in, event_keys, first_layout)
+                # the block stops at the end of the file, or the end of the shard.
+                stop = min(start + block_size, n_events, start + shard_sizes[shard] - row)
+                for key in event_keys:
+                    hf[key][row:row + stop - start] = f_in[key][start:stop]
+                if sparse:
+                    offsets = f_in['cvnmap_offsets'][start:stop + 1]
+                    n_pixels = hf['cvnmap_index'].shape[0]
+                    for key in ['cvnmap_index', 'cvnmap_value']:
+                        hf[key].resize((n_pixels + offsets[-1] - offsets[0],))
+                        hf[key][n_pixels:] = f_in[key][offsets[0]:offsets[-1]]
+                    hf['cvnmap_offsets'][row + 1:row + stop - start + 1] = n_pixels + offsets[1:] - offsets[0]
+                row += stop - start
+                start = stop
+                if row == shard_sizes[shard]:
+                    close_shard(hf)
+                    hf, shard, row = None, shard + 1, 0
+
+    # event id -> (shard, row) & (source file, source row).
+    return write_shard_index(out_dir, shard_events, n_shards,
+                             np.repeat(np.arange(len(in_files)), events_per_file),
+                             np.concatenate([np.arange(n) for n in events_per_file]), in_files)
+
+
+def source_flux(in_file) -> str:
+    """
+    :param in_file: full path to a preprocessed file
+    :return: str, its flux ('Nonswap', 'Fluxswap') from the file (or dir) name, or 'unknown'
+    """
+    for flux in ['Nonswap', 'Fluxswap']:
+        if flux in in_file:
+            return flux
+    return 'unknown'
+
+
+def flush_bucket(bucket, pending, chunk_events=0) -> list:
+    """
+    Append the pending events to a shuffle bucket, in one write per key. Only whole chunks are written (but at the end),
+    so no compressed chunk is ever read back, decompressed and compressed again to append to it.
+    :param bucket: h5py.File of the bucket, open for writing
+    :param pending: list of dicts of {key: np.array}, the events appended to the bucket since the last flush
+    :param chunk_events: int, events per chunk of the bucket (0 = write all the pending events)
+    :return: list of the events still pending, fewer than a chunk
+    """
+    events = {key: np.concatenate([piece[key] for piece in pending]) for key in pending[0]}
+    n_events = len(events['event_id'])
+    n_write = n_events - n_events % chunk_events if chunk_events else n_events
+    n_bucket = bucket['event_id'].shape[0]
+    for key, value in events.items():
+        bucket[key].resize((n_bucket + n_write,) + value.shape[1:])
+        bucket[key][n_bucket:] = value[:n_write]
+    return [{key: value[n_write:].copy() for key, value in events.items()}] if n_write < n_events else []
+
+
+def shuffle_shards(in_files, out_dir, shard_events=DEFAULT_SHARD_EVENTS, seed=None,
+                   block_size=utils.preprocess.DEFAULT_BLOCK_SIZE) -> str:
+    """
+    Shuffle the events of ALL the input files (e.g. the Nonswap AND Fluxswap files of a 'Combined' sample)
+    into shards, out of core: the memory used is ~one shard (and <~1 MB per bucket), never the sample.
+    1. bucket: every event is given its place in one global permutation (from `seed`). The files are streamed
+       in blocks of `block_size` events, and each event is appended to the (temporary) bucket of its shard,
+       a whole chunk at a time (see flush_bucket()).
+    2. shuffle: one bucket at a time is read, put in the order of the permutation, and written as its shard.
+    So reading the shards in order (i.e. sequentially, at full disk bandwidth) gives well-mixed events of every file.
+    The shards are preprocessed files too, and the index (SHARD_INDEX_FILENAME) is the same as from repack_shards().
+    :param in_files: list of full paths to the preprocessed h5 files (all preprocessed with the same options)
+    :param out_dir: directory to save the shards and the index
+    :param shard_events: int, events per shard
+    :param seed: int, seed of the shuffle
+    :param block_size: int, events read at a time
+    :return: full path to the shard index
+    """
+    first_keys, first_layout, events_per_file = check_same_layout(in_files)
+    total_events = int(np.sum(events_per_file))
+    file_offsets = np.concatenate(([0], np.cumsum(events_per_file)))
+    n_shards = -(-total_events // shard_events)
+    shard_sizes = [min(shard_events, total_events - shard * shard_events) for shard in range(n_shards)]
+    print(f'Shuffling {total_events} events from {len(in_files)} files into {n_shards} shards of {shard_events} events')
+
+    # the place of every event (in the order of the files) in the shuffled sample, i.e. its new event id.
+    destination = np.random.default_rng(seed).permutation(total_events)
+    # sparse cvnmaps are densified in the buckets, and sparsified again into the shards.
+    sparse = 'cvnmap_offsets' in first_keys
+    event_keys = [key for key in first_keys if key not in utils.preprocess.CVNMAP_SPARSE_KEYS]
+    bucket_keys = event_keys + (['cvnmap'] if sparse else [])
+    with h5py.File(in_files[0], 'r') as f_first:
+        bucket_layout = {key: ((16000,), f_first['cvnmap_value'].dtype) if key == 'cvnmap' and sparse
+                         else (f_first[key].shape[1:], f_first[key].dtype) for key in bucket_keys}
+    # the events of a chunk of the largest key (e.g. the cvnmap), the same for every key.
+    chunk_events = max(1, BUCKET_CHUNK_BYTES // max(int(np.prod(shape)) * np.dtype(dtype).itemsize
+                                                    for shape, dtype in bucket_layout.values()))
+
+    # 1. bucket.
+    # scratch, removed once the shards are written, so named like an incomplete output.
+    bucket_dir = utils.atomic.partial_filename(os.path.join(out_dir, 'buckets'))
+    os.makedirs(bucket_dir, exist_ok=True)
+    buckets = [h5py.File(os.path.join(bucket_dir, f'bucket_{shard:05d}.h5'), 'w') for shard in range(n_shards)]
+    for bucket in buckets:
+        for key, (event_shape, dtype) in bucket_layout.items():
+            bucket.create_dataset(key, shape=(0,) + event_shape, maxshape=(None,) + event_shape,
+                                  dtype=dtype, chunks=(chunk_events,) + event_shape, compression='lzf')
+        for key in ['event_id', 'source_file', 'source_row']:
+            bucket.create_dataset(key, shape=(0,), maxshape=(None,), dtype='int64', chunks=(65536,))
+    # the events of each bucket not written yet.
+    pending = [[] for _ in range(n_shards)]
+    n_pending = np.zeros(n_shards, dtype='int64')
+    for file_number, in_file in enumerate(in_files):
+        with h5py.File(in_file, 'r') as f_in:
+            for start, stop in utils.preprocess.iter_event_blocks(events_per_file[file_number], block_size):
+                block = {key: f_in[key][start:stop] for key in event_keys}
+                if sparse:
+                    block['cvnmap'] = io.read_sparse_cvnmaps(f_in, start, stop)
+                block['event_id'] = destination[file_offsets[file_number] + start:file_offsets[file_number] + stop]
+                block['source_file'] = np.full(stop - start, file_number)
+                block['source_row'] = np.arange(start, stop)
+                shard_of_event = block['event_id'] // shard_events
+                for shard in np.unique(shard_of_event):
+                    in_shard = shard_of_event == shard
+                    pending[shard].append({key: value[in_shard] for key, value in block.items()})
+                    n_pending[shard] += in_shard.sum()
+                    if n_pending[shard] >= chunk_events:
+                        pending[shard] = flush_bucket(buckets[shard], pending[shard], chunk_events)
+                        n_pending[shard] %= chunk_events
+                print(f'bucketed events {start}-{stop} of file {file_number + 1} of {len(in_files)}', end='\r', flush=True)
+    print()
+    for shard, bucket in enumerate(buckets):
+        if pending[shard]:
+            # the last, partial, chunk.
+            flush_bucket(bucket, pending[shard])
+        bucket.close()
+
+    # 2. shuffle each bucket into its shard.
+    source_file = np.zeros(total_events, dtype='int64')
+    source_row = np.zeros(total_events, dtype='int64')
+    fluxes = np.array([source_flux(in_file) for in_file in in_files])
+    with h5py.File(in_files[0], 'r') as f_like:
+        for shard in range(n_shards):
+            bucket_file = os.path.join(bucket_dir, f'bucket_{shard:05d}.h5')
+            with h5py.File(bucket_file, 'r') as bucket:
+                order = np.argsort(bucket['event_id'][:])
+                event_id = bucket['event_id'][:][order]
+                assert len(event_id) == shard_sizes[shard]
+                source_file[event_id] = bucket['source_file'][:][order]
+                source_row[event_id] = bucket['source_row'][:][order]
+                hf = open_shard(out_dir, shard, n_shards, shard_sizes[shard], f_like, event_keys, first_layout)
+                for key in event_keys:
+                    hf[key][:] = bucket[key][:][order]
+                if sparse:
+                    counts, indices, values = dp.sparsify_cvnmaps(bucket['cvnmap'][:][order])
+                    hf['cvnmap_offsets'][:] = np.concatenate(([0], np.cumsum(counts)))
+                    for key, pixels in [('cvnmap_index', indices), ('cvnmap_value', values)]:
+                        hf[key].resize((len(pixels),))
+                        hf[key][:] = pixels
+                close_shard(hf)
+            os.remove(bucket_file)
+            # how well mixed the shard is.
+            flux, count = np.unique(fluxes[source_file[event_id]], return_counts=True)
+            print(f'shard {shard}: ' + ', '.join(f'{name} {100 * n / len(event_id):.1f}%' for name, n in zip(flux, count)))
+    os.rmdir(bucket_dir)
+
+    return write_shard_index(out_dir, shard_events, n_shards, source_file, source_row, in_files)
+
+
+def load_shard_index(shard_dir) -> dict:
+    """
+    :param shard_dir: directory of the shards
+    :return: dict of the global index arrays ('shard', 'row', 'source_file', 'source_row'),
+             indexed by event id, and the file names ('shard_files', 'source_files')
+    """
+    with h5py.File(os.path.join(shard_dir, SHARD_INDEX_FILENAME), 'r') as f_index:
+        index = {key: f_index[key][:] for key in ['shard', 'row', 'source_file', 'source_row']}
+        for key in ['shard_files', 'source_files']:
+            index[key] = [name.decode() for name in f_index[key][:]]
+    return index
+
+
+def shard_files(shard_dir, n_shards=0, seed=None) -> list:
+    """
+    The shards to read: all of them, or only the first `n_shards` (i.e. train on part of the sample).
+    With a seed, the shards are shuffled first -- e.g. a new order every epoch with seed = epoch,
+    without moving any events.
+    :param shard_dir: directory of the shards
+    :param n_shards: int, number of shards (0 = all)
+    :param seed: int, seed to shuffle the shards (None = in order)
+    :return: list of the shard file names
+    """
+    with h5py.File(os.path.join(shard_dir, SHARD_INDEX_FILENAME), 'r') as f_index:
+        files = [name.decode() for name in f_index['shard_files'][:]]
+    if seed is not None:
+        files = [files[i] for i in np.random.default_rng(seed).permutation(len(files))]
+    return files[:n_shards] if n_shards else files
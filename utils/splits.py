@@ -0,0 +1,118 @@
+# splits.py
+# Tools to make, save and load the train/val/test split of a sample, as global event ids.
+
+import hashlib
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.iomanager as io
+
+SPLIT_KEYS = ['train', 'val', 'test']
+
+
+def count_sample_events(path_to_data) -> int:
+    """
+    :param path_to_data: directory of the (preprocessed) h5 files, or of their .npy export, or a single h5 file
+    :return: int, events in the sample, i.e. the number of global event ids
+    """
+    if os.path.isfile(path_to_data):
+        # e.g. the virtual dataset file of the sample.
+        with h5py.File(path_to_data, 'r') as f:
+            return io.events_in_file(f)
+    schema_file = os.path.join(path_to_data, io.NPY_SCHEMA_FILENAME)
+    if os.path.exists(schema_file):
+        with open(schema_file, 'r', encoding='utf-8') as f:
+            return json.load(f)['sample_events']
+    _, sample_events = io.sample_event_offsets(path_to_data)
+    return sample_events
+
+
+def create_split(n_events, test_size=0.25, val_size=0.1, seed=101) -> dict:
+    """
+    Split the event ids 0 to n_events-1 of a sample, once, from a seed.
+    Same fractions as Config.create_test_train_val_datasets(): `test_size` of the events are the test set,
+    and `val_size` of the rest are the validation set.
+    :param n_events: int, events in the sample
+    :param test_size: fraction of test size data
+    :param val_size: fraction of validation size data (of the non-test events)
+    :param seed: int, seed of the split
+    :return: dict of {'train', 'val', 'test': sorted np.array of event ids}
+    """
+    permutation = np.random.default_rng(seed).permutation(n_events)
+    n_test = int(np.ceil(test_size * n_events))
+    n_val = int(np.ceil(val_size * (n_events - n_test)))
+    return {'test': np.sort(permutation[:n_test]),
+            'val': np.sort(permutation[n_test:n_test + n_val]),
+            'train': np.sort(permutation[n_test + n_val:])}
+
+
+def save_split(split_file, split, path_to_data, test_size, val_size, seed) -> None:
+    """
+    Save the split into an h5 sidecar file, with the sample it was made for.
+    :param split_file: full path to the split h5 file
+    :param split: dict, from create_split()
+    :param path_to_data: directory of the sample
+    :param test_size: fraction of test size data
+    :param val_size: fraction of validation size data
+    :param seed: int, seed of the split
+    :return: None
+    """
+    with utils.atomic.atomic_output(split_file) as partial_file, h5py.File(partial_file, 'w') as f:
+        for key in SPLIT_KEYS:
+            f.create_dataset(key, data=split[key], compression='gzip')
+        f.attrs['path_to_data'] = os.path.abspath(path_to_data)
+        f.attrs['n_events'] = sum(len(split[key]) for key in SPLIT_KEYS)
+        f.attrs['test_size'] = test_size
+        f.attrs['val_size'] = val_size
+        f.attrs['seed'] = seed
+        f.attrs['created'] = time.ctime()
+    print('Split saved to: ', split_file)
+    return None
+
+
+def load_split(split_file, path_to_data=None) -> dict:
+    """
+    :param split_file: full path to the split h5 file
+    :param path_to_data: directory of the sample, to check the split was made for the same number of events
+    :return: dict of {'train', 'val', 'test': sorted np.array of event ids}
+    """
+    with h5py.File(split_file, 'r') as f:
+        split = {key: f[key][:] for key in SPLIT_KEYS}
+        n_events = int(f.attrs['n_events'])
+        print(f"Loaded split (seed {f.attrs['seed']}) of {n_events} events: "
+              + ', '.join(f'{key} {len(split[key])}' for key in SPLIT_KEYS))
+    if path_to_data is not None:
+        sample_events = count_sample_events(path_to_data)
+        if sample_events != n_events:
+            raise ValueError(f'The split {split_file} is for {n_events} events, but {path_to_data} has {sample_events}.')
+    return split
+
+
+def split_rows(split, event_ids) -> dict:
+    """
+    Turn the split (event ids) into the rows of the loaded arrays, whose events are `event_ids`.
+    The events not loaded (e.g. outside the cvnmap) are not in any set.
+    :param split: dict, from load_split()
+    :param event_ids: sorted np.array, the event id of each row of the loaded arrays
+    :return: dict of {'train', 'val', 'test': np.array of rows}
+    """
+    rows = {}
+    for key in SPLIT_KEYS:
+        position = np.searchsorted(event_ids, split[key])
+        found = position < len(event_ids)
+        found[found] = event_ids[position[found]] == split[key][found]
+        rows[key] = position[found]
+    return rows
+
+
+def split_digest(event_ids) -> str:
+    """
+    :param event_ids: np.array of the event ids of a set of a split (e.g. split['train'])
+    :return: str, hex sha256 of the ids, to tell if something (e.g. the pixel stats) was made from the same set
+    """
+    return hashlib.sha256(np.asarray(event_ids, dtype=np.int64).tobytes()).hexdigest()
@@ -0,0 +1,89 @@
+# vds.py
+# Tools to stitch the preprocessed h5 files of a sample into one HDF5 virtual dataset (VDS) file.
+# Each dataset of the VDS file maps onto the same dataset of every preprocessed file, in order,
+# so any global range of events is one h5py read -- no per-file lists, no concatenation, and no copy of the data on disk.
+
+import os
+
+import h5py
+import numpy as np
+
+import utils.atomic
+import utils.iomanager as io
+import utils.shards
+
+
+def vds_filename(input_dir) -> str:
+    """
+    :param input_dir: directory of the preprocessed h5 files of a sample
+    :return: full path to its VDS file, in the same directory and named after it (so det, horn & flux can be read from it)
+    """
+    return os.path.join(input_dir, os.path.basename(os.path.normpath(input_dir)) + '.vds.h5')
+
+
+def build_vds(in_files, vds_file) -> str:
+    """
+    Build a VDS file of the preprocessed files: every per-event dataset (cvnmap, vtx.*, firstcell*, ...)
+    of the files, one after the other in the order of `in_files`. The event id of an event is its row in the VDS.
+    The sources are mapped by absolute path, so the preprocessed files must stay where they are.
+    Written with atomic.atomic_output().
+    :param in_files: list of full paths to the preprocessed h5 files (all preprocessed with the same options)
+    :param vds_file: full path to the VDS file to create
+    :return: full path to the VDS file
+    """
+    if not in_files:
+        raise ValueError('No preprocessed files to stitch.')
+    events_per_file = []
+    for in_file in in_files:
+        with h5py.File(in_file, 'r') as f:
+            if 'cvnmap_offsets' in f:
+                # the offsets of each file start at 0, they would need re-basing, i.e. a copy.
+                raise ValueError(f"{in_file} is '--layout sparse', repack it (repack_h5_shards.py) instead.")
+            layout = {key: f.attrs.get(key) for key in utils.shards.LAYOUT_ATTRS}
+            if not events_per_file:
+                first_layout = layout
+                # name, per-event shape & type of every dataset.
+                sources = {key: (f[key].shape[1:], f[key].dtype) for key in f.keys()}
+            elif str(layout) != str(first_layout) or sorted(f.keys()) != sorted(sources):
+                raise ValueError(f'{in_file} does not have the same datasets or layout as {in_files[0]}.')
+            events_per_file.append(io.events_in_file(f))
+    total_events = int(np.sum(events_per_file))
+    file_offsets = np.concatenate(([0], np.cumsum(events_per_file)))
+    print(f'Stitching {total_events} events from {len(in_files)} files: {list(sources)}')
+
+    with utils.atomic.atomic_output(vds_file) as partial_file, h5py.File(partial_file, 'w') as f_vds:
+        for key, (event_shape, dtype) in sources.items():
+            layout = h5py.VirtualLayout(shape=(total_events,) + event_shape, dtype=dtype)
+            for file_number, in_file in enumerate(in_files):
+                n_events = events_per_file[file_number]
+                source = h5py.VirtualSource(os.path.abspath(in_file), key, shape=(n_events,) + event_shape)
+                layout[file_offsets[file_number]:file_offsets[file_number + 1]] = source
+            f_vds.create_virtual_dataset(key, layout)
+        # event id -> source file (searchsorted on the offsets).
+        f_vds.create_dataset('vds_file_offsets', data=file_offsets)
+        f_vds.create_dataset('vds_source_files', data=[os.path.abspath(in_file) for in_file in in_files])
+        for key, value in first_layout.items():
+            if value is not None:
+                f_vds.attrs[key] = value
+        # so a directory listing doesn't take the VDS for more events (see iomanager.has_cvnmap()).
+        f_vds.attrs['virtual'] = True
+        f_vds.attrs['total_events'] = total_events
+    print(f'Virtual dataset file created: {vds_file}')
+    return vds_file
+
+
+def read_events(vds_file, start=0, stop=None, keys=None) -> dict:
+    """
+    Read a global range of events of the sample, one read per dataset.
+    :param vds_file: full path to the VDS file
+    :param start: int, first event id to read
+    :param stop: int, one past the last event id to read. None reads to the end.
+    :param keys: list of the datasets to read (default: all of them)
+    :return: dict of {key: np.array}, and 'event_id'
+    """
+    with h5py.File(vds_file, 'r') as f:
+        stop = int(f.attrs['total_events']) if stop is None else stop
+        keys = [key for key in f.keys() if not key.startswith('vds_')] if keys is None else keys
+        events = {key: f[key][start:stop] for key in keys}
+    events['event_id'] = np.arange(start, start + len(events[keys[0]]))
+    return events
@@ -0,0 +1,286 @@
+# verify.py
+# Tools to check the integrity of the preprocessed files, before a (long) training job reads them:
+# the schema, the types, the event count of every dataset, that every chunk decompresses,
+# the values of the first hits, and the size & checksum recorded in the manifest.
+
+import json
+import os
+import time
+
+import numpy as np
+
+import utils.atomic
+import utils.data_processing as dp
+import utils.iomanager as io
+import utils.preprocess
+import utils.zarr_store
+
+# bytes read at a time from a dataset, i.e. the memory used per file checked.
+READ_BLOCK_BYTES = 64 * 1024 ** 2
+
+# the valid first hits, once read as signed ints. FD has 384 cells and 896 planes,
+# and the cvnmap (80 cells x 100 planes) can start before the first cell or plane.
+FD_FIRST_HIT_RANGES = {'firstcellx': (-80, 384), 'firstcelly': (-80, 384), 'firstplane': (-100, 896)}
+
+# the datasets every preprocessed file has, besides the cvnmap (in any layout).
+REQUIRED_KEYS = ['vtx.x', 'vtx.y', 'vtx.z', 'firstcellx', 'firstcelly', 'firstplane']
+
+# what reading a damaged file raises: an OSError (h5py: truncated file, bad chunk), a KeyError or ValueError
+# (missing dataset, bad metadata or manifest), or a RuntimeError (a Blosc chunk of a Zarr store that doesn't decompress).
+READ_ERRORS = (OSError, KeyError, ValueError, RuntimeError)
+
+
+def find_preprocessed_paths(input_dirs) -> list:
+    """
+    Unlike io.list_preprocessed_files(), the files are not opened, so a corrupted file is listed (and reported).
+    :param input_dirs: list of directories of preprocessed h5 files (or Zarr stores)
+    :return: sorted list of full paths to the h5 files and Zarr stores
+    """
+    paths = []
+    for input_dir in input_dirs:
+        for name in sorted(os.listdir(input_dir)):
+            if name.endswith('.h5') or utils.zarr_store.is_zarr(name):
+                paths.append(os.path.join(input_dir, name))
+    return paths
+
+
+def expected_dtypes(f) -> dict:
+    """
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :return: dict of {dataset: the numpy type kinds it may have ('f' float, 'iu' int, ...), or the exact type}
+    """
+    expected = {key: 'f' for key in ['vtx.x', 'vtx.y', 'vtx.z']}
+    expected.update({key: 'iu' for key in utils.preprocess.FIRST_HIT_KEYS.values()})
+    expected.update({key: 'float32' for key in utils.preprocess.PIXELMAP_LABEL_KEYS.values()})
+    expected.update({key: 'uint8' for key in ['cvnmap', 'cvnmap_value'] + utils.preprocess.CVNMAP_VIEW_KEYS})
+    expected.update({'cvnmap_offsets': 'int64', 'cvnmap_index': 'uint16', 'contained': 'bool'})
+    pooling = f.attrs.get('pyramid_pooling', 'none')
+    for factor in utils.preprocess.PYRAMID_FACTORS:
+        expected.update({key: 'uint16' if pooling == 'sum' else 'uint8' for key in utils.preprocess.pyramid_view_keys(factor)})
+        expected.update({key: 'float32' for key in utils.preprocess.pyramid_label_keys(factor).values()})
+    return expected
+
+
+def event_shape(key):
+    """
+    :param key: str, dataset name
+    :return: tuple, the shape of one event of the dataset, or None if not fixed (the scalars can be (N,) or (N, 1))
+    """
+    if key == 'cvnmap':
+        return (16000,)
+    if key in utils.preprocess.CVNMAP_VIEW_KEYS:
+        return (100, 80)
+    for factor in utils.preprocess.PYRAMID_FACTORS:
+        if key in utils.preprocess.pyramid_view_keys(factor):
+            return (100 // factor, 80 // factor)
+    return None
+
+
+def check_schema(f, report) -> None:
+    """
+    The schema version, the datasets present, and the type & shape of each.
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :param report: dict, the errors & warnings are appended to it
+    :return: None
+    """
+    version = f.attrs.get('schema_version')
+    if version is None:
+        report['warnings'].append('no schema_version attribute')
+    elif int(version) != utils.preprocess.SCHEMA_VERSION:
+        report['errors'].append(f'schema_version {version}, expected {utils.preprocess.SCHEMA_VERSION}')
+
+    keys = list(f.keys())
+    for key in REQUIRED_KEYS:
+        if key not in keys:
+            report['errors'].append(f'missing dataset {key}')
+    layouts = {'flat': ['cvnmap'], 'views': utils.preprocess.CVNMAP_VIEW_KEYS, 'sparse': utils.preprocess.CVNMAP_SPARSE_KEYS}
+    found = [layout for layout, layout_keys in layouts.items() if all(key in keys for key in layout_keys)]
+    if len(found) != 1:
+        report['errors'].append(f'expected the cvnmap in exactly one layout, found {found or "none"}')
+    elif f.attrs.get('layout', found[0]) != found[0]:
+        report['errors'].append(f"layout attribute is {f.attrs.get('layout')}, the datasets are {found[0]}")
+    for factor in f.attrs.get('pyramid', []):
+        for key in utils.preprocess.pyramid_view_keys(int(factor)):
+            if key not in keys:
+                report['errors'].append(f'missing dataset {key} (pyramid {factor})')
+
+    expected = expected_dtypes(f)
+    for key in keys:
+        dtype = np.dtype(f[key].dtype)
+        if key not in expected:
+            report['warnings'].append(f'unexpected dataset {key} ({dtype})')
+        elif expected[key] in ['f', 'iu'] and dtype.kind not in expected[key]:
+            report['errors'].append(f'{key} is {dtype}, expected a {"float" if expected[key] == "f" else "int"}')
+        elif expected[key] not in ['f', 'iu'] and dtype != np.dtype(expected[key]):
+            report['errors'].append(f'{key} is {dtype}, expected {expected[key]}')
+        shape = event_shape(key)
+        if shape is not None and tuple(f[key].shape[1:]) != shape:
+            report['errors'].append(f'{key} has events of shape {f[key].shape[1:]}, expected {shape}')
+    return None
+
+
+def check_event_counts(f, report) -> int:
+    """
+    Every per-event dataset has the same number of events (the sparse offsets one more),
+    and the sparse offsets cover the pixels exactly.
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :param report: dict, the errors are appended to it
+    :return: int, events in the file
+    """
+    n_events = io.events_in_file(f)
+    for key in f.keys():
+        if key in ['cvnmap_index', 'cvnmap_value']:
+            continue
+        expected = n_events + 1 if key == 'cvnmap_offsets' else n_events
+        if f[key].shape[0] != expected:
+            report['errors'].append(f'{key} has {f[key].shape[0]} rows, expected {expected}')
+    if 'cvnmap_offsets' in f:
+        n_pixels = f['cvnmap_index'].shape[0]
+        if f['cvnmap_value'].shape[0] != n_pixels:
+            report['errors'].append(f"cvnmap_value has {f['cvnmap_value'].shape[0]} pixels, cvnmap_index {n_pixels}")
+        if int(f['cvnmap_offsets'][-1]) != n_pixels:
+            report['errors'].append(f"the last cvnmap_offset is {int(f['cvnmap_offsets'][-1])}, expected {n_pixels} pixels")
+    return n_events
+
+
+def check_values(key, block, report) -> None:
+    """
+    Check a block of a dataset: no NaN or inf in the floats, the first hits in range, the sparse pixels valid.
+    :param key: str, dataset name
+    :param block: np.array, the rows read
+    :param report: dict, the counts of bad values are added to report['bad_values'][key]
+    :return: None
+    """
+    bad = 0
+    if block.dtype.kind == 'f':
+        bad += int(np.count_nonzero(~np.isfinite(block)))
+    if key in FD_FIRST_HIT_RANGES and block.dtype.kind in 'iu':
+        # the unbaked first hits are the signed values written as uint32 (see dp.remove_unsigned_ints_array()).
+        first_hit = dp.remove_unsigned_ints_array(block, 'int64') if block.dtype.kind == 'u' else block
+        low, high = FD_FIRST_HIT_RANGES[key]
+        bad += int(np.count_nonzero((first_hit < low) | (first_hit >= high)))
+    if key == 'cvnmap_index':
+        bad += int(np.count_nonzero(block >= 16000))
+    if key == 'cvnmap_offsets':
+        bad += int(np.count_nonzero(np.diff(block) < 0))
+    if bad:
+        report['bad_values'][key] = report['bad_values'].get(key, 0) + bad
+    return None
+
+
+def check_readable(f, report) -> None:
+    """
+    Read every dataset front to back, in blocks of ~READ_BLOCK_BYTES, so every chunk is decompressed,
+    and check the values read (see check_values()).
+    :param f: h5py.File or zarr.Group, the open preprocessed file
+    :param report: dict, the errors are appended to it
+    :return: None
+    """
+    for key in f.keys():
+        dset = f[key]
+        row_bytes = int(np.prod(dset.shape[1:], dtype=np.int64)) * np.dtype(dset.dtype).itemsize
+        rows_per_read = max(1, READ_BLOCK_BYTES // max(row_bytes, 1))
+        contained_events = 0
+        # the sparse offsets are read overlapping by one, so the order is checked across the blocks too.
+        step = rows_per_read - 1 if key == 'cvnmap_offsets' and rows_per_read > 1 else rows_per_read
+        for start in range(0, max(dset.shape[0], 1), step):
+            stop = min(start + rows_per_read, dset.shape[0])
+            try:
+                block = dset[start:stop]
+            except READ_ERRORS as e:
+                report['errors'].append(f'{key}: rows {start}-{stop} are unreadable: {e!r}')
+                break
+            check_values(key, block, report)
+            if key == 'contained':
+                contained_events += int(np.count_nonzero(block))
+            if stop >= dset.shape[0]:
+                break
+        if key == 'contained' and f.attrs.get('containment') == 'mask':
+            outside = int(f.attrs.get('events_outside_cvnmap', -1))
+            if outside >= 0 and dset.shape[0] - contained_events != outside:
+                report['errors'].append(f'{dset.shape[0] - contained_events} events are not contained, '
+                                        f'the events_outside_cvnmap attribute is {outside}')
+    for key, bad in report['bad_values'].items():
+        report['errors'].append(f'{key}: {bad} NaN, inf or out of range values')
+    return None
+
+
+def check_manifest(path, n_events, report, checksum=True) -> None:
+    """
+    Check the file against its manifest (see preprocess.write_manifest()): the size, the events, and the checksum.
+    The shards (and files preprocessed before the manifests) have none, which is only a warning.
+    :param path: full path to the preprocessed h5 file (or Zarr store)
+    :param n_events: int, events in the file
+    :param report: dict, the errors & warnings are appended to it
+    :param checksum: bool, also check the sha256 checksum (reads the whole file again)
+    :return: None
+    """
+    manifest_file = utils.preprocess.manifest_filename(path)
+    if not os.path.exists(manifest_file):
+        report['warnings'].append('no manifest')
+        return None
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except ValueError as e:
+        report['errors'].append(f'unreadable manifest: {e}')
+        return None
+    if io.path_size(path) != manifest.get('output_size'):
+        report['errors'].append(f"size is {io.path_size(path)} bytes, the manifest has {manifest.get('output_size')}")
+    if n_events != manifest.get('events'):
+        report['errors'].append(f"{n_events} events, the manifest has {manifest.get('events')}")
+    if checksum and utils.preprocess.file_sha256(path) != manifest.get('output_sha256'):
+        report['errors'].append('sha256 checksum does not match the manifest')
+    return None
+
+
+def verify_file(path, checksum=True) -> dict:
+    """
+    Check one preprocessed file (see the check_*() functions). Never raises, every problem is in the report.
+    :param path: full path to the preprocessed h5 file (or Zarr store)
+    :param checksum: bool, also check the sha256 checksum of the manifest
+    :return: dict of the file, its status ('ok', 'warning', 'error', or 'skipped' if it holds no events, e.g. a sidecar),
+             the events, the errors & warnings, and the seconds taken
+    """
+    start = time.time()
+    report = {'file': path, 'status': 'ok', 'events': 0, 'errors': [], 'warnings': [], 'bad_values': {}}
+    try:
+        with io.open_preprocessed(path) as f:
+            if not io.has_cvnmap(f):
+                report['status'] = 'skipped'
+            else:
+                check_schema(f, report)
+                report['events'] = check_event_counts(f, report)
+                check_readable(f, report)
+        if report['status'] != 'skipped':
+            check_manifest(path, report['events'], report, checksum)
+    except READ_ERRORS as e:  # e.g. a truncated file, that doesn't even open.
+        report['errors'].append(f'cannot read the file: {e!r}')
+    if report['errors']:
+        report['status'] = 'error'
+    elif report['warnings'] and report['status'] == 'ok':
+        report['status'] = 'warning'
+    report['seconds'] = time.time() - start
+    return report
+
+
+def write_summary(reports, summary_file) -> dict:
+    """
+    Write the reports of every file checked, with the totals, as JSON (atomically).
+    :param reports: list of dict, from verify_file()
+    :param summary_file: full path to the summary JSON file
+    :return: dict, the summary
+    """
+    reports = sorted(reports, key=lambda report: report['file'])
+    counts = {status: sum(report['status'] == status for report in reports)
+              for status in ['ok', 'warning', 'error', 'skipped']}
+    summary = {'files': len(reports),
+               **counts,
+               'events': int(sum(report['events'] for report in reports if report['status'] != 'error')),
+               'failed_files': [report['file'] for report in reports if report['status'] == 'error'],
+               'reports': reports,
+               'created': time.ctime()}
+    with utils.atomic.atomic_output(summary_file) as partial_file, open(partial_file, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    print(f'Summary saved to: {summary_file}')
+    return summary
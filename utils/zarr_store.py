@@ -0,0 +1,125 @@
+# zarr_store.py
+# Tools to write and read the preprocessed data as a Zarr store (a directory of chunk files), compressed with Blosc.
+# An alternative to HDF5: h5py decompresses one chunk at a time, under the HDF5 global lock,
+# while Blosc releases the GIL, so the chunks of a read are decompressed in parallel threads.
+# zarr (v2) & numcodecs are optional, they are only imported when a Zarr store is written or read.
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+# the name of a Zarr store ends with this, instead of '.h5'.
+ZARR_SUFFIX = '.zarr'
+
+# the Blosc compressors, on top of 'gzip' & 'none' (numcodecs has no lzf).
+BLOSC_CODECS = ['lz4', 'zstd']
+ZARR_CODECS = BLOSC_CODECS + ['gzip', 'none']
+
+# threads to decompress the chunks of a read with, e.g. the CPUs of a slurm job.
+DEFAULT_READ_THREADS = 8
+
+
+def import_zarr():
+    """
+    :return: the zarr & numcodecs modules
+    """
+    try:
+        import numcodecs
+        import zarr
+    except ImportError as e:
+        raise ImportError("The Zarr backend needs zarr (v2) and numcodecs: pip install 'zarr<3'") from e
+    return zarr, numcodecs
+
+
+def is_zarr(path) -> bool:
+    """
+    :param path: path to a preprocessed file or store
+    :return: True if it is a Zarr store
+    """
+    return os.path.normpath(path).endswith(ZARR_SUFFIX)
+
+
+def open_zarr(path, mode='r'):
+    """
+    :param path: full path to the Zarr store (a directory)
+    :param mode: 'r' to read, 'w' to create (replacing any store there)
+    :return: zarr.Group, with the same dataset & attribute access as an h5py.File
+    """
+    zarr, _ = import_zarr()
+    return zarr.open_group(path, mode=mode)
+
+
+def zarr_storage_kwargs(shape, compression='lz4', compression_level=5, shuffle=False, chunk_events=1) -> dict:
+    """
+    The zarr create_dataset() keywords for the compression and chunk layout of one dataset,
+    the chunks the same as preprocess.dataset_storage_kwargs().
+    :param shape: tuple, shape of the dataset (events first)
+    :param compression: str, one of ZARR_CODECS
+    :param compression_level: int, compression level (Blosc 0-9, gzip 0-9)
+    :param shuffle: bool, apply the Blosc bit-shuffle filter before compressing
+    :param chunk_events: int, events per chunk
+    :return: dict of keywords
+    """
+    if compression not in ZARR_CODECS:
+        raise ValueError(f'Compression {compression} is not valid for Zarr. Use one of {ZARR_CODECS}.')
+    _, numcodecs = import_zarr()
+    if compression in BLOSC_CODECS:
+        bit_shuffle = numcodecs.Blosc.BITSHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE
+        compressor = numcodecs.Blosc(cname=compression, clevel=compression_level, shuffle=bit_shuffle)
+    elif compression == 'gzip':
+        compressor = numcodecs.GZip(level=compression_level)
+    else:
+        compressor = None
+
+    chunk_events = max(1, min(chunk_events, shape[0]))
+    if int(np.prod(shape[1:])) <= 1:
+        # the scalar columns are tiny, so use big chunks -- never less than one chunk of maps.
+        chunk_events = max(chunk_events, min(shape[0], 65536))
+    return {'chunks': (chunk_events,) + tuple(shape[1:]), 'compressor': compressor}
+
+
+def read_array(arr, start=0, stop=None, rows=None, n_threads=DEFAULT_READ_THREADS, out=None) -> np.array:
+    """
+    Read events of a Zarr array, the chunks split across `n_threads` threads,
+    each decompressing straight into its part of the (preallocated) output.
+    :param arr: zarr.Array (events first)
+    :param start: int, first event to read
+    :param stop: int, one past the last event to read. None reads to the end.
+    :param rows: sorted np.array of the events to read (or a boolean mask), instead of start & stop.
+                 The span of the rows is read, and the rows kept.
+    :param n_threads: int, threads to read with
+    :param out: np.array of the events read, to read into. None allocates it.
+                With `rows`, their span is still read into a temporary array first.
+    :return: np.array (`out`, if given)
+    """
+    if rows is not None:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        if len(rows) == 0:
+            return np.empty((0,) + arr.shape[1:], dtype=arr.dtype) if out is None else out
+        start, stop = int(rows[0]), int(rows[-1]) + 1
+    stop = arr.shape[0] if stop is None else min(stop, arr.shape[0])
+    selected = out
+    if out is None or rows is not None:
+        out = np.empty((max(stop - start, 0),) + arr.shape[1:], dtype=arr.dtype)
+
+    # whole chunks per thread, so no chunk is decompressed twice.
+    chunk_events = arr.chunks[0]
+    chunk_starts = np.arange(start - start % chunk_events, stop, chunk_events)
+    per_thread = max(1, -(-len(chunk_starts) // n_threads))
+    bounds = [(max(int(chunk_starts[i]), start), min(int(chunk_starts[i]) + per_thread * chunk_events, stop))
+              for i in range(0, len(chunk_starts), per_thread)] if len(out) else []
+
+    def read(bound):
+        arr.get_basic_selection(slice(*bound), out=out[bound[0] - start:bound[1] - start])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(read, bounds))
+    if rows is None:
+        return out
+    if selected is None:
+        return out[rows - start]
+    selected[...] = out[rows - start]
+    return selected